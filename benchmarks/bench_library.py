@@ -0,0 +1,199 @@
+"""
+Scans a synthetic library made by benchmarks/gen_library.py, or an
+existing one, and reports how long a cold scan (no index) and a warm scan
+(index of the cold one) take, how much memory the scanned library holds
+and how long serializing /music/playlist/all takes.
+
+Needs what the library needs, i.e. eyed3.
+
+    python3 benchmarks/bench_library.py [--path AUDIO_DIR | --playlists 200 --albums-per-playlist 5
+                                         --songs-per-album 12 --state] [--repeat 3] [--json] [--output FILE]
+
+An existing library is scanned in a copy in a temporary directory, so its
+index, saved state and checkpoints are left alone.
+
+--output writes the results with the parameters and a timestamp, to be
+compared with earlier runs.
+"""
+from argparse import ArgumentParser
+import gc
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "marta"))
+sys.path.insert(0, BENCHMARKS_DIR)
+os.environ.setdefault("MARTA", os.path.join(BENCHMARKS_DIR, ".."))
+
+from gen_library import generate  # noqa: E402
+from Library import Library, INDEX_FILE, STATE_FILE, CHECKPOINT_FILE  # noqa: E402
+from LibrarySnapshot import SnapshotReader  # noqa: E402
+
+
+def _link_or_copy(source, destination):
+    # Scans only read songs, so they can be shared with the original
+    if source.lower().endswith(".mp3"):
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, destination)
+
+
+def copy_library(audio_path):
+    '''
+    Copies a library into a temporary directory, without what earlier
+    scans left behind. Returns the path of the copy.
+    '''
+    copy_path = os.path.join(tempfile.mkdtemp(prefix="marta-library-"), "audio")
+    shutil.copytree(audio_path, copy_path, copy_function=_link_or_copy,
+                    ignore=shutil.ignore_patterns(INDEX_FILE + "*", STATE_FILE + "*", CHECKPOINT_FILE + "*"))
+    return copy_path
+
+
+def forget(audio_path):
+    '''
+    Removes what earlier scans left behind: index, saved state and
+    checkpoints, including SQLite's journal files.
+    '''
+    for name in os.listdir(audio_path):
+        if any(name.startswith(prefix) for prefix in [INDEX_FILE, STATE_FILE, CHECKPOINT_FILE]):
+            os.unlink(os.path.join(audio_path, name))
+
+
+def scan(audio_path, snapshot_path):
+    '''
+    Registers and scans all playlists like the warm up does, returns the
+    library and the seconds it took.
+    '''
+    started_at = time.monotonic()
+    library = Library(audio_path, warm_up=False, analyze_loudness=False, snapshot_path=snapshot_path)
+    library.materialize_all()
+    return library, time.monotonic() - started_at
+
+
+def timed(function, repeat):
+    '''
+    Best of repeat runs in seconds and the result of the last one.
+    '''
+    best = None
+    for i in range(repeat):
+        started_at = time.monotonic()
+        result = function()
+        seconds = time.monotonic() - started_at
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def measure_memory(audio_path, snapshot_path):
+    '''
+    Bytes held by a warm scanned library, and the most held while
+    scanning.
+    '''
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    library, seconds = scan(audio_path, snapshot_path)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    library.terminate()
+    return current - before, peak - before
+
+
+def run(audio_path, repeat):
+    snapshot_path = os.path.join(tempfile.mkdtemp(prefix="marta-bench-"), "library.snapshot")
+    results = {"cold_scan_seconds": None, "warm_scan_seconds": None}
+
+    try:
+        for i in range(repeat):
+            forget(audio_path)
+            library, seconds = scan(audio_path, snapshot_path)
+            library.terminate()
+            results["cold_scan_seconds"] = min(seconds, results["cold_scan_seconds"] or seconds)
+
+        for i in range(repeat):
+            library, seconds = scan(audio_path, snapshot_path)
+            library.terminate()
+            results["warm_scan_seconds"] = min(seconds, results["warm_scan_seconds"] or seconds)
+
+        results["library_bytes"], results["scan_peak_bytes"] = measure_memory(audio_path, snapshot_path)
+
+        library, seconds = scan(audio_path, snapshot_path)
+        results["playlists"] = len(library.playlists)
+        results["albums"] = sum(len(playlist.albums) for playlist in library.playlists)
+        results["songs"] = sum(1 for song in library.songs())
+
+        # What the web process got before snapshots, what the library
+        # does for each snapshot and what the web process does now
+        results["to_json_seconds"], payload = timed(lambda: json.dumps(library.to_snapshot()), repeat)
+        results["json_bytes"] = len(payload)
+        results["publish_seconds"], _ = timed(library.snapshot.publish, repeat)
+        reader = SnapshotReader(snapshot_path)
+        results["snapshot_read_seconds"], _ = timed(reader.payload, repeat)
+        reader.close()
+        library.terminate()
+    finally:
+        shutil.rmtree(os.path.dirname(snapshot_path), ignore_errors=True)
+
+    results["max_rss_kbytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--path", help="scan a copy of this library instead of a generated one")
+    parser.add_argument("--playlists", type=int, default=200)
+    parser.add_argument("--albums-per-playlist", type=int, default=5)
+    parser.add_argument("--songs-per-album", type=int, default=12)
+    parser.add_argument("--state", action="store_true", help="generate playlist.json and album.json files")
+    parser.add_argument("--repeat", type=int, default=3, help="take the best of this many runs")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    params = {"repeat": args.repeat}
+    if args.path is not None:
+        audio_path = copy_library(args.path)
+        params["path"] = os.path.abspath(args.path)
+    else:
+        audio_path = os.path.join(tempfile.mkdtemp(prefix="marta-library-"), "audio")
+        generate(audio_path, args.playlists, args.albums_per_playlist, args.songs_per_album, state=args.state)
+        params.update(playlists=args.playlists, albums_per_playlist=args.albums_per_playlist,
+                      songs_per_album=args.songs_per_album, state=args.state)
+
+    try:
+        results = run(audio_path, args.repeat)
+    finally:
+        shutil.rmtree(os.path.dirname(audio_path), ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "params": params, "results": results}, f,
+                      indent=2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("{} playlists, {} albums, {} songs".format(results["playlists"], results["albums"], results["songs"]))
+    print("cold scan    {:8.3f} s".format(results["cold_scan_seconds"]))
+    print("warm scan    {:8.3f} s".format(results["warm_scan_seconds"]))
+    print("library      {:8.1f} MiB, peak while scanning {:.1f} MiB, max rss {:.1f} MiB".format(
+        results["library_bytes"] / 2.0 ** 20, results["scan_peak_bytes"] / 2.0 ** 20,
+        results["max_rss_kbytes"] / 1024.0))
+    print("to json      {:8.2f} ms for {:.1f} KiB".format(results["to_json_seconds"] * 1000,
+                                                        results["json_bytes"] / 1024.0))
+    print("publish      {:8.2f} ms".format(results["publish_seconds"] * 1000))
+    print("read         {:8.2f} ms".format(results["snapshot_read_seconds"] * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Memory used by the in-memory library for a synthetic library, comparing
+the compact representation (slotted Song/Album, interned strings, index
+rows as tuples) with the former one (plain objects, index rows as dicts).
+
+Nothing is read from disk, songs are made up.
+
+    python3 benchmarks/bench_memory.py [--songs 20000] [--songs-per-album 12] [--json]
+"""
+from argparse import ArgumentParser
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "marta"))
+os.environ.setdefault("MARTA", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from Library import Song, Album  # noqa: E402
+from LibraryIndex import LibraryIndex  # noqa: E402
+
+
+class FormerSong(object):
+    """
+    Song as it used to be: an instance dict and a string copy per song.
+    """
+    def __init__(self, path, title=None, album=None, artist=None, track_num=None, mtime=None, size=None,
+                 length_millis=None, sample_rate=None):
+        self.path = path
+        self.title = title
+        self.album = album
+        self.artist = artist
+        self.track_num = track_num
+        self.mtime = mtime
+        self.size = size
+        self.length_millis = length_millis
+        self.sample_rate = sample_rate
+        self.current_position = None
+
+
+def make_rows(songs, songs_per_album):
+    '''
+    Rows like they come out of the index database, every string a copy of
+    its own.
+    '''
+    rows = []
+    for i in range(songs):
+        album = i // songs_per_album
+        album_path = "/home/pi/mmm/audio/Playlist {:04d} 0123456789AB/Album {:05d}".format(album // 10, album)
+        rows.append({
+            "path": "{}/{:02d} Song number {}.mp3".format(album_path, i % songs_per_album + 1, i),
+            "title": "Song number {}".format(i),
+            "album": "".join(["Album ", str(album)]),
+            "artist": "".join(["Artist ", str(album // 10)]),
+            "track_num": i % songs_per_album + 1,
+            "mtime": 1500000000.0 + i,
+            "size": 4000000 + i,
+            "length_millis": 180000 + i,
+            "sample_rate": 44100,
+        })
+    return rows
+
+
+def fresh(row):
+    '''
+    Copy of a row with values of its own, like each query returns them.
+    '''
+    copy = {}
+    for key, value in row.items():
+        if isinstance(value, str):
+            copy[key] = "".join(list(value))
+        elif value is not None:
+            copy[key] = type(value)(str(value))
+        else:
+            copy[key] = None
+    return copy
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return used
+
+
+def build_songs(song_class, rows):
+    return lambda: [song_class(**fresh(row)) for row in rows]
+
+
+def build_albums(rows, songs_per_album):
+    def build():
+        albums = []
+        for start in range(0, len(rows), songs_per_album):
+            album = Album.__new__(Album)
+            album.path = os.path.dirname(rows[start]["path"])
+            album.songs = [Song(**fresh(row)) for row in rows[start:start + songs_per_album]]
+            albums.append(album)
+        return albums
+    return build
+
+
+def build_former_index(rows):
+    def build():
+        songs_by_dir = {}
+        for row in rows:
+            songs_by_dir.setdefault(os.path.dirname(row["path"]), []).append(fresh(row))
+        return songs_by_dir
+    return build
+
+
+def build_index(rows):
+    def build():
+        index = LibraryIndex(":memory:")
+        songs_by_dir = {}
+        for row in rows:
+            songs_by_dir.setdefault(os.path.dirname(row["path"]), []).append(row)
+        for album_path, songs in songs_by_dir.items():
+            index.put_album(album_path, songs)
+        index.commit()
+        # Measure what a boot loads, not what was put
+        index.load()
+        return index
+    return build
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--songs", type=int, default=20000)
+    parser.add_argument("--songs-per-album", type=int, default=12)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    rows = make_rows(args.songs, args.songs_per_album)
+
+    results = {
+        "songs": args.songs,
+        "former_songs_bytes": measure(build_songs(FormerSong, rows)),
+        "songs_bytes": measure(build_songs(Song, rows)),
+        "albums_bytes": measure(build_albums(rows, args.songs_per_album)),
+        "former_index_bytes": measure(build_former_index(rows)),
+        "index_bytes": measure(build_index(rows)),
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    def line(name, former, current):
+        print("{:<8} {:>10.1f} MiB {:>10.1f} MiB {:>7.0f} %".format(
+            name, former / 2.0 ** 20, current / 2.0 ** 20, 100.0 * current / former))
+
+    print("{} songs, {} per album".format(args.songs, args.songs_per_album))
+    print("{:<8} {:>14} {:>14} {:>9}".format("", "former", "now", "ratio"))
+    line("songs", results["former_songs_bytes"], results["songs_bytes"])
+    line("index", results["former_index_bytes"], results["index_bytes"])
+    print("albums incl. songs now: {:.1f} MiB".format(results["albums_bytes"] / 2.0 ** 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Drives scripted sessions through Marta.message_loop on a plain Linux box,
+with the hardware replaced by the fakes in sim/ and mpg123 by
+sim/fake_mpg123.py. Reports the latencies recorded by marta/Latency.py and
+the CPU time used per scenario.
+
+Needs what marta needs apart from the hardware, i.e. flask.
+The library is a copy of audio/ in a temporary directory.
+
+    python3 benchmarks/bench_sim.py [--scenarios tag,skips,tilts,track_ends,web] [--rounds 5] [--json]
+"""
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from multiprocessing import Process, Queue
+from threading import Thread
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SIM_DIR = os.path.join(BASE_DIR, "sim")
+
+# The fakes have to shadow the hardware modules
+sys.path.insert(0, os.path.join(BASE_DIR, "marta"))
+sys.path.insert(0, SIM_DIR)
+
+import RPi.GPIO as GPIO  # noqa: E402
+import serial  # noqa: E402
+import smbus  # noqa: E402
+
+# Tags of the two playlists of the simulated library
+TAGS = [serial.tag_with_checksum("B0B0B0B001"), serial.tag_with_checksum("B0B0B0B002")]
+
+# Track length and speed of the fake mpg123, set by main()
+SESSION = {}
+
+# Stages shown in the summary, all of them are in the JSON output
+SUMMARY_STAGES = ["button", "rfid", "queue", "handler.EVENT_TAG", "handler.EVENT_BUTTON", "handler.EVENT_ROTATION",
+                  "handler.EVENT_SONG_STOPPED", "player.LP", "player.P", "input_to_audio", "led", "web.all",
+                  "web.latency"]
+
+
+def make_base_dir():
+    '''
+    A MARTA directory with a copy of audio/system and two playlists made
+    from the examples in audio/.
+    '''
+    base_dir = tempfile.mkdtemp(prefix="marta-sim-")
+    audio = os.path.join(base_dir, "audio")
+    os.makedirs(os.path.join(base_dir, "logs"))
+    shutil.copytree(os.path.join(BASE_DIR, "audio", "system"), os.path.join(audio, "system"))
+    shutil.copytree(os.path.join(BASE_DIR, "audio", "example_112233445566"),
+                    os.path.join(audio, "Simulated audiobook " + TAGS[0]))
+    shutil.copytree(os.path.join(BASE_DIR, "audio", "C01DDEADBEEF"), os.path.join(audio, "Simulated music " + TAGS[1]))
+    return base_dir
+
+
+def cpu_seconds(pid):
+    '''
+    User and system CPU time of a process, from /proc.
+    '''
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+
+def children_cpu_seconds():
+    '''
+    CPU time of the direct children, i.e. the LED process, the fake mpg123
+    processes and web pollers.
+    '''
+    total = 0.0
+    me = str(os.getpid())
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                if f.read().rsplit(")", 1)[1].split()[1] == me:
+                    total += cpu_seconds(pid)
+        except (OSError, IndexError):
+            pass
+    return total
+
+
+################################################################
+# SCENARIOS
+
+def scenario_tag(rounds):
+    '''
+    Places a tag, lets it play for a moment and removes it again.
+    '''
+    for i in range(rounds):
+        serial.place_tag(TAGS[i % 2])
+        time.sleep(1.5)
+        serial.remove_tag()
+        time.sleep(1.0)
+
+
+def scenario_skips(rounds):
+    '''
+    Skips through songs with short clicks on the yellow button.
+    '''
+    import Buttons
+    serial.place_tag(TAGS[1])
+    time.sleep(1.5)
+    for i in range(rounds * 3):
+        GPIO.press(Buttons.YELLOW_BUTTON, 120)
+        time.sleep(0.4)
+    serial.remove_tag()
+    time.sleep(1.0)
+
+
+def scenario_tilts(rounds):
+    '''
+    Tilts the device to switch between pitch, brightness and volume
+    control. The MPU is read once a second.
+    '''
+    for i in range(rounds):
+        for x in [60, -60, 0]:
+            smbus.tilt(x, 0)
+            time.sleep(1.3)
+
+
+def scenario_track_ends(rounds):
+    '''
+    Lets tracks play to their end, so that the player continues gapless.
+    '''
+    serial.place_tag(TAGS[0])
+    time.sleep(rounds * 1.2 * SESSION["track_seconds"] / SESSION["speed"] + 1.0)
+    serial.remove_tag()
+    time.sleep(1.0)
+
+
+def _poll_web(polls, interval, results):
+    from EventManager import BridgeClient
+    from Library import LibraryAPI
+
+    api = LibraryAPI()
+    bridge = BridgeClient()
+    timings = {"web.all": [], "web.latency": []}
+    for i in range(polls):
+        started_at = time.monotonic()
+        api.playlist("all")
+        timings["web.all"].append(time.monotonic() - started_at)
+
+        started_at = time.monotonic()
+        bridge.call("latency_report")
+        timings["web.latency"].append(time.monotonic() - started_at)
+        time.sleep(interval)
+    results.put(timings)
+
+
+def scenario_web(rounds):
+    '''
+    Polls the library and latencies like the web interface does, while
+    changing the volume with the red and green buttons.
+    '''
+    import Buttons
+    import Latency
+
+    results = Queue()
+    poller = Process(target=_poll_web, args=(rounds * 40, 0.05, results))
+    poller.start()
+
+    serial.place_tag(TAGS[1])
+    time.sleep(1.5)
+    for i in range(rounds):
+        GPIO.press(Buttons.RED_BUTTON, 80)
+        time.sleep(0.3)
+        GPIO.press(Buttons.GREEN_BUTTON, 80)
+        time.sleep(0.3)
+    serial.remove_tag()
+
+    for stage, timings in results.get().items():
+        for seconds in timings:
+            Latency.record(stage, seconds)
+    poller.join()
+    time.sleep(1.0)
+
+
+SCENARIOS = {
+    "tag": scenario_tag,
+    "skips": scenario_skips,
+    "tilts": scenario_tilts,
+    "track_ends": scenario_track_ends,
+    "web": scenario_web,
+}
+
+
+def run_scenario(name, rounds):
+    import Latency
+
+    Latency.reset()
+    cpu_before = (cpu_seconds(os.getpid()), children_cpu_seconds())
+    started_at = time.monotonic()
+
+    SCENARIOS[name](rounds)
+
+    # Let LEDs and player catch up before taking stock
+    time.sleep(0.5)
+    return {
+        "seconds": time.monotonic() - started_at,
+        "cpu_seconds": cpu_seconds(os.getpid()) - cpu_before[0],
+        "children_cpu_seconds": children_cpu_seconds() - cpu_before[1],
+        "latency": Latency.report(),
+    }
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--track-seconds", type=float, default=3, help="length of the example songs")
+    parser.add_argument("--speed", type=float, default=1, help="play everything this many times faster")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show marta's log")
+    args = parser.parse_args()
+
+    names = args.scenarios.split(",")
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: " + name)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format="%(asctime)s.%(msecs)03d | %(name)s |    %(message)s", datefmt="%H:%M:%S")
+
+    SESSION.update(track_seconds=args.track_seconds, speed=args.speed)
+    base_dir = make_base_dir()
+    os.environ["MARTA"] = base_dir
+
+    import MPG123
+    from Marta import Marta
+
+    MPG123.MPG123Player._MPG123_COMMAND = [sys.executable, os.path.join(SIM_DIR, "fake_mpg123.py"), "--remote",
+                                           "--track-seconds", str(args.track_seconds), "--speed", str(args.speed)]
+
+    results = {}
+    # Keep stdout clean for the results, marta prints here and there
+    try:
+        with redirect_stdout(sys.stderr):
+            marta = Marta("pi")
+            loop_thread = Thread(target=marta.message_loop)
+            loop_thread.daemon = True
+            loop_thread.start()
+            # Let the library warm up
+            time.sleep(2)
+
+            for name in names:
+                results[name] = run_scenario(name, args.rounds)
+
+            marta.interrupt()
+            loop_thread.join()
+            marta.terminate()
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for name in names:
+        result = results[name]
+        print("{}: {:.1f} s, cpu {:.2f} s, children cpu {:.2f} s".format(
+            name, result["seconds"], result["cpu_seconds"], result["children_cpu_seconds"]))
+        for stage in SUMMARY_STAGES:
+            stats = result["latency"].get(stage)
+            if stats is None:
+                continue
+            print("    {:<28} n={:<5} mean {:8.2f} ms   p50 <= {:<6} ms   p99 <= {:<6} ms   max {:8.2f} ms".format(
+                stage, stats["count"], stats["mean_millis"], stats["p50_millis"], stats["p99_millis"],
+                stats["max_millis"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Generates a synthetic library: playlists of albums of tiny but valid MP3
+files, each with an ID3v2.3 tag and a few silent MPEG frames. An Info
+header in the first frame makes every song appear --seconds long.
+
+    python3 benchmarks/gen_library.py OUT_DIR [--playlists 200] [--albums-per-playlist 5]
+                                              [--songs-per-album 12] [--frames 2] [--state]
+
+With --state every playlist and album gets the state files older versions
+wrote, which the library takes over into its state journal on first use.
+"""
+from argparse import ArgumentParser
+from struct import pack
+import json
+import os
+import random
+import sys
+
+# MPEG 1 layer III, 128 kbit/s, 44.1 kHz, joint stereo: 417 byte frames
+# with 32 bytes of side info
+_FRAME_HEADER = b"\xff\xfb\x90\x64"
+_FRAME_SIZE = 417
+_SIDE_INFO_SIZE = 32
+_SAMPLES_PER_FRAME = 1152
+_SAMPLE_RATE = 44100
+
+_WORDS = ["little", "big", "red", "blue", "moon", "sun", "river", "forest", "song", "dream", "night", "morning",
+          "bear", "fox", "rabbit", "train", "boat", "garden", "winter", "summer", "star", "cloud", "dance", "lullaby"]
+
+
+def _syncsafe(value):
+    return bytes([(value >> 21) & 0x7f, (value >> 14) & 0x7f, (value >> 7) & 0x7f, value & 0x7f])
+
+
+def id3v2_tag(title, album, artist, track_num, track_count):
+    '''
+    >>> len(id3v2_tag("t", "a", "b", 1, 2))
+    60
+    '''
+    frames = b""
+    for frame_id, text in [("TIT2", title), ("TALB", album), ("TPE1", artist),
+                           ("TRCK", "{}/{}".format(track_num, track_count))]:
+        # Latin-1 text
+        data = b"\x00" + text.encode("latin-1", "replace")
+        frames += frame_id.encode("latin-1") + pack(">I", len(data)) + b"\x00\x00" + data
+    return b"ID3\x03\x00\x00" + _syncsafe(len(frames)) + frames
+
+
+def mpeg_frames(frames, seconds):
+    '''
+    An Info frame claiming the given length followed by silent frames.
+    '''
+    claimed_frames = max(frames, int(seconds * _SAMPLE_RATE / _SAMPLES_PER_FRAME))
+    info = b"Info" + pack(">II", 0x1, claimed_frames)
+    info_frame = _FRAME_HEADER + bytes(_SIDE_INFO_SIZE) + info
+    info_frame += bytes(_FRAME_SIZE - len(info_frame))
+    silent_frame = _FRAME_HEADER + bytes(_FRAME_SIZE - len(_FRAME_HEADER))
+    return info_frame + silent_frame * frames
+
+
+def tag_for(number):
+    '''
+    >>> tag_for(255)
+    'DEAD000000FF'
+    '''
+    return "DEAD{:08X}".format(number)
+
+
+def _title(rand, words):
+    return " ".join(rand.choice(_WORDS) for i in range(words)).capitalize()
+
+
+def generate(out_dir, playlists=200, albums_per_playlist=5, songs_per_album=12, frames=2, seconds=180,
+             state=False, seed=0):
+    '''
+    Writes the library to out_dir, which must not exist yet. Returns the
+    number of songs written.
+    '''
+    rand = random.Random(seed)
+    os.makedirs(os.path.join(out_dir, "system"))
+    audio = mpeg_frames(frames, seconds)
+    songs = 0
+
+    for p in range(playlists):
+        tag = tag_for(p)
+        playlist_path = os.path.join(out_dir, "{:04d} {} {}".format(p, _title(rand, 2), tag))
+        os.makedirs(playlist_path)
+        artist = _title(rand, 2)
+
+        for a in range(albums_per_playlist):
+            album = "{} {}".format(_title(rand, 3), a + 1)
+            album_path = os.path.join(playlist_path, album)
+            os.makedirs(album_path)
+
+            for s in range(songs_per_album):
+                title = _title(rand, 4)
+                file_name = "{:02d} {}.mp3".format(s + 1, title)
+                with open(os.path.join(album_path, file_name), "wb") as f:
+                    f.write(id3v2_tag(title, album, artist, s + 1, songs_per_album))
+                    f.write(audio)
+                songs += 1
+
+            if state:
+                with open(os.path.join(album_path, "album.json"), "w") as f:
+                    json.dump({"idx": rand.randrange(songs_per_album), "position": rand.randrange(100000)}, f)
+
+        if state:
+            with open(os.path.join(playlist_path, "playlist.json"), "w") as f:
+                json.dump({"idx": rand.randrange(albums_per_playlist), "repeat": False, "tag": tag}, f)
+
+    return songs
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("out_dir")
+    parser.add_argument("--playlists", type=int, default=200)
+    parser.add_argument("--albums-per-playlist", type=int, default=5)
+    parser.add_argument("--songs-per-album", type=int, default=12)
+    parser.add_argument("--frames", type=int, default=2, help="silent MPEG frames per song")
+    parser.add_argument("--seconds", type=float, default=180, help="length every song claims to have")
+    parser.add_argument("--state", action="store_true", help="write playlist.json and album.json files")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if os.path.exists(args.out_dir):
+        parser.error(args.out_dir + " already exists")
+
+    songs = generate(args.out_dir, args.playlists, args.albums_per_playlist, args.songs_per_album, args.frames,
+                     args.seconds, args.state, args.seed)
+    print("wrote {} songs to {}".format(songs, args.out_dir), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
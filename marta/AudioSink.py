@@ -0,0 +1,150 @@
+from logging import getLogger
+from time import monotonic as mtime, sleep
+import wave
+
+debug = getLogger(' AudioSink').debug
+
+
+class AudioSink(object):
+    """
+    Destination of the signed 16 bit little endian PCM data decoded by
+    LibMPG123Player.
+    """
+    SAMPLE_WIDTH = 2
+
+    def open(self, rate, channels):
+        raise NotImplementedError()
+
+    def write(self, data):
+        raise NotImplementedError()
+
+    def delay_in_frames(self):
+        '''
+        Number of frames written, but not played yet.
+        '''
+        return 0
+
+    def close(self):
+        pass
+
+
+class NullSink(AudioSink):
+    """
+    Throws all data away. In realtime mode, writes take as long as playing
+    the data would, so positions and track ends behave like on real hardware.
+    """
+    def __init__(self, realtime=True):
+        self._realtime = realtime
+        self._rate = None
+        self._frame_size = None
+        self._deadline = None
+        self.frames_written = 0
+
+    def open(self, rate, channels):
+        self._rate = rate
+        self._frame_size = channels * AudioSink.SAMPLE_WIDTH
+        self._deadline = None
+
+    def write(self, data):
+        frames = len(data) // self._frame_size
+        self.frames_written += frames
+        if not self._realtime:
+            return
+
+        now = mtime()
+        if self._deadline is None or self._deadline < now:
+            self._deadline = now
+        self._deadline += frames / float(self._rate)
+        sleep(max(0, self._deadline - now))
+
+    def close(self):
+        self._deadline = None
+
+
+class FileSink(AudioSink):
+    """
+    Writes everything played into a WAV file, reopened whenever the format
+    changes.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._wave = None
+        self._format = None
+
+    def open(self, rate, channels):
+        if self._wave is not None and self._format == (rate, channels):
+            return
+
+        self.close()
+        debug("writing {} Hz, {} channels to {}".format(rate, channels, self._path))
+        self._wave = wave.open(self._path, "wb")
+        self._wave.setnchannels(channels)
+        self._wave.setsampwidth(AudioSink.SAMPLE_WIDTH)
+        self._wave.setframerate(rate)
+        self._format = (rate, channels)
+
+    def write(self, data):
+        self._wave.writeframesraw(data)
+
+    def close(self):
+        if self._wave is not None:
+            self._wave.close()
+            self._wave = None
+
+
+class AlsaSink(AudioSink):
+    """
+    Plays through ALSA, needs pyalsaaudio.
+    """
+    _PERIOD_SIZE = 1024
+
+    def __init__(self, device="default"):
+        self._device = device
+        self._pcm = None
+        self._format = None
+        self._buffer_size = None
+
+    def open(self, rate, channels):
+        import alsaaudio
+
+        if self._pcm is not None and self._format == (rate, channels):
+            return
+
+        self.close()
+        debug("opening {} with {} Hz, {} channels".format(self._device, rate, channels))
+        self._pcm = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, device=self._device)
+        self._pcm.setchannels(channels)
+        self._pcm.setrate(rate)
+        self._pcm.setformat(alsaaudio.PCM_FORMAT_S16_LE)
+        self._pcm.setperiodsize(AlsaSink._PERIOD_SIZE)
+        self._format = (rate, channels)
+
+        # info() and avail() came with pyalsaaudio 0.10, older versions
+        # report no delay
+        try:
+            self._buffer_size = self._pcm.info()["buffer_size"]
+        except (AttributeError, KeyError, alsaaudio.ALSAAudioError):
+            self._buffer_size = None
+
+    def write(self, data):
+        self._pcm.write(data)
+
+    def delay_in_frames(self):
+        '''
+        Frames in the ALSA buffer, i.e. its size minus the room left in it.
+        '''
+        import alsaaudio
+
+        if self._pcm is None or self._buffer_size is None:
+            return 0
+
+        try:
+            return max(0, self._buffer_size - self._pcm.avail())
+        except alsaaudio.ALSAAudioError:
+            return 0
+
+    def close(self):
+        if self._pcm is not None:
+            self._pcm.close()
+            self._pcm = None
+            self._buffer_size = None
@@ -1,8 +1,10 @@
 from logging import getLogger
-from monotonic import monotonic as mtime
+from time import monotonic as mtime
 
 import RPi.GPIO as GPIO
 
+import Latency
+
 debug = getLogger('   Buttons').debug
 
 POWER_BUTTON = 17
@@ -37,6 +39,7 @@ def setup_gpio(button_callback):
     }
 
     def edge_detected_on_pin(event_pin):
+        detected_at = mtime()
         # debug("button event: " + BUTTONS_HUMAN_READABLE[pin])
         event_pin_is_pushed = False if GPIO.input(event_pin) == 1 else True
         event_pin_was_already_pushed = buttons_last_pushed_time[event_pin] is not 0
@@ -62,6 +65,7 @@ def setup_gpio(button_callback):
 
         debug("push event on pin " + str(event_pin) + ": " + str(diff))
         button_callback(event_pin, diff)
+        Latency.record("button", mtime() - detected_at)
 
     for pin in COLOR_BUTTONS + [POWER_BUTTON]:
         GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
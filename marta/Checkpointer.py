@@ -0,0 +1,185 @@
+from threading import Thread, Lock
+from queue import Queue, Empty
+from logging import getLogger
+import json
+import os
+
+debug = getLogger('Checkpoint').debug
+info = getLogger('Checkpoint').info
+
+
+class Checkpointer(object):
+    """
+    Records where playback is every few seconds, so that it can continue
+    close to that point after a power loss or crash.
+
+    Checkpoints are dicts with at least a "playlist" key. They are appended
+    to a log file as JSON lines, a checkpoint equal to the previous one is
+    skipped. Once the log got long, it is compacted to the latest
+    checkpoint of each playlist.
+
+    Playback state belongs to the message loop, so the checkpointer does
+    not take checkpoints itself. It asks for one every few seconds and the
+    loop hands it over with submit(), writing happens in the checkpointer's
+    thread.
+
+    A line torn by a power loss is cut off when the log is opened again,
+    so the next checkpoint starts on a line of its own.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "checkpoints.log")
+    >>> with open(path, "w") as f:
+    ...     _ = f.write('{"playlist": "a", "song": 1}\\n{"playlist": "b", "so')
+    >>> c = Checkpointer(path)
+    >>> c.record({"playlist": "b", "song": 2})
+    >>> c.terminate()
+    >>> sorted((p, cp["song"]) for p, cp in Checkpointer(path).recover().items())
+    [('a', 1), ('b', 2)]
+    """
+    _DEFAULT_INTERVAL = 10
+
+    # Appended checkpoints after which the log is compacted
+    _COMPACT_THRESHOLD = 256
+
+    def __init__(self, path, interval=_DEFAULT_INTERVAL):
+        self.path = path
+        self._interval = interval
+        self._lock = Lock()
+        self._request = None
+        self._submitted = Queue()
+        self._checkpoint_thread = None
+
+        self._latest, self._appended = self._read()
+        self._last = None
+        self._cut_torn_line()
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _cut_torn_line(self):
+        '''
+        Truncates the log after its last complete line.
+        '''
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        if data and not data.endswith(b"\n"):
+            debug("cutting off torn checkpoint")
+            os.truncate(self.path, data.rfind(b"\n") + 1)
+
+    def recover(self):
+        '''
+        Reads the log and returns the latest checkpoint of each playlist,
+        keyed by its "playlist" value. A line torn by a power loss is
+        ignored.
+        '''
+        return self._read()[0]
+
+    def _read(self):
+        '''
+        Like recover(), but also returns the number of complete lines in
+        the log, which counts towards compacting it.
+        '''
+        latest = {}
+        lines = 0
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    if line.endswith("\n"):
+                        lines += 1
+                    try:
+                        checkpoint = json.loads(line)
+                        latest[checkpoint["playlist"]] = checkpoint
+                    except (ValueError, KeyError, TypeError):
+                        debug("skipping broken checkpoint")
+        except FileNotFoundError:
+            pass
+
+        debug("recovered {} checkpoints from {} lines".format(len(latest), lines))
+        return latest, lines
+
+    def start(self, request):
+        '''
+        Calls request() every interval seconds, which is expected to answer
+        with submit() from the thread the playback state belongs to.
+        '''
+        self._request = request
+        if self._checkpoint_thread is not None:
+            return
+
+        self._checkpoint_thread = Thread(target=self._checkpoint_periodically)
+        self._checkpoint_thread.daemon = True
+        self._checkpoint_thread.start()
+
+    def submit(self, checkpoint):
+        '''
+        Hands a checkpoint over to be recorded in the checkpointer's thread.
+        '''
+        if checkpoint is not None:
+            self._submitted.put(checkpoint)
+
+    def _checkpoint_periodically(self):
+        while True:
+            try:
+                checkpoint = self._submitted.get(timeout=self._interval)
+            except Empty:
+                try:
+                    self._request()
+                except Exception as e:
+                    info("could not request checkpoint: " + repr(e))
+                continue
+
+            # terminate() wakes us up with None
+            if checkpoint is None:
+                break
+            self.record(checkpoint)
+
+    def record(self, checkpoint):
+        with self._lock:
+            if checkpoint == self._last or self._fd is None:
+                return
+
+            try:
+                os.write(self._fd, (json.dumps(checkpoint) + "\n").encode())
+                os.fdatasync(self._fd)
+            except OSError as e:
+                info("could not write checkpoint: " + str(e))
+                return
+
+            self._last = dict(checkpoint)
+            self._latest[checkpoint["playlist"]] = self._last
+            self._appended += 1
+
+            if self._appended > Checkpointer._COMPACT_THRESHOLD:
+                try:
+                    self._compact()
+                except OSError as e:
+                    info("could not compact checkpoints: " + str(e))
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for checkpoint in self._latest.values():
+                f.write(json.dumps(checkpoint) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self._appended = len(self._latest)
+        debug("compacted to {} checkpoints".format(self._appended))
+
+    def terminate(self):
+        debug("checkpointer terminating.")
+        if self._checkpoint_thread is not None:
+            # Checkpoints submitted before are still recorded
+            self._submitted.put(None)
+            self._checkpoint_thread.join()
+            self._checkpoint_thread = None
+
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
@@ -1,37 +1,291 @@
-from multiprocessing import Process, Queue
-from multiprocessing.managers import BaseManager
+from collections import deque
+from queue import Empty
+from threading import Thread, Lock, Event
+from logging import getLogger
+from tempfile import gettempdir
+from time import monotonic as mtime
+import json
+import os
+import socket
 
-class QueueManager(BaseManager):
-    queues = {}
+debug = getLogger('    Events').debug
+info = getLogger('    Events').info
 
-    @classmethod
-    def make_queue(cls, queue_name):
-        if queue_name in cls.queues:
-            return
+BRIDGE_SOCKET_FILE = "marta-events.sock"
+
+
+def default_bridge_path():
+    return os.path.join(gettempdir(), BRIDGE_SOCKET_FILE)
+
+
+class EventBus(object):
+    """
+    Delivers events from any thread of this process to a consumer thread.
+    Events are appended to a deque, which needs no lock of its own, and
+    nothing is pickled. Waking up the consumer still goes through the
+    Condition of a threading.Event. It can be used like a queue.Queue.
+
+    Every event is stamped with the monotonic time it was posted at, see
+    get_timed().
 
-        q = Queue()
-        cls.queues[queue_name] = q
+    Buses are looked up by name, see named(). Other processes post to them
+    through a BridgeServer.
+
+    >>> bus = EventBus()
+    >>> bus.empty()
+    True
+    >>> bus.put([2, 17, 300])
+    >>> bus.put([4, 1, 0])
+    >>> bus.get()
+    [2, 17, 300]
+    >>> bus.get(block=False)
+    [4, 1, 0]
+    >>> bus.get(timeout=0.01)
+    Traceback (most recent call last):
+    ...
+    _queue.Empty
+    """
+    _buses = {}
+    _buses_lock = Lock()
 
     @classmethod
-    def manager(cls, server=False):
-        mgr = cls(address=('', 50000), authkey=b'abracadabra')
-        print(cls.queues)
-
-        if server:
-            for queue_name in cls.queues:
-                cls.register('get_'+queue_name, callable=lambda: cls.queues[queue_name])
-            s = mgr.get_server()
-            return s.serve_forever()
-
-        for queue_name in cls.queues:
-            cls.register('get_'+queue_name)
-            #cls.queues[queue_name] = cls.get_
-        mgr.connect()
-        return mgr
-
-class Server(Process):
+    def named(cls, name):
+        '''
+        The bus of the given name, it is created on first use.
+        '''
+        with cls._buses_lock:
+            if name not in cls._buses:
+                cls._buses[name] = cls()
+            return cls._buses[name]
+
     def __init__(self):
-        super(Process, self).__init__()
+        self._events = deque()
+        self._ready = Event()
+
+    def put(self, event, block=True, timeout=None):
+        self._events.append((mtime(), event))
+        self._ready.set()
+
+    def put_nowait(self, event):
+        self.put(event)
+
+    def get(self, block=True, timeout=None):
+        return self.get_timed(block, timeout)[1]
+
+    def get_timed(self, block=True, timeout=None):
+        '''
+        Like get(), but returns (posted_at, event).
+        '''
+        deadline = None if timeout is None else mtime() + timeout
+
+        while True:
+            try:
+                return self._events.popleft()
+            except IndexError:
+                pass
+
+            if not block:
+                raise Empty
+
+            # Events put after clearing are caught by the check below,
+            # events put after that set the flag again
+            self._ready.clear()
+            if self._events:
+                continue
+
+            remaining = None if deadline is None else deadline - mtime()
+            if remaining is not None and remaining <= 0:
+                raise Empty
+            self._ready.wait(remaining)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def empty(self):
+        return not self._events
+
+    def qsize(self):
+        return len(self._events)
+
+
+class BridgeError(Exception):
+    pass
+
+
+class BridgeServer(object):
+    """
+    Lets other processes, i.e. the web process, post events and call
+    functions of this one via a Unix domain socket.
+
+    Messages are JSON objects, one per line:
+
+        {"to": name, "args": [...]}             calls the handler, no reply
+        {"to": name, "args": [...], "id": n}    replies {"id": n, "result": ...}
+                                                or {"id": n, "error": "..."}
+
+    Handlers run in the thread of the connection.
+    """
+    def __init__(self, path=None):
+        self.path = path if path is not None else default_bridge_path()
+        self._handlers = {}
+        self._stopped = Event()
+
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        self._socket.listen()
+
+        self._accept_thread = Thread(target=self._accept)
+        self._accept_thread.daemon = True
+        self._accept_thread.start()
+
+    def register(self, name, handler):
+        self._handlers[name] = handler
+
+    def register_bus(self, name):
+        '''
+        Allows posting events to the bus of the given name.
+        '''
+        self.register(name, EventBus.named(name).put)
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                break
+
+            connection_thread = Thread(target=self._serve, args=(connection,))
+            connection_thread.daemon = True
+            connection_thread.start()
+
+    def _serve(self, connection):
+        with connection, connection.makefile("rwb") as stream:
+            for line in stream:
+                reply = self._dispatch(line)
+                if reply is None:
+                    continue
+                try:
+                    stream.write(json.dumps(reply).encode("utf-8") + b"\n")
+                    stream.flush()
+                except OSError:
+                    break
+
+    def _dispatch(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            info("ignoring broken bridge message")
+            return None
+
+        try:
+            handler = self._handlers[message["to"]]
+            reply = {"result": handler(*message.get("args", []))}
+        except Exception as e:
+            info("bridge message to {} failed: {}".format(message.get("to"), repr(e)))
+            reply = {"error": repr(e)}
+
+        if "id" not in message:
+            return None
+        reply["id"] = message["id"]
+        return reply
+
+    def terminate(self):
+        debug("bridge server terminating.")
+        self._stopped.set()
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+        self._accept_thread.join()
+
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class BridgeClient(object):
+    """
+    The other end of a BridgeServer. Connects on first use and again after
+    the connection broke.
+    """
+    _DEFAULT_TIMEOUT = 2
+
+    def __init__(self, path=None, timeout=_DEFAULT_TIMEOUT):
+        self.path = path if path is not None else default_bridge_path()
+        self._timeout = timeout
+        self._lock = Lock()
+        self._connection = None
+        self._stream = None
+        self._next_id = 0
+
+    def _connect(self):
+        if self._connection is not None:
+            return
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self._timeout)
+        try:
+            connection.connect(self.path)
+        except OSError:
+            connection.close()
+            raise
+        self._connection = connection
+        self._stream = connection.makefile("rwb")
+
+    def _disconnect(self):
+        if self._connection is not None:
+            self._stream.close()
+            self._connection.close()
+        self._connection = None
+        self._stream = None
+
+    def _send(self, message):
+        self._connect()
+        self._stream.write(json.dumps(message).encode("utf-8") + b"\n")
+        self._stream.flush()
+
+    def post(self, name, *args):
+        '''
+        Calls the handler registered as name on the other end, e.g. puts
+        an event into a bus, without waiting for it.
+        '''
+        with self._lock:
+            try:
+                self._send({"to": name, "args": args})
+            except OSError:
+                self._disconnect()
+                raise
+
+    def call(self, name, *args):
+        '''
+        Calls the handler registered as name on the other end and returns
+        its result. Raises BridgeError if it failed and OSError if there
+        was no reply in time.
+        '''
+        with self._lock:
+            self._next_id += 1
+            try:
+                self._send({"to": name, "args": args, "id": self._next_id})
+                line = self._stream.readline()
+                if not line:
+                    raise ConnectionError("bridge closed")
+                reply = json.loads(line)
+            except OSError:
+                # A late reply must not be taken for the next one
+                self._disconnect()
+                raise
+
+        if "error" in reply:
+            raise BridgeError(reply["error"])
+        return reply["result"]
 
-    def run(self):
-        QueueManager.manager(server=True)
+    def close(self):
+        with self._lock:
+            self._disconnect()
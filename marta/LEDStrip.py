@@ -1,8 +1,12 @@
+from array import array
 from queue import Empty
 
 from neopixel import *
 from multiprocessing import Queue, Process
 from logging import getLogger
+from time import monotonic as mtime
+
+from EventManager import BridgeClient
 
 debug = getLogger('  LEDStrip').debug
 
@@ -22,6 +26,7 @@ class LEDStrip(object):
     _LED_INVERT = False  # True to invert the signal (when using NPN transistor level shift)
     _LED_CHANNEL = 0  # set to '1' for GPIOs 13, 19, 41, 45 or 53
     _LED_STRIP = ws.WS2811_STRIP_GRB  # Strip type and colour ordering
+    _FRAME_SECONDS = 0.02  # At most one render per frame, i.e. 50 frames per second
 
     _EVENT_TERMINATE = 0
     _EVENT_RAINBOW_DEMO = 1
@@ -57,15 +62,33 @@ class LEDStrip(object):
                                         LEDStrip._LED_DMA, LEDStrip._LED_INVERT, LEDStrip._LED_BRIGHTNESS,
                                         LEDStrip._LED_CHANNEL, LEDStrip._LED_STRIP)
         self._strip.begin()
+        self._channel = self._strip.getPixels().channel
         self._message_queue = Queue()
 
+        # Animations compose frames in here, _show() pushes what differs
+        # from the frame shown before
+        self._frame = array('I', [0]) * LEDStrip._LED_COUNT
+        self._shown = array('I', [0]) * LEDStrip._LED_COUNT
+        self._next_frame_at = 0
+        self._wheel_colors = [LEDStrip._wheel(pos) for pos in range(256)]
+
+        # When the animation being shown was requested, until it shows up
+        self._requested_at = None
+        self._bridge = None
+
         self._led_controller_process = Process(target=self._control_leds, daemon=True)
         self._led_controller_process.start()
 
     def _control_leds(self):
+        # Latencies are kept by the main process
+        self._bridge = BridgeClient()
+
         msg = None
         while True:
-            msg = self._message_queue.get(block=True, timeout=None) if msg is None else msg
+            if msg is None:
+                self._requested_at, msg = self._message_queue.get(block=True, timeout=None)
+            else:
+                self._requested_at, msg = msg
 
             event = msg[0]
 
@@ -112,31 +135,59 @@ class LEDStrip(object):
         except Empty:
             pass
 
+    def _put(self, msg):
+        self._message_queue.put((mtime(), msg))
+
+    def _show(self):
+        # Waiting for the next frame can be interrupted like any other sleep
+        wait = self._next_frame_at - mtime()
+        if wait > 0:
+            self._sleep(wait)
+
+        frame = self._frame
+        shown = self._shown
+        if frame != shown:
+            # Bypasses the list emulation of neopixel, one call per pixel
+            # changed is the closest the binding has to a bulk update
+            for i in range(LEDStrip._LED_COUNT):
+                if frame[i] != shown[i]:
+                    ws.ws2811_led_set(self._channel, i, frame[i])
+            shown[:] = frame
+            self._strip.show()
+        self._next_frame_at = mtime() + LEDStrip._FRAME_SECONDS
+
+        if self._requested_at is not None:
+            try:
+                self._bridge.post("latency", "led", mtime() - self._requested_at)
+            except OSError:
+                pass
+            self._requested_at = None
+
     def startup(self):
-        self._message_queue.put([LEDStrip._EVENT_STARTUP])
+        self._put([LEDStrip._EVENT_STARTUP])
 
     def shutdown(self):
-        self._message_queue.put([LEDStrip._EVENT_SHUTDOWN])
+        self._put([LEDStrip._EVENT_SHUTDOWN])
 
     def rainbow_demo(self):
-        self._message_queue.put([LEDStrip._EVENT_RAINBOW_DEMO])
+        self._put([LEDStrip._EVENT_RAINBOW_DEMO])
 
     def volume(self, volume):
-        self._message_queue.put([LEDStrip._EVENT_VOLUME, volume])
+        self._put([LEDStrip._EVENT_VOLUME, volume])
 
     def song(self, i, n, forward=True):
-        self._message_queue.put([LEDStrip._EVENT_SONG, i, n, forward])
+        self._put([LEDStrip._EVENT_SONG, i, n, forward])
 
     def fade_up_and_down(self, color):
-        self._message_queue.put([LEDStrip._EVENT_FADE_UP_AND_DOWN, color])
+        self._put([LEDStrip._EVENT_FADE_UP_AND_DOWN, color])
 
     def clear(self):
-        self._message_queue.put([LEDStrip._EVENT_CLEAR])
+        self._put([LEDStrip._EVENT_CLEAR])
 
     def _clear_all(self):
         for i in range(LEDStrip._LED_COUNT):
-            self._strip.setPixelColor(i, 0)
-        self._strip.show()
+            self._frame[i] = 0
+        self._show()
 
     def _fade_up(self, leds, colors):
         rgbs = []
@@ -145,24 +196,24 @@ class LEDStrip(object):
 
         for c in range(11):
             for i in range(len(leds)):
-                self._strip.setPixelColor(leds[i], Color(int(round(rgbs[i][0] * 0.1 * c)),
-                                                         int(round(rgbs[i][1] * 0.1 * c)),
-                                                         int(round(rgbs[i][2] * 0.1 * c))))
-            self._strip.show()
+                self._frame[leds[i]] = Color(int(round(rgbs[i][0] * 0.1 * c)),
+                                             int(round(rgbs[i][1] * 0.1 * c)),
+                                             int(round(rgbs[i][2] * 0.1 * c)))
+            self._show()
             self._sleep(0.05)
 
     def _fade_down(self, leds):
         initial_rgbs = []
         for led in leds:
-            color = self._strip.getPixelColor(led)
+            color = self._frame[led]
             initial_rgbs.append(((color >> 16) & 255, (color >> 8) & 255, color & 255))
 
         for c in range(-9, 1):
             for i in range(len(leds)):
-                self._strip.setPixelColor(leds[i], Color(int(round(initial_rgbs[i][0] * -0.1 * c)),
-                                                         int(round(initial_rgbs[i][1] * -0.1 * c)),
-                                                         int(round(initial_rgbs[i][2] * -0.1 * c))))
-            self._strip.show()
+                self._frame[leds[i]] = Color(int(round(initial_rgbs[i][0] * -0.1 * c)),
+                                             int(round(initial_rgbs[i][1] * -0.1 * c)),
+                                             int(round(initial_rgbs[i][2] * -0.1 * c)))
+            self._show()
             self._sleep(0.05)
 
     def _fade_up_and_down(self, leds, colors):
@@ -173,8 +224,8 @@ class LEDStrip(object):
     def _walk_around(self, leds, color, timeout=0.03):
         color_is_fun = callable(color)
         for i in leds:
-            self._strip.setPixelColor(i, color(i) if color_is_fun else color)
-            self._strip.show()
+            self._frame[i] = color(i) if color_is_fun else color
+            self._show()
             self._sleep(timeout)
 
     @staticmethod
@@ -239,10 +290,8 @@ class LEDStrip(object):
         while True:
             for j in range(256):
                 for i in range(LEDStrip._LED_COUNT):
-                    self._strip.setPixelColor(i, LEDStrip._wheel((int(i * 256 / LEDStrip._LED_COUNT) + j) & 255))
-                    self._strip.show()
-
-                self._sleep(0.02)
+                    self._frame[i] = self._wheel_colors[(int(i * 256 / LEDStrip._LED_COUNT) + j) & 255]
+                self._show()
 
     def terminate(self):
         debug("led strip terminating.")
@@ -250,7 +299,7 @@ class LEDStrip(object):
             debug("already terminated")
             return
 
-        self._message_queue.put([LEDStrip._EVENT_TERMINATE])
+        self._put([LEDStrip._EVENT_TERMINATE])
         self._led_controller_process.join()
 
         for i in range(LEDStrip._LED_COUNT):
@@ -0,0 +1,130 @@
+from threading import Lock
+from logging import getLogger
+from time import monotonic as mtime
+
+info = getLogger('   Latency').info
+
+# Upper bounds of the histogram buckets in milliseconds, the last one
+# catches everything slower
+BUCKET_BOUNDS_IN_MILLIS = [0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf")]
+
+
+class Histogram(object):
+    """
+    Latencies of one stage, in buckets growing roughly exponentially.
+
+    >>> h = Histogram()
+    >>> for millis in [0.3, 0.4, 3, 4, 40]:
+    ...     h.record(millis / 1000.0)
+    >>> h.count, h.percentile(50), h.percentile(90), round(h.max_in_millis, 1)
+    (5, 5, 50, 40.0)
+    """
+    def __init__(self):
+        self.counts = [0] * len(BUCKET_BOUNDS_IN_MILLIS)
+        self.count = 0
+        self.sum_in_millis = 0.0
+        self.max_in_millis = 0.0
+
+    def record(self, seconds):
+        millis = seconds * 1000
+        bucket = 0
+        while millis > BUCKET_BOUNDS_IN_MILLIS[bucket]:
+            bucket += 1
+
+        self.counts[bucket] += 1
+        self.count += 1
+        self.sum_in_millis += millis
+        self.max_in_millis = max(self.max_in_millis, millis)
+
+    def percentile(self, percent):
+        '''
+        Upper bound of the bucket the given percentile falls into.
+        '''
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS_IN_MILLIS, self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return bound
+        return None
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_millis": self.sum_in_millis / self.count if self.count else None,
+            "max_millis": self.max_in_millis,
+            "p50_millis": self.percentile(50),
+            "p90_millis": self.percentile(90),
+            "p99_millis": self.percentile(99),
+            "buckets": dict((str(bound), count) for bound, count in zip(BUCKET_BOUNDS_IN_MILLIS, self.counts)
+                            if count)
+        }
+
+
+# Stages along the path from an input to audible output:
+#   button, rfid:     edge or tag frame detected until its event was posted
+#   queue:            event posted until the message loop took it
+#   handler.<EVENT>:  handling the event in the message loop
+#   player.<COMMAND>: command written until mpg123 answered it
+#   input_to_audio:   event posted until mpg123 confirmed playing
+#   led:              animation requested until it was first shown
+_histograms = {}
+_lock = Lock()
+
+# When the event currently handled by the message loop was posted
+_event_posted_at = None
+
+
+def record(stage, seconds):
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.record(seconds)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def event_started(posted_at):
+    global _event_posted_at
+    _event_posted_at = posted_at
+
+
+def event_finished():
+    global _event_posted_at
+    _event_posted_at = None
+
+
+def record_since_event(stage):
+    '''
+    Records the time since the event being handled was posted, if any.
+    '''
+    posted_at = _event_posted_at
+    if posted_at is not None:
+        record(stage, mtime() - posted_at)
+
+
+def report():
+    '''
+    All histograms as dicts, keyed by stage.
+    '''
+    with _lock:
+        return dict((stage, histogram.to_dict()) for stage, histogram in _histograms.items())
+
+
+def format_report():
+    lines = ["{:<28} {:>7} {:>9} {:>9} {:>9} {:>9}".format("stage", "count", "mean ms", "p50 ms", "p99 ms",
+                                                              "max ms")]
+    for stage, stats in sorted(report().items()):
+        lines.append("{:<28} {:>7} {:>9.2f} {:>9} {:>9} {:>9.2f}".format(
+            stage, stats["count"], stats["mean_millis"], stats["p50_millis"], stats["p99_millis"],
+            stats["max_millis"]))
+    return "\n".join(lines)
+
+
+def log_report():
+    for line in format_report().splitlines():
+        info(line)
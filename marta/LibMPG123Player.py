@@ -0,0 +1,470 @@
+from ctypes import CDLL, c_void_p, c_char_p, c_int, c_long, c_size_t, c_double, byref, create_string_buffer, POINTER
+from ctypes.util import find_library
+from threading import Thread, Condition
+from logging import getLogger
+
+from Player import Player
+from AudioSink import AlsaSink
+
+debug = getLogger('LibMPG123').debug
+info = getLogger('LibMPG123').info
+
+
+class DecoderError(Exception):
+    pass
+
+
+class Decoder(object):
+    """
+    Minimal ctypes binding of libmpg123, decoding MP3 files to signed 16 bit
+    PCM at their native sample rate.
+    """
+    MPG123_OK = 0
+    MPG123_ERR = -1
+    MPG123_NEW_FORMAT = -11
+    MPG123_DONE = -12
+
+    MPG123_MONO = 1
+    MPG123_STEREO = 2
+    MPG123_ENC_SIGNED_16 = 0xd0
+
+    SEEK_SET = 0
+
+    _RATES = [8000, 11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000]
+
+    _lib = None
+
+    @staticmethod
+    def _load_library():
+        if Decoder._lib is not None:
+            return Decoder._lib
+
+        lib = CDLL(find_library("mpg123") or "libmpg123.so.0")
+
+        lib.mpg123_new.restype = c_void_p
+        lib.mpg123_new.argtypes = [c_char_p, POINTER(c_int)]
+        lib.mpg123_delete.argtypes = [c_void_p]
+        lib.mpg123_format_none.argtypes = [c_void_p]
+        lib.mpg123_format.argtypes = [c_void_p, c_long, c_int, c_int]
+        lib.mpg123_open.argtypes = [c_void_p, c_char_p]
+        lib.mpg123_close.argtypes = [c_void_p]
+        lib.mpg123_getformat.argtypes = [c_void_p, POINTER(c_long), POINTER(c_int), POINTER(c_int)]
+        lib.mpg123_read.argtypes = [c_void_p, c_void_p, c_size_t, POINTER(c_size_t)]
+        lib.mpg123_seek.restype = c_long
+        lib.mpg123_seek.argtypes = [c_void_p, c_long, c_int]
+        lib.mpg123_tell.restype = c_long
+        lib.mpg123_tell.argtypes = [c_void_p]
+        lib.mpg123_length.restype = c_long
+        lib.mpg123_length.argtypes = [c_void_p]
+        lib.mpg123_volume.argtypes = [c_void_p, c_double]
+        lib.mpg123_strerror.restype = c_char_p
+        lib.mpg123_strerror.argtypes = [c_void_p]
+        lib.mpg123_plain_strerror.restype = c_char_p
+        lib.mpg123_plain_strerror.argtypes = [c_int]
+
+        lib.mpg123_init()
+        Decoder._lib = lib
+        return lib
+
+    def __init__(self):
+        self._lib = Decoder._load_library()
+
+        error = c_int()
+        self._handle = self._lib.mpg123_new(None, byref(error))
+        if not self._handle:
+            raise DecoderError(self._lib.mpg123_plain_strerror(error.value).decode())
+
+        # Only ask for 16 bit output, whatever the sample rate
+        self._lib.mpg123_format_none(self._handle)
+        for rate in Decoder._RATES:
+            self._lib.mpg123_format(self._handle, rate, Decoder.MPG123_MONO | Decoder.MPG123_STEREO,
+                                    Decoder.MPG123_ENC_SIGNED_16)
+
+    def _check(self, result):
+        if result != Decoder.MPG123_OK:
+            raise DecoderError(self._lib.mpg123_strerror(self._handle).decode())
+
+    def open(self, path):
+        self._check(self._lib.mpg123_open(self._handle, path.encode()))
+
+    def close(self):
+        self._lib.mpg123_close(self._handle)
+
+    def get_format(self):
+        '''
+        Returns (sample_rate, channels) of the opened file.
+        '''
+        rate = c_long()
+        channels = c_int()
+        encoding = c_int()
+        self._check(self._lib.mpg123_getformat(self._handle, byref(rate), byref(channels), byref(encoding)))
+        return rate.value, channels.value
+
+    def read(self, buffer):
+        '''
+        Decodes into the given ctypes buffer, returns (data, status) where
+        status is one of MPG123_OK, MPG123_NEW_FORMAT and MPG123_DONE.
+        '''
+        done = c_size_t()
+        status = self._lib.mpg123_read(self._handle, buffer, len(buffer), byref(done))
+        if status not in (Decoder.MPG123_OK, Decoder.MPG123_NEW_FORMAT, Decoder.MPG123_DONE):
+            raise DecoderError(self._lib.mpg123_strerror(self._handle).decode())
+        return buffer.raw[:done.value], status
+
+    def seek(self, sample):
+        result = self._lib.mpg123_seek(self._handle, sample, Decoder.SEEK_SET)
+        if result < 0:
+            raise DecoderError(self._lib.mpg123_strerror(self._handle).decode())
+        return result
+
+    def tell(self):
+        return max(0, self._lib.mpg123_tell(self._handle))
+
+    def length(self):
+        '''
+        Length in samples, might be an estimate, None if unknown.
+        '''
+        length = self._lib.mpg123_length(self._handle)
+        return length if length > 0 else None
+
+    def set_volume(self, factor):
+        self._lib.mpg123_volume(self._handle, factor)
+
+    def delete(self):
+        if self._handle:
+            self._lib.mpg123_delete(self._handle)
+            self._handle = None
+
+
+class LibMPG123Player(Player):
+    """
+    Player backend decoding in process via libmpg123 and writing the PCM
+    data to an AudioSink. Positions are taken from the decoder, corrected
+    by what is still buffered in the sink.
+
+    Pitch works like in mpg123 by playing the samples at a different rate,
+    so speed changes as well.
+    """
+    _DEFAULT_VOLUME = 50
+    _DEFAULT_PITCH = 100
+
+    # 1152 stereo samples of 16 bit, one MPEG frame
+    _BUFFER_SIZE = 1152 * 2 * 2
+
+    def __init__(self, on_stop_callback, on_error_callback, volume=_DEFAULT_VOLUME, pitch=_DEFAULT_PITCH, gapless=False,
+                 sink=None):
+        '''
+        See MPG123Player for the callbacks and gapless mode.
+        sink: where to play to, ALSA's default device if None
+        '''
+        self._condition = Condition()
+        self._current_state = Player.STATE_STOPPED
+
+        self._decoder = Decoder()
+        self._buffer = create_string_buffer(LibMPG123Player._BUFFER_SIZE)
+        self._sink = sink if sink is not None else AlsaSink()
+        # Sample rate and channels the sink has to be opened with, set
+        # whenever format or pitch change and applied by the decode thread
+        self._sink_format = None
+        self._sink_outdated = False
+
+        self._sample_rate = None
+        self._track_length_in_samples = 0
+        self._track_length_in_millis = 0
+
+        self._volume = None
+        self._gain = 1.0
+        self._pitch = LibMPG123Player._DEFAULT_PITCH
+
+        self._current_file = None
+        self._gapless = gapless
+        self._queued_file = None
+        self._queued_length_in_millis = None
+
+        self._on_stop_callback = on_stop_callback
+        self._on_error_callback = on_error_callback
+
+        self.set_volume(volume)
+        self.set_pitch(pitch)
+
+        self._decode_thread = Thread(target=self._decode)
+        self._decode_thread.daemon = True
+        self._decode_thread.start()
+        debug("libmpg123 initialized")
+
+    def _open_file(self, file_name, length_in_millis):
+        '''
+        Opens a file in the decoder, must be called with the condition held.
+        '''
+        self._decoder.close()
+        self._current_file = None
+        self._decoder.open(file_name)
+        self._current_file = file_name
+
+        self._sample_rate, channels = self._decoder.get_format()
+        self._sink_format = (self._sample_rate, channels)
+        self._sink_outdated = True
+
+        length = self._decoder.length()
+        if length is not None:
+            self._track_length_in_samples = length
+            self._track_length_in_millis = length * 1000 // self._sample_rate
+        elif length_in_millis is not None:
+            self._track_length_in_millis = length_in_millis
+            self._track_length_in_samples = length_in_millis * self._sample_rate // 1000
+        else:
+            self._track_length_in_millis = 0
+            self._track_length_in_samples = 0
+
+    def _decode(self):
+        while True:
+            with self._condition:
+                while self._current_state in (Player.STATE_STOPPED, Player.STATE_PAUSED):
+                    self._condition.wait()
+                if self._current_state == Player.STATE_TERMINATED:
+                    break
+
+                try:
+                    data, status = self._decoder.read(self._buffer)
+                except DecoderError as e:
+                    info("decoding {} failed: {}".format(self._current_file, e))
+                    status = Decoder.MPG123_DONE
+                    data = None
+
+                next_file = None
+                if status == Decoder.MPG123_NEW_FORMAT:
+                    self._sample_rate, channels = self._decoder.get_format()
+                    self._sink_format = (self._sample_rate, channels)
+                    self._sink_outdated = True
+                elif status == Decoder.MPG123_DONE:
+                    next_file = self._continue_with_queued_file()
+                    if next_file is None:
+                        self._decoder.close()
+                        self._current_file = None
+                        self._current_state = Player.STATE_STOPPED
+
+                sink_format = None
+                if self._sink_outdated:
+                    rate, channels = self._sink_format
+                    sink_format = (rate * self._pitch // 100, channels)
+                    self._sink_outdated = False
+
+            # The sink blocks while its buffer is full, so it is written
+            # without holding the condition
+            try:
+                if sink_format is not None:
+                    self._sink.open(*sink_format)
+                if data:
+                    self._sink.write(data)
+            except Exception as e:
+                info("sink failed: " + repr(e))
+                with self._condition:
+                    self._current_state = Player.STATE_TERMINATED
+                if self._on_error_callback is not None:
+                    self._on_error_callback()
+                break
+
+            if status == Decoder.MPG123_DONE:
+                self._on_stop_callback(next_file)
+
+    def _continue_with_queued_file(self):
+        if not self._gapless or self._queued_file is None:
+            return None
+
+        next_file = self._queued_file
+        self._queued_file = None
+        try:
+            self._open_file(next_file, self._queued_length_in_millis)
+        except DecoderError as e:
+            info("could not continue with {}: {}".format(next_file, e))
+            return None
+
+        debug("continuing with " + next_file)
+        return next_file
+
+    def is_track_playing(self):
+        return self._current_state == Player.STATE_PLAYING
+
+    def get_volume(self):
+        return self._volume
+
+    def set_volume(self, volume):
+        if volume < Player.MIN_VOLUME:
+            raise ValueError("Out of bounds!")
+        elif volume > Player.MAX_VOLUME:
+            raise ValueError("Out of bounds!")
+
+        with self._condition:
+            self._volume = volume
+            self._apply_volume()
+
+    def set_gain(self, gain_in_db):
+        with self._condition:
+            self._gain = 10 ** (gain_in_db / 20.0)
+            if self._volume is not None:
+                self._apply_volume()
+
+    def _apply_volume(self):
+        self._decoder.set_volume(min(1.0, self._volume * self._gain / Player.MAX_VOLUME))
+
+    def get_pitch(self):
+        return self._pitch
+
+    def set_pitch(self, pitch):
+        if pitch < Player.MIN_PITCH:
+            raise ValueError("Out of bounds!")
+        elif pitch > Player.MAX_PITCH:
+            raise ValueError("Out of bounds!")
+
+        with self._condition:
+            if pitch == self._pitch:
+                return
+            self._pitch = pitch
+            if self._sink_format is not None:
+                self._sink_outdated = True
+
+    def _get_position_in_samples(self):
+        with self._condition:
+            if self._current_file is None:
+                return 0
+            position = self._decoder.tell() - self._sink.delay_in_frames()
+        return max(0, position)
+
+    def get_position_in_millis(self):
+        if not self._sample_rate:
+            return 0
+        return self._get_position_in_samples() * 1000 // self._sample_rate
+
+    def set_position_in_millis(self, position_in_millis):
+        with self._condition:
+            if self._current_file is None or not self._sample_rate:
+                return
+            self._decoder.seek(int(position_in_millis) * self._sample_rate // 1000)
+
+    def get_track_length_in_millis(self):
+        return self._track_length_in_millis
+
+    def queue_track(self, file_name, length_in_millis=None, sample_rate=None):
+        if not self._gapless:
+            return
+
+        with self._condition:
+            debug("queued " + str(file_name))
+            self._queued_length_in_millis = length_in_millis
+            self._queued_file = file_name
+
+    def load_track_from_file(self, file_name, length_in_millis=None, sample_rate=None):
+        '''
+        Loads a track, paused at its beginning. The decoder knows length and
+        sample rate itself, length_in_millis is used if it does not.
+        '''
+        with self._condition:
+            self._queued_file = None
+
+            if file_name == self._current_file:
+                debug("file already loaded")
+                return
+
+            try:
+                self._open_file(file_name, length_in_millis)
+            except DecoderError as e:
+                info("could not load {}: {}".format(file_name, e))
+                self._current_state = Player.STATE_STOPPED
+                return False
+
+            self._current_state = Player.STATE_PAUSED
+        return True
+
+    def toggle(self):
+        with self._condition:
+            if self._current_state == Player.STATE_PLAYING:
+                self._current_state = Player.STATE_PAUSED
+            elif self._current_state == Player.STATE_PAUSED:
+                self._current_state = Player.STATE_PLAYING
+                self._condition.notify_all()
+
+    def play_track(self):
+        if self._current_state == Player.STATE_PLAYING:
+            debug("already playing")
+            return
+
+        self.toggle()
+
+    def pause_track(self):
+        if self._current_state == Player.STATE_PAUSED:
+            debug("already paused")
+            return
+
+        self.toggle()
+
+    def stop_track(self):
+        with self._condition:
+            self._queued_file = None
+
+            if self._current_state in (Player.STATE_STOPPED, Player.STATE_TERMINATED):
+                debug("already stopped")
+                return
+
+            self._decoder.close()
+            self._current_file = None
+            self._current_state = Player.STATE_STOPPED
+
+        self._on_stop_callback(None)
+
+    def terminate(self):
+        debug("libmpg123 player terminating...")
+        with self._condition:
+            if self._decode_thread is None:
+                debug("already terminated")
+                return
+
+            self._on_error_callback = None
+            self._current_state = Player.STATE_TERMINATED
+            self._condition.notify_all()
+
+        self._decode_thread.join()
+        self._decode_thread = None
+
+        self._sink.close()
+        self._decoder.close()
+        self._decoder.delete()
+        debug("ok, finished.")
+
+
+def main():
+    from sys import argv
+    from time import sleep
+    from SetupLogging import setup_stdout_logging
+    from AudioSink import NullSink, FileSink
+    setup_stdout_logging()
+
+    # Plays to a WAV file or, with "-", headless in real time
+    if len(argv) < 3:
+        debug("usage: LibMPG123Player.py <mp3 file> <wav file or ->")
+        return
+
+    sink = NullSink() if argv[2] == "-" else FileSink(argv[2])
+    player = LibMPG123Player(lambda next_file: debug("song stopped, next: " + str(next_file)), lambda: debug("error"),
+                             50, sink=sink)
+
+    if not player.load_track_from_file(argv[1]):
+        debug("file could not be loaded")
+        return
+
+    debug("length: " + str(player.get_track_length_in_millis()) + " ms")
+    player.play_track()
+
+    try:
+        while player.is_track_playing():
+            sleep(.5)
+            debug("position: " + str(player.get_position_in_millis()) + " ms")
+    except:
+        pass
+
+    player.terminate()
+
+    debug("good bye")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,24 @@ from os import listdir
 from os.path import isdir
 from logging import getLogger, DEBUG, INFO
 from re import compile, match
-from Util import sorted_aphanumeric
+from bisect import bisect_right
+from Util import sorted_aphanumeric, lower_thread_priority
 from multiprocessing import Queue
-from threading import Thread
-from EventManager import QueueManager
+from threading import Thread, RLock, Event
+from concurrent.futures import ThreadPoolExecutor
+from EventManager import BridgeClient
+from LibraryIndex import LibraryIndex
+from Loudness import LoudnessAnalyzer
+from StateStore import StateStore
+from Checkpointer import Checkpointer
+from LibrarySnapshot import SnapshotPublisher, SnapshotReader, default_path as default_snapshot_path
+from MP3Info import read_tags, read_stream_info
+from sys import intern
 import hashlib
+import json
 #from watchdog.observers import Observer
 #from watchdog.events import FileSystemEventHandler
-import eyed3
 import os
-import json
 
 debug = getLogger('   Library').debug
 info = getLogger('   Library').info
@@ -19,6 +27,12 @@ error = getLogger('   Library').error
 
 ALBUM_INDICATOR_FILE = ".albumindicator"
 
+INDEX_FILE = ".library.db"
+
+STATE_FILE = ".state.json"
+
+CHECKPOINT_FILE = ".checkpoints.log"
+
 TAG_IN_PATH_REGEX = compile("^.*([0-9A-F]{12})$")
 
 """
@@ -31,7 +45,17 @@ class LibraryFSChangeHandler(FileSystemEventHandler):
         self.library.prepare()
 """
 
+def _intern(text):
+    '''
+    Paths, album and artist names repeat a lot across songs and the index,
+    keep only one copy of each.
+    '''
+    return intern(text) if isinstance(text, str) else text
+
+
 class Song(object):
+    # Large libraries hold tens of thousands of these
+    __slots__ = ("path", "title", "album", "artist", "track_num", "mtime", "size", "length_millis", "sample_rate")
 
     @classmethod
     def from_file(cls, path):
@@ -50,29 +74,68 @@ class Song(object):
         >>> s.track_num
         1
         """
-        mp3 = eyed3.load(path)
-
-        if mp3 is None:
-            raise ValueError("File {} does not seem to be a valid MP3")
+        tags = read_tags(path)
+        if tags is None:
+            tags = cls._read_tags_with_eyed3(path)
 
         self = cls(path)
-        self.current_position = None
-        self.mtime = os.path.getmtime(path)
+        stat = os.stat(path)
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
 
-        if mp3.tag is None:
+        stream_info = read_stream_info(path)
+        if stream_info is not None:
+            (self.length_millis, self.sample_rate) = stream_info
+
+        if not tags:
             # Fallback if no ID3 available
             (dirname, self.title) = os.path.split(path)
-            (dirname, self.album) = os.path.split(dirname)
+            (dirname, album) = os.path.split(dirname)
+            self.album = _intern(album)
             self.artist = ""
             self.track_num = None
         else:
-            self.title = mp3.tag.title
-            self.artist = mp3.tag.artist
-            self.album = mp3.tag.album
-            self.track_num = mp3.tag.track_num[0]
+            self.title = tags.get("title")
+            self.artist = _intern(tags.get("artist"))
+            self.album = _intern(tags.get("album"))
+            self.track_num = tags.get("track_num")
 
         return self
 
+    @staticmethod
+    def _read_tags_with_eyed3(path):
+        '''
+        Fallback for files MP3Info.read_tags() does not understand. eyed3 is
+        slow to import, so only do that when really needed.
+        '''
+        import eyed3
+
+        mp3 = eyed3.load(path)
+
+        if mp3 is None:
+            raise ValueError("File {} does not seem to be a valid MP3".format(path))
+
+        if mp3.tag is None:
+            return {}
+
+        return {
+            "title": mp3.tag.title,
+            "artist": mp3.tag.artist,
+            "album": mp3.tag.album,
+            "track_num": mp3.tag.track_num[0]
+            }
+
+    @classmethod
+    def from_file_or_none(cls, path):
+        '''
+        Like from_file(), but returns None for invalid files. Handy for
+        mapping over a bunch of files with an executor.
+        '''
+        try:
+            return cls.from_file(path)
+        except ValueError:
+            return None
+
     @classmethod
     def from_dict(cls, d):
         """
@@ -82,13 +145,17 @@ class Song(object):
         """
         return cls(**d)
 
-    def __init__(self, path, title=None, album=None, artist=None, track_num=None, mtime=None):
-        self.path = path
+    def __init__(self, path, title=None, album=None, artist=None, track_num=None, mtime=None, size=None,
+                 length_millis=None, sample_rate=None):
+        self.path = _intern(path)
         self.title = title
-        self.album = album
-        self.artist = artist
+        self.album = _intern(album)
+        self.artist = _intern(artist)
         self.track_num = track_num
         self.mtime = mtime
+        self.size = size
+        self.length_millis = length_millis
+        self.sample_rate = sample_rate
 
     def __repr__(self):
         return("Song(title={}, track_num={})".format(self.title, self.track_num))
@@ -103,11 +170,17 @@ class Song(object):
             "album": self.album,
             "artist": self.artist,
             "track_num": self.track_num,
-            "mtime": self.mtime
+            "mtime": self.mtime,
+            "size": self.size,
+            "length_millis": self.length_millis,
+            "sample_rate": self.sample_rate
             }
 
 class Album(object):
-    def __init__(self, path):
+    __slots__ = ("path", "id", "_index", "_executor", "_state_store", "tag", "name", "artist", "_cur_song",
+                 "is_current_album", "songs", "_song_idx", "_song_position")
+
+    def __init__(self, path, index=None, executor=None, state_store=None):
         """
         >>> Album(".").name
         ''
@@ -128,8 +201,11 @@ class Album(object):
         1
         >>> first_song = a.cur_song()
         """
-        self.path = path
+        self.path = _intern(path)
         self.id = hashlib.sha256(path.encode('utf-8')).hexdigest()
+        self._index = index
+        self._executor = executor
+        self._state_store = state_store if state_store is not None else StateStore(None)
 
         self.tag = None
         self.name = ""
@@ -139,6 +215,7 @@ class Album(object):
         self.songs = []
 
         self._song_idx = 0
+        self._song_position = None
 
         if not match(TAG_IN_PATH_REGEX, path):
             #raise Exception("naming convention error: " + current)
@@ -152,23 +229,28 @@ class Album(object):
     def rescan(self):
         '''
         Scan album directory for files and load their metadata.
+
+        Metadata of files whose mtime and size match the library index is
+        taken from the index, only new or changed files are read. If the
+        album was given an executor, those are read in parallel. Files that
+        are no valid MP3s are indexed as such, so they are not read again.
         '''
-        # Load state cache
-        cache_file = self.path+"/cache.json"
-        cached_songs = {}
-        if os.path.isfile(cache_file):
-            try:
-                with open(self.path + "/cache.json", 'r') as f:
-                    cache = json.load(f)
-                    for song_dict in cache:
-                        song = Song.from_dict(song_dict)
-                        cached_songs[song.path] = song
-            except PermissionError:
-                info("Could not read cache % due to lack of permissions" % cache)
-            except json.JSONDecodeError:
-                info("JSON format error reading cache file %" % cache)
-
-        files = sorted_aphanumeric(listdir(self.path))
+        self.songs = []
+
+        indexed_songs = {}
+        indexed_invalid_files = {}
+        if self._index is not None:
+            for song_dict in self._index.album_songs(self.path):
+                song = Song.from_dict(song_dict)
+                indexed_songs[song.path] = song
+            indexed_invalid_files = self._index.album_invalid_files(self.path)
+
+        if self._index is not None:
+            entries, unchanged = self._index.scan_dir(self.path)
+        else:
+            entries, unchanged = [(f, isdir(self.path + "/" + f)) for f in listdir(self.path)], False
+
+        files = sorted_aphanumeric([name for name, _ in entries])
         mp3s = [ x for x in files if ".mp3" in x.lower() ]
         if not mp3s:
             info("empty album: " + self.path)
@@ -177,24 +259,55 @@ class Album(object):
         if ALBUM_INDICATOR_FILE in files:
             self.is_current_album = True
 
+        directories = set([name for name, is_dir in entries if is_dir])
+        index_outdated = set([self.path + "/" + f for f in mp3s]) != set(indexed_songs) | set(indexed_invalid_files)
+        unknown_files = []
+        invalid_files = []
+
         for filename in mp3s:
             current = self.path + "/" + filename
 
-            if isdir(current):
+            if filename in directories:
                 raise Exception("directory ended in .mp3 : " + current)
 
-            # Prefer cached songs
-            if current in cached_songs:
-                song = cached_songs[current]
-                if os.path.getmtime(current) == song.mtime:
+            # Prefer indexed songs, trust them without stat()ing if the
+            # directory did not change since the last scan
+            if current in indexed_songs:
+                song = indexed_songs[current]
+                if unchanged and not index_outdated:
                     self.songs.append(song)
                     continue
-                        
-            try:
-                song = Song.from_file(current)
+
+                stat = os.stat(current)
+                if stat.st_mtime == song.mtime and stat.st_size == song.size:
+                    self.songs.append(song)
+                    continue
+
+            elif current in indexed_invalid_files:
+                mtime, size = indexed_invalid_files[current]
+                if unchanged and not index_outdated:
+                    invalid_files.append((current, mtime, size))
+                    continue
+
+                stat = os.stat(current)
+                if stat.st_mtime == mtime and stat.st_size == size:
+                    invalid_files.append((current, mtime, size))
+                    continue
+
+            index_outdated = True
+            unknown_files.append(current)
+
+        if self._executor is not None and len(unknown_files) > 1:
+            new_songs = self._executor.map(Song.from_file_or_none, unknown_files)
+        else:
+            new_songs = map(Song.from_file_or_none, unknown_files)
+        for path, song in zip(unknown_files, new_songs):
+            if song is not None:
                 self.songs.append(song)
-            except ValueError:
-                song = None
+            else:
+                debug("not a valid MP3: " + path)
+                stat = os.stat(path)
+                invalid_files.append((path, stat.st_mtime, stat.st_size))
 
         # Perfer sorting by track number from ID3,
         # otherwise resort to name based sorting
@@ -203,6 +316,9 @@ class Album(object):
         else:
             self.songs = sorted(self.songs, key=lambda x: x.path)
 
+        if index_outdated and self._index is not None:
+            self._index.put_album(self.path, self.songs, invalid_files)
+
         if not self.songs:
             info("No songs in directory...")
             return
@@ -210,10 +326,6 @@ class Album(object):
         self.artist = self.songs[0].artist
         self.name = self.songs[0].album
 
-        # Now write cache back
-        with open(cache_file, 'w') as f:
-            json.dump([song.to_dict() for song in self.songs], f)
-
     def __repr__(self):
         return("Album(tag={}, name={}, artist={}, songs={})".format(self.tag, self.name, self.artist, self.songs))
 
@@ -224,16 +336,14 @@ class Album(object):
         self._song_position = position
         state = {"idx":self._song_idx, "position": self._song_position}
 
-        with open(self.path+"/album.json", "w") as f:
-            json.dump(state, f)
+        self._state_store.put(self.path+"/album.json", state)
 
     def load_state(self):
+        state = self._state_store.get(self.path+"/album.json")
         try:
-            with open(self.path+"/album.json", "r") as f:
-                state = json.load(f)
-                self._song_idx = state["idx"]
-                self._song_position = state['position']
-        except:
+            self._song_idx = state["idx"]
+            self._song_position = state['position']
+        except (TypeError, KeyError):
             self.restart()
             return
 
@@ -301,6 +411,37 @@ class Album(object):
         else:
             return None
 
+    def peek_next_song(self, wrap=True):
+        """
+        Returns the song next_song() would return, without selecting it.
+
+        >>> import sys, tempfile
+        >>> from glob import glob
+        >>> sys.path.insert(0, "../benchmarks")
+        >>> from gen_library import generate
+        >>> audio_path = tempfile.mkdtemp() + "/audio"
+        >>> generate(audio_path, playlists=1, albums_per_playlist=1, songs_per_album=3)
+        3
+        >>> a = Album(glob(audio_path + "/0000 */*")[0])
+        >>> a.peek_next_song().track_num
+        2
+        >>> a.cur_song().track_num
+        1
+        >>> _ = a.next_song(), a.next_song()
+        >>> a.peek_next_song().track_num, a.peek_next_song(wrap=False)
+        (1, None)
+        """
+        if not self.songs:
+            return None
+
+        idx = self._song_idx + 1
+        if idx >= len(self.songs):
+            if not wrap:
+                return None
+            idx = 0
+
+        return self.songs[idx]
+
     def prev_song(self, wrap=True):
         """
         Returns the next song from this album.
@@ -349,6 +490,15 @@ class Album(object):
     def count_tracks(self):
         return(len(self.songs))
 
+    def select_song(self, song_idx):
+        '''
+        Selects a song by its position in this album, from its beginning.
+        '''
+        self._song_idx = song_idx
+        self._song_position = 0
+        self._cur_song = self.songs[song_idx]
+        return self._cur_song
+
     def current_track_num(self):
         if self.cur_song() is not None:
             # TODO calculation is wrong, have to add all albums!
@@ -402,14 +552,26 @@ class Playlist(object):
         except KeyError:
             return None
 
-    def __init__(self, path):
-        print(path)
+    def __init__(self, path, index=None, executor=None, state_store=None, on_change=None):
+        """
+        Only registers the playlist by its id and tag, albums are scanned
+        on first access, see materialize(). on_change is called once that
+        happened.
+        """
         self.path = path
         self.tag = None
         self._album_idx = None
         self._cur_album = None
         self._flag_repeat = False
-        self.albums = []
+        self._albums = None
+        # Playlist wide index of each album's first song, followed by the
+        # number of songs, see _update_song_offsets()
+        self._song_offsets = [0]
+        self._index = index
+        self._executor = executor
+        self._state_store = state_store if state_store is not None else StateStore(None)
+        self._materialize_lock = RLock()
+        self._on_change = on_change
         self.id = hashlib.sha256(path.encode('utf-8')).hexdigest()
         self._playlists_by_id[self.id] = self
         (_, self.name) = os.path.split(path)
@@ -421,50 +583,116 @@ class Playlist(object):
         else:
             self.tag = path[-12:]
 
-        files = listdir(path)
+        # Tags assigned via set_tag() are only known from the saved state
+        state = self._state_store.get(self.path+"/playlist.json")
+        if state is not None and "tag" in state:
+            self.tag = state["tag"]
 
-        # When there are mp3 files, assume this is an album and therefore
-        # make only a small playlist from it
-        if any(["mp3" == f.lower()[-3:] for f in files]):
-            album = Album(path)
-            self.albums = [ album ]
-            if album.tag is not None:
-                self.tag = album.tag
-        else:
-            for d in files:
-                current = path + "/" + d
+        # Remember all playlists by their tag
+        if self.tag is not None and not self._register_tag(self.tag):
+            self.tag = None
 
-                if not isdir(current):
-                    # We assume only one lever of playlists, so skip
-                    info("Ignoring file {} in playlist {}, will only look for album directories here.".format(d, path))
-                    continue
+    def _register_tag(self, tag):
+        '''
+        Makes tag resolve to this playlist, unless another one has it
+        already. If two playlists claim the same tag, the tag index decides,
+        so the same one wins on every boot.
+        '''
+        owner = self._index.tag_owner(tag) if self._index is not None else None
+        if owner is not None and owner[1] != self.path and isdir(owner[1]):
+            error("tag {} of {} already belongs to {}".format(tag, self.path, owner[1]))
+            return False
+
+        other = self._playlists_by_tag.get(tag)
+        if other is not None and other is not self:
+            error("tag {} of {} already belongs to {}".format(tag, self.path, other.path))
+            return False
+
+        self._playlists_by_tag[tag] = self
+        if self._index is not None:
+            self._index.put_tag(tag, self.id, self.path)
+        return True
+
+    @property
+    def albums(self):
+        if self._albums is None:
+            self.materialize()
+        return self._albums
+
+    def is_materialized(self):
+        return self._albums is not None
+
+    def materialize(self):
+        """
+        Scans the albums of this playlist and loads its state, unless
+        that already happened.
+        """
+        with self._materialize_lock:
+            if self._albums is not None:
+                return
 
-                album = Album(current)
+            debug("materializing playlist {}".format(self.path))
+            albums = []
+            index = self._index
 
-                self.albums.append(album)
+            if index is not None:
+                entries, _ = index.scan_dir(self.path)
+            else:
+                entries = [(f, isdir(self.path + "/" + f)) for f in listdir(self.path)]
 
-        self.albums = sorted(self.albums, key=lambda x: x.name.lower())
+            # When there are mp3 files, assume this is an album and therefore
+            # make only a small playlist from it
+            if any(["mp3" == f.lower()[-3:] for f, _ in entries]):
+                albums = [ Album(self.path, index, self._executor, self._state_store) ]
+            else:
+                for d, is_dir in entries:
+                    current = self.path + "/" + d
 
-        self._album_idx = 0
-        self.load_state()
+                    if not is_dir:
+                        # We assume only one lever of playlists, so skip
+                        info("Ignoring file {} in playlist {}, will only look for album directories here.".format(d, self.path))
+                        continue
 
-        # Remember all playlists by their tag
-        if self.tag is not None:
-            if self.tag in self._playlists_by_tag:
-                raise Exception("tag "+self.tag+" found twice: " + path + ", " + str(self._playlists_by_tag[self.tag]))
-            self._playlists_by_tag[self.tag] = self
-
-        # Try to remember which album was played last
-        current_albums = [x.is_current_album for x in self.albums]
-        if True in current_albums:
-            self._album_idx = current_albums.index(current_album_dir)
-    
-        try:
-            self._cur_album = self.albums[self._album_idx]
-        except IndexError:
-            self._cur_album = None
-        except TypeError:
-            self._cur_album = None
+                    albums.append(Album(current, index, self._executor, self._state_store))
+
+            self._albums = sorted(albums, key=lambda x: x.name.lower())
+            self._update_song_offsets()
+
+            self._album_idx = 0
+            self.load_state()
+
+            # Try to remember which album was played last
+            current_albums = [x.is_current_album for x in self._albums]
+            if True in current_albums:
+                self._album_idx = current_albums.index(True)
+
+            try:
+                self._cur_album = self._albums[self._album_idx]
+            except IndexError:
+                self._cur_album = None
+            except TypeError:
+                self._cur_album = None
+
+            if index is not None:
+                index.commit()
+
+        if self._on_change is not None:
+            self._on_change()
+
+    def to_summary(self):
+        '''
+        What is known without scanning the albums, i.e. without
+        materializing the playlist. The albums are left empty and
+        "materialized" tells them apart from a playlist without any.
+        '''
+        return {
+                "name": self.name,
+                "id": self.id,
+                "path": self.path,
+                "tag": self.tag,
+                "materialized": False,
+                "albums": []
+                }
 
     def to_dict(self):
         return {
@@ -473,6 +701,7 @@ class Playlist(object):
                 "path": self.path,
                 "tag": self.tag,
                 "current_album": self._album_idx,
+                "materialized": True,
                 "albums": [ a.to_dict() for a in self.albums ]
                 }
 
@@ -484,32 +713,59 @@ class Playlist(object):
         if self._cur_album is not None:
             self._cur_album.save_state(position)
 
-        with open(self.path+"/playlist.json", "w") as f:
-            json.dump(state, f)
+        self._state_store.put(self.path+"/playlist.json", state)
 
     def load_state(self):
+        state = self._state_store.get(self.path+"/playlist.json")
         try:
-            with open(self.path+"/playlist.json", "r") as f:
-                state = json.load(f)
-                self._album_idx = state["idx"]
-                self._flag_repeat = state['repeat']
-                self.tag = state['tag']
-                try:
-                    self._cur_album = self.albums[self._album_idx]
-                except IndexError:
-                    self._cur_album = None
-        except (FileNotFoundError, KeyError):
+            self._album_idx = state["idx"]
+            self._flag_repeat = state['repeat']
+            # The tag was settled in __init__, the saved one may belong to
+            # another playlist
+            try:
+                self._cur_album = self.albums[self._album_idx]
+            except IndexError:
+                self._cur_album = None
+        except (TypeError, KeyError):
             self.restart()
             return
 
         self._cur_album = self.albums[self._album_idx]
         self._cur_album.load_state()
 
+    def checkpoint(self):
+        '''
+        Where playback is within this playlist, see
+        Library.restore_checkpoints().
+        '''
+        album = self._cur_album
+        if album is None:
+            return None
+
+        return {
+            "playlist": self.path,
+            "tag": self.tag,
+            "album": self._album_idx,
+            "album_path": album.path,
+            "song": album._song_idx
+        }
+
     def set_tag(self, tag):
-        if self.tag in self._playlists_by_tag:
-            del self._playlists_by_tag[self.tag]
+        '''
+        Assigns a new tag, returns False if it belongs to another playlist.
+        '''
+        if tag != self.tag and not self._register_tag(tag):
+            return False
+
+        if self.tag is not None and self.tag != tag:
+            if self._playlists_by_tag.get(self.tag) is self:
+                del self._playlists_by_tag[self.tag]
+            if self._index is not None:
+                self._index.remove_tag(self.tag)
+
         self.tag = tag
         self.save_state()
+        return True
 
     def restart(self):
         """
@@ -574,11 +830,13 @@ class Playlist(object):
         >>> a is None
         True
         """
-        self._album_idx -= 1
-        if self._album_idx < 0 and wrap:
-            self.album_idx = len(self.albums)-1
-        else:
-            return None
+        album_idx = self._album_idx - 1
+        if album_idx < 0:
+            if not wrap:
+                return None
+            album_idx = len(self.albums) - 1
+
+        self._album_idx = album_idx
         self._cur_album = self.albums[self._album_idx]
         return self._cur_album
 
@@ -597,6 +855,26 @@ class Playlist(object):
         else:
             return None
 
+    def peek_next_song(self, wrap=True):
+        '''
+        Returns the song next_song() would return, without selecting it.
+        '''
+        if self._cur_album is None:
+            return None
+
+        song = self._cur_album.peek_next_song(wrap)
+        if song:
+            return song
+
+        album_idx = self._album_idx + 1
+        if album_idx >= len(self.albums):
+            if not (self._flag_repeat or wrap):
+                return None
+            album_idx -= 1
+
+        songs = self.albums[album_idx].songs
+        return songs[0] if songs else None
+
     def prev_song(self, wrap=True):
         if self._cur_album is None:
             return None
@@ -625,43 +903,111 @@ class Playlist(object):
 
         return self._cur_album._song_position
 
+    def _update_song_offsets(self):
+        '''
+        Has to be called whenever albums were added, removed or rescanned.
+        '''
+        offsets = [0]
+        for album in self._albums:
+            offsets.append(offsets[-1] + len(album.songs))
+        self._song_offsets = offsets
+
     def count_songs(self):
-        return sum([a.count_tracks() for a in self.albums])
+        self.materialize()
+        return self._song_offsets[-1]
 
     def current_song_index(self):
-        track = 0
-        for a in self.albums:
-            if a is self._cur_album:
-                break
-            track += len(self.album.songs)
+        '''
+        Index of the current song within the whole playlist, starting at 0.
+        '''
+        if self._cur_album is None or self._album_idx is None:
+            return 0
+        return self._song_offsets[self._album_idx] + self._cur_album._song_idx
 
-        if self._cur_album is not None:
-            track += self._cur_album.current_track_num()
-        return track
+    def seek_to_index(self, index):
+        '''
+        Selects a song by its index within the whole playlist, see
+        current_song_index(). Returns the song or None if out of range.
+
+        >>> import sys, tempfile
+        >>> from glob import glob
+        >>> sys.path.insert(0, "../benchmarks")
+        >>> from gen_library import generate
+        >>> audio_path = tempfile.mkdtemp() + "/audio"
+        >>> generate(audio_path, playlists=1, albums_per_playlist=2, songs_per_album=2)
+        4
+        >>> pl = Playlist(glob(audio_path + "/0000 *")[0])
+        >>> song = pl.seek_to_index(2)
+        >>> song is pl.albums[1].songs[0]
+        True
+        >>> pl.current_song_index()
+        2
+        >>> pl.seek_to_index(pl.count_songs()) is None
+        True
+        '''
+        self.materialize()
+        if not 0 <= index < self._song_offsets[-1]:
+            return None
+
+        # Empty albums share their offset with the following album, the
+        # last album starting at or before index is the one holding it
+        album_idx = bisect_right(self._song_offsets, index) - 1
+        self._album_idx = album_idx
+        self._cur_album = self._albums[album_idx]
+        return self._cur_album.select_song(index - self._song_offsets[album_idx])
 
     def set_album(self, album_idx=None, album_id=None):
         idx = None
 
-        if album_idx is not None and ( 0 <= self.album_idx < len(self.albums) ):
+        if album_idx is not None and ( 0 <= album_idx < len(self.albums) ):
             idx = album_idx
 
         if album_id is not None:
             for i in range(len(self.albums)):
                 if self.albums[i].id == album_id:
-                    self.album_idx = i
+                    idx = i
                     break
 
         if idx is not None:
-            self.album_idx = idx
+            self._album_idx = idx
             self._cur_album = self.albums[idx]
+            return self._cur_album
 
 
 class Library(object):
 
-    def __init__(self, audio_path):
+    def __init__(self, audio_path, index_path=None, incremental=True, scan_workers=None, warm_up=True,
+                 analyze_loudness=True, snapshot_path=None):
+        '''
+        incremental: only descend into directories whose mtime changed
+                     since the last scan, see LibraryIndex
+        scan_workers: number of threads reading ID3 tags of new files,
+                      defaults to the number of cores
+        warm_up: scan all playlists in a low priority background thread,
+                 otherwise they are only scanned when looked up
+        analyze_loudness: measure the loudness of all songs after warming
+                          up, see LoudnessAnalyzer
+        snapshot_path: where the snapshot read by the web process is
+                       published, see LibrarySnapshot
+        '''
         self.audio_path = audio_path
+        self.scan_workers = scan_workers or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self.scan_workers)
 
         self.playlists = []
+        self._warm_up_thread = None
+        self._stopped = Event()
+
+        if index_path is None:
+            index_path = os.path.join(audio_path, INDEX_FILE)
+        self.index = LibraryIndex(index_path, incremental)
+        self.snapshot = SnapshotPublisher(snapshot_path or default_snapshot_path(), self.to_snapshot)
+        # Saved states carry tags and current albums and songs
+        self.state_store = StateStore(os.path.join(audio_path, STATE_FILE), on_change=self.snapshot.changed,
+                                      legacy_root=audio_path)
+        self.checkpointer = Checkpointer(os.path.join(audio_path, CHECKPOINT_FILE))
+        self.restore_checkpoints()
+        self.loudness = LoudnessAnalyzer(self.index) if analyze_loudness else None
 
         #change_handler = LibraryFSChangeHandler(self)
 
@@ -671,6 +1017,11 @@ class Library(object):
 
         self.prepare()
 
+        if warm_up:
+            self._warm_up_thread = Thread(target=self._warm_up)
+            self._warm_up_thread.daemon = True
+            self._warm_up_thread.start()
+
 
 #    def _prepare_albums(self, tag_path):
         # we have to sahift and cannot simply insert in place at index 0 because that doesn't rotate the other entries
@@ -680,7 +1031,31 @@ class Library(object):
         #    i = albums.index(current_album_dir)
         #    albums = albums[i:] + albums[:i]
 
+    def restore_checkpoints(self):
+        '''
+        Takes over the latest checkpoint of each playlist into the saved
+        state. Clean stops are recorded as checkpoints as well, so the
+        latest checkpoint is never older than the saved state.
+        '''
+        for checkpoint in self.checkpointer.recover().values():
+            try:
+                playlist_key = checkpoint["playlist"] + "/playlist.json"
+                playlist_state = self.state_store.get(playlist_key) or {"repeat": False, "tag": checkpoint["tag"]}
+                playlist_state["idx"] = checkpoint["album"]
+                if "position" in checkpoint:
+                    playlist_state["position"] = checkpoint["position"]
+                self.state_store.put(playlist_key, playlist_state)
+
+                self.state_store.put(checkpoint["album_path"] + "/album.json",
+                                     {"idx": checkpoint["song"], "position": checkpoint.get("position")})
+            except KeyError:
+                debug("ignoring incomplete checkpoint " + str(checkpoint))
+
     def prepare(self):
+        '''
+        Registers all playlists of the library, see Playlist.materialize()
+        for when their albums are scanned.
+        '''
         audio_path = self.audio_path
 
         if not isdir(audio_path):
@@ -690,10 +1065,17 @@ class Library(object):
         if not isdir(audio_path + "/system"):
             raise Exception("missing directory: " + audio_path + "/system")
 
+        # The index file itself lives in here, so the mtime of this
+        # directory is useless for incremental scans
         dirs = listdir(audio_path)
 
         debug(audio_path + "/system exists")
 
+        self.playlists = []
+        # Playlists found by an earlier scan are replaced
+        Playlist._playlists_by_tag.clear()
+        Playlist._playlists_by_id.clear()
+
         for d in dirs:
 
             current = audio_path + "/" + d
@@ -706,67 +1088,145 @@ class Library(object):
             if d == "system":
                 continue
 
-            playlist = Playlist(current)
-        self.playlists.append(playlist)
+            playlist = Playlist(current, self.index, self._executor, self.state_store, self.snapshot.changed)
+            self.playlists.append(playlist)
+
+        self.index.retain_tags([playlist.path for playlist in self.playlists])
+        self.snapshot.changed()
+
+    def _warm_up(self):
+        lower_thread_priority()
+        for playlist in list(self.playlists):
+            if self._stopped.is_set():
+                return
+            playlist.materialize()
+        debug("warm up finished")
+        self.snapshot.changed()
+
+        if self.loudness is not None:
+            self.loudness.analyze(self.songs())
+
+    def materialize_all(self):
+        for playlist in list(self.playlists):
+            playlist.materialize()
+
+    def songs(self):
+        for playlist in list(self.playlists):
+            for album in playlist.albums:
+                for song in album.songs:
+                    yield song
+
+    def to_snapshot(self):
+        '''
+        What the "all" command of LibraryAPI returns. Playlists not
+        materialized yet are only summarized, so that publishing the
+        snapshot does not scan the whole library.
+        '''
+        return [playlist.to_dict() if playlist.is_materialized() else playlist.to_summary()
+                for playlist in list(self.playlists)]
+
+    def gain_for(self, song):
+        if self.loudness is None:
+            return 0.0
+        return self.loudness.gain_for(song)
+
+    def terminate(self):
+        # The warm up stops after the playlist it is scanning
+        self._stopped.set()
+        if self._warm_up_thread is not None:
+            self._warm_up_thread.join()
+            self._warm_up_thread = None
+
+        if self.loudness is not None:
+            self.loudness.terminate()
+        self.checkpointer.terminate()
+        self.state_store.terminate()
+        self.snapshot.terminate()
+        self._executor.shutdown()
+        self.index.close()
 
     def lookup_playlist(self, tag=None, id=None):
         if id is not None:
-            return Playlist.get_playlist_by_id(id)
+            playlist = Playlist.get_playlist_by_id(id)
         else:
-            return Playlist.get_playlist(tag)
+            playlist = Playlist.get_playlist(tag)
+
+        if playlist is not None:
+            playlist.materialize()
+        return playlist
 
 class LibraryAPI(object):
-    QueueManager.make_queue("library_in")
-    QueueManager.make_queue("library_out")
-    
 
-    def __init__(self, library=None):
+    def __init__(self, library=None, snapshot_path=None, bridge=None):
         '''
-        library: None if not in same process as the library
+        library: None if not in same process as the library, reading is
+                 then done from the snapshot the library publishes and
+                 everything else is sent over the bridge
+        bridge: the BridgeServer of the library's process, which the API
+                is offered on
         '''
-        qm = QueueManager.manager()
-        self._queue_cmd = qm.get_library_in()
-        self._queue_response = qm.get_library_out()
-
         self.library = library
         if library is not None:
-            self._thread = Thread(target=self._api_handler)
-            self._thread.daemon = True
-            self._thread.start()
+            self._snapshot = None
+            self._bridge = None
+            if bridge is not None:
+                bridge.register("library", self._handle_request)
+        else:
+            self._snapshot = SnapshotReader(snapshot_path)
+            self._bridge = BridgeClient()
 
-    def _api_handler(self):
+    def _handle_request(self, command, arguments=[], data={}):
+        '''
+        Does API related things in the master process on behalf of the
+        web process.
         '''
-        Does API related things in the master process.
+        debug("API request: {} {}".format(command, arguments))
+        response = self.playlist(command, arguments, data)
+        if isinstance(response, Playlist):
+            return response.to_dict()
+        return response
 
-        Route all messages to the handler function and pass
-        back the result
+    def playlists_json(self):
         '''
-        while True:
-            msg = self._queue_cmd.get(block=True, timeout=None)
-            print("Message received: {}".format(msg))
-            if msg is None:
-                continue
-            try:
-                response = self.playlist( *msg )
-            except Exception as e:
-               print("Exception occured {}".format(e))
-            finally:
-                self._queue_response.put(response)
-        
+        All playlists JSON encoded, as the "all" command returns them.
+        '''
+        if self._snapshot is not None:
+            payload = self._snapshot.payload()
+            if payload is not None:
+                return payload
+        return json.dumps(self.playlist("all"))
+
+    def _from_snapshot(self, command):
+        snapshot = self._snapshot.load() if self._snapshot is not None else None
+        if snapshot is None or command in ("assign", "current"):
+            return None
+
+        if command == "all":
+            return snapshot
+        for playlist in snapshot:
+            if command in (playlist["id"], playlist["tag"]):
+                # Summaries lack the albums, the library has to scan them
+                return playlist if playlist["materialized"] else None
+        return None
+
     def playlist(self, command, arguments=[], data={}):
         if not self.library:
-            self._queue_cmd.put( ( command, arguments, data ) )
-            return self._queue_response.get(block=True, timeout=2)
+            response = self._from_snapshot(command)
+            if response is not None:
+                return response
+
+            return self._bridge.call("library", command, arguments, dict(data))
 
         if command == "all":
-            return([pl.to_dict() for pl in self.library.playlists])
+            return(self.library.to_snapshot())
         elif command == "assign":
             pl = self.library.lookup_playlist(arguments[0])
             if pl is None:
-                return({"ok":False, "message": "Playlist % not found"%arguments[0]})
+                return({"ok":False, "message": "Playlist %s not found"%arguments[0]})
             if "tag" not in data:
                 return({"ok":False, "message": "No tag given"})
-            pl.set_tag(data["tag"])
+            if not pl.set_tag(data["tag"]):
+                return({"ok":False, "message": "Tag %s belongs to another playlist"%data["tag"]})
             return({"ok":True})
         elif command == "current":
             return({"ok":False, "message": "Not implemented (yet)"})
@@ -776,18 +1236,16 @@ class LibraryAPI(object):
             return(r)
 
 if __name__ == "__main__":
-    from SetupLogging import setup_stdout_logging
     from sys import argv
 
     getLogger('   Library').setLevel(DEBUG)
 
-    #setup_stdout_logging()
-
-    if len(argv) != 2:
+    if len(argv) < 2:
         info("Error: Missing path argument.")
         exit(1)
 
-    lib = Library(argv[1])
+    lib = Library(argv[1], incremental="--full" not in argv, warm_up=False, analyze_loudness=False)
+    lib.materialize_all()
     #try:
     #    lib = Library(argv[1])
     #    input()
@@ -0,0 +1,302 @@
+from sqlite3 import connect, DatabaseError
+from threading import RLock
+from sys import intern
+from logging import getLogger
+from os import listdir, stat
+from os.path import isdir
+import json
+
+debug = getLogger('  LibIndex').debug
+info = getLogger('  LibIndex').info
+
+
+class LibraryIndex(object):
+    """
+    Library wide metadata index, stored in a single SQLite file.
+
+    The whole index is read once on construction, albums only look up
+    their songs in memory. Songs are kept as tuples in the order of
+    _SONG_COLUMNS, dicts are only built for the album asking for them.
+    Changes are collected per album directory and written back in a
+    single transaction by commit(), so an unchanged library is booted
+    without any write access to the SD card. Files that turned out not to
+    be valid MP3s are kept with their mtime and size only, so they are not
+    read again on every boot.
+
+    Loudness measurements are kept apart from the songs, so rescans of an
+    album do not lose them. They are collected in memory and written in
+    batches by flush_loudness(), which holds only the database lock while
+    writing, so lookups are not blocked by the SD card. commit() flushes
+    them too.
+
+    The tag index maps RFID tags to the playlist they belong to. A tag can
+    only belong to a single playlist, changes are written right away.
+
+    >>> idx = LibraryIndex(":memory:")
+    >>> idx.album_songs("/audio/foo")
+    []
+    >>> idx.put_album("/audio/foo", [{"path": "/audio/foo/a.mp3", "title": "a", "album": "foo", "artist": "", "track_num": 1, "mtime": 1.0, "size": 3}])
+    >>> idx.commit()
+    >>> [s["title"] for s in idx.album_songs("/audio/foo")]
+    ['a']
+    >>> idx.put_album("/audio/foo", [], [("/audio/foo/b.mp3", 2.0, 0)])
+    >>> idx.commit()
+    >>> idx.load()
+    >>> idx.album_songs("/audio/foo"), idx.album_invalid_files("/audio/foo")
+    ([], {'/audio/foo/b.mp3': (2.0, 0)})
+    >>> idx.put_loudness("/audio/foo/a.mp3", 1.0, 3, -20.0, 10)
+    >>> idx.flush_loudness()
+    >>> idx.load()
+    >>> idx.loudness("/audio/foo/a.mp3", 1.0, 3)
+    (-20.0, 10)
+    """
+    _SCHEMA_VERSION = 4
+
+    _SONG_COLUMNS = ["path", "title", "album", "artist", "track_num", "mtime", "size", "length_millis", "sample_rate"]
+
+    def __init__(self, path, incremental=True):
+        self.path = path
+        self.incremental = incremental
+        self._lock = RLock()
+        # Serializes access to the database, taken after _lock, never before
+        self._db_lock = RLock()
+        self._songs_by_dir = {}
+        self._invalid_by_dir = {}
+        self._dirty_dirs = set()
+        self._listings = {}
+        self._dirty_listings = set()
+        self._loudness = {}
+        self._dirty_loudness = set()
+        self._tags = {}
+        self._closed = False
+
+        try:
+            self._db = connect(path, check_same_thread=False)
+            self._prepare_schema()
+        except DatabaseError:
+            info("index file {} is corrupt, starting over".format(path))
+            self._db = connect(path, check_same_thread=False)
+            self._drop_schema()
+            self._prepare_schema()
+
+        self.load()
+
+    def _drop_schema(self):
+        with self._db:
+            self._db.execute("DROP TABLE IF EXISTS songs")
+            self._db.execute("DROP TABLE IF EXISTS dirs")
+            self._db.execute("DROP TABLE IF EXISTS loudness")
+            self._db.execute("DROP TABLE IF EXISTS tags")
+
+    def _prepare_schema(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version != LibraryIndex._SCHEMA_VERSION:
+            debug("index schema version {} is outdated, recreating".format(version))
+            self._drop_schema()
+
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS songs ("
+                             "dir TEXT NOT NULL, "
+                             "path TEXT PRIMARY KEY, "
+                             "title TEXT, album TEXT, artist TEXT, track_num INTEGER, "
+                             "mtime REAL, size INTEGER, length_millis INTEGER, sample_rate INTEGER, "
+                             "invalid INTEGER NOT NULL DEFAULT 0)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS songs_by_dir ON songs (dir)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS dirs ("
+                             "path TEXT PRIMARY KEY, mtime REAL, entries TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS loudness ("
+                             "path TEXT PRIMARY KEY, mtime REAL, size INTEGER, lufs REAL, blocks INTEGER)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS tags ("
+                             "tag TEXT PRIMARY KEY, playlist_id TEXT, path TEXT)")
+            self._db.execute("PRAGMA user_version = {}".format(LibraryIndex._SCHEMA_VERSION))
+
+    def load(self):
+        """
+        Reads the complete index into memory.
+        """
+        with self._lock, self._db_lock:
+            self._songs_by_dir = {}
+            self._invalid_by_dir = {}
+            self._dirty_dirs = set()
+            columns = ", ".join(LibraryIndex._SONG_COLUMNS)
+            for row in self._db.execute("SELECT dir, invalid, " + columns + " FROM songs"):
+                if row[1]:
+                    song = dict(zip(LibraryIndex._SONG_COLUMNS, row[2:]))
+                    self._invalid_by_dir.setdefault(row[0], {})[song["path"]] = (song["mtime"], song["size"])
+                    continue
+                song = tuple(intern(value) if isinstance(value, str) else value for value in row[2:])
+                self._songs_by_dir.setdefault(intern(row[0]), []).append(song)
+
+            self._listings = {}
+            self._dirty_listings = set()
+            for path, mtime, entries in self._db.execute("SELECT path, mtime, entries FROM dirs"):
+                self._listings[path] = (mtime, [tuple(e) for e in json.loads(entries)])
+
+            self._loudness = {}
+            self._dirty_loudness = set()
+            for path, mtime, size, lufs, blocks in self._db.execute("SELECT path, mtime, size, lufs, blocks FROM loudness"):
+                self._loudness[path] = (mtime, size, lufs, blocks)
+
+            self._tags = {}
+            for tag, playlist_id, path in self._db.execute("SELECT tag, playlist_id, path FROM tags"):
+                self._tags[tag] = (playlist_id, path)
+            debug("loaded {} album directories from {}".format(len(self._songs_by_dir), self.path))
+
+    def scan_dir(self, path):
+        """
+        Lists a directory, returns a tuple (entries, unchanged) with entries
+        being a list of (name, is_dir) tuples. unchanged is True if the
+        directory's mtime is the same as during the last indexed scan, in
+        which case the entries come from the index.
+        """
+        mtime = stat(path).st_mtime
+        with self._lock:
+            cached = self._listings.get(path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1], self.incremental and path not in self._dirty_listings
+
+        entries = [(name, isdir(path + "/" + name)) for name in listdir(path)]
+        with self._lock:
+            self._listings[path] = (mtime, entries)
+            self._dirty_listings.add(path)
+        return entries, False
+
+    def album_songs(self, album_path):
+        """
+        Returns the indexed songs of an album directory as a list of dicts
+        suitable for Song.from_dict().
+        """
+        with self._lock:
+            songs = self._songs_by_dir.get(album_path, [])
+        return [dict(zip(LibraryIndex._SONG_COLUMNS, song)) for song in songs]
+
+    def album_invalid_files(self, album_path):
+        """
+        Returns the files of an album directory that are no valid MP3s, as
+        a dict of path to (mtime, size).
+        """
+        with self._lock:
+            return dict(self._invalid_by_dir.get(album_path, {}))
+
+    def put_album(self, album_path, songs, invalid_files=()):
+        """
+        Replaces the indexed songs of an album directory. Songs may be given
+        as dicts or objects providing to_dict(), invalid files as (path,
+        mtime, size) tuples.
+        """
+        songs = [s if isinstance(s, dict) else s.to_dict() for s in songs]
+        songs = [tuple(s.get(c) for c in LibraryIndex._SONG_COLUMNS) for s in songs]
+        with self._lock:
+            self._songs_by_dir[album_path] = songs
+            self._invalid_by_dir[album_path] = dict((path, (mtime, size)) for path, mtime, size in invalid_files)
+            self._dirty_dirs.add(album_path)
+
+    def loudness(self, path, mtime, size):
+        """
+        Returns the measured (lufs, blocks) of a file, None if it was not
+        measured yet or changed since. lufs is None for silent files.
+        """
+        with self._lock:
+            measured = self._loudness.get(path)
+        if measured is None or measured[0] != mtime or measured[1] != size:
+            return None
+        return measured[2], measured[3]
+
+    def put_loudness(self, path, mtime, size, lufs, blocks):
+        with self._lock:
+            self._loudness[path] = (mtime, size, lufs, blocks)
+            self._dirty_loudness.add(path)
+
+    def flush_loudness(self):
+        """
+        Writes the loudness measurements put since the last flush in a
+        single transaction.
+        """
+        with self._lock:
+            rows = [(path,) + self._loudness[path] for path in self._dirty_loudness]
+            self._dirty_loudness = set()
+        if not rows:
+            return
+
+        with self._db_lock:
+            if self._closed:
+                return
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO loudness (path, mtime, size, lufs, blocks) "
+                                     "VALUES (?, ?, ?, ?, ?)", rows)
+        debug("wrote loudness of {} songs".format(len(rows)))
+
+    def tag_owner(self, tag):
+        """
+        Returns (playlist id, playlist path) of the playlist a tag belongs
+        to or None.
+        """
+        with self._lock:
+            return self._tags.get(tag)
+
+    def put_tag(self, tag, playlist_id, path):
+        with self._lock:
+            if self._tags.get(tag) == (playlist_id, path):
+                return
+            self._tags[tag] = (playlist_id, path)
+            with self._db_lock, self._db:
+                self._db.execute("INSERT OR REPLACE INTO tags (tag, playlist_id, path) VALUES (?, ?, ?)",
+                                 (tag, playlist_id, path))
+
+    def remove_tag(self, tag):
+        with self._lock:
+            if self._tags.pop(tag, None) is None:
+                return
+            with self._db_lock, self._db:
+                self._db.execute("DELETE FROM tags WHERE tag = ?", (tag,))
+
+    def retain_tags(self, paths):
+        """
+        Forgets the tags of all playlists not in paths.
+        """
+        paths = set(paths)
+        with self._lock:
+            gone = [tag for tag, (_, path) in self._tags.items() if path not in paths]
+            if not gone:
+                return
+            for tag in gone:
+                del self._tags[tag]
+            with self._db_lock, self._db:
+                self._db.executemany("DELETE FROM tags WHERE tag = ?", [(tag,) for tag in gone])
+            debug("forgot {} tags of vanished playlists".format(len(gone)))
+
+    def commit(self):
+        """
+        Writes all changed album directories back in a single transaction,
+        after the loudness measurements not flushed yet.
+        """
+        self.flush_loudness()
+        with self._lock:
+            if not self._dirty_dirs and not self._dirty_listings:
+                debug("index unchanged, nothing to write")
+                return
+
+            placeholders = ", ".join(["?"] * (len(LibraryIndex._SONG_COLUMNS) + 1))
+            columns = ", ".join(LibraryIndex._SONG_COLUMNS)
+            with self._db_lock, self._db:
+                for album_path in self._dirty_dirs:
+                    self._db.execute("DELETE FROM songs WHERE dir = ?", (album_path,))
+                    self._db.executemany("INSERT OR REPLACE INTO songs (dir, " + columns + ") VALUES (" + placeholders + ")",
+                                         [(album_path,) + song for song in self._songs_by_dir[album_path]])
+                    self._db.executemany("INSERT OR REPLACE INTO songs (dir, path, mtime, size, invalid) "
+                                         "VALUES (?, ?, ?, ?, 1)",
+                                         [(album_path, path, mtime, size) for path, (mtime, size)
+                                          in self._invalid_by_dir.get(album_path, {}).items()])
+                self._db.executemany("INSERT OR REPLACE INTO dirs (path, mtime, entries) VALUES (?, ?, ?)",
+                                     [(path, self._listings[path][0], json.dumps(self._listings[path][1]))
+                                      for path in self._dirty_listings])
+            info("index updated for {} album directories, {} directory listings".format(
+                len(self._dirty_dirs), len(self._dirty_listings)))
+            self._dirty_dirs = set()
+            self._dirty_listings = set()
+
+    def close(self):
+        self.commit()
+        with self._db_lock:
+            self._closed = True
+            self._db.close()
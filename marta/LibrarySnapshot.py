@@ -0,0 +1,206 @@
+from threading import Thread, Lock, Event
+from logging import getLogger
+from tempfile import gettempdir
+import json
+import mmap
+import os
+import struct
+
+from Util import lower_thread_priority
+
+debug = getLogger('  Snapshot').debug
+info = getLogger('  Snapshot').info
+
+SNAPSHOT_FILE = "marta-library.snapshot"
+
+_MAGIC = b"MMMS"
+_FORMAT_VERSION = 1
+
+# Magic, format version, generation and payload length, then the payload
+_HEADER = struct.Struct("<4sIQQ")
+
+
+def default_path():
+    '''
+    Snapshots live in RAM if possible, they are rebuilt on every boot anyway.
+    '''
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else gettempdir()
+    return os.path.join(directory, SNAPSHOT_FILE)
+
+
+class SnapshotPublisher(object):
+    """
+    Publishes what source() returns as an immutable snapshot file, which
+    other processes map into memory and read without asking this one, see
+    SnapshotReader.
+
+    Every snapshot is written to a new file which then replaces the
+    previous one, so a reader either sees the old or the new snapshot and
+    a mapped snapshot never changes. Like with StateStore, publishing is
+    delayed by publish_delay seconds after a change, so that a burst of
+    changes results in a single snapshot.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), SNAPSHOT_FILE)
+    >>> publisher = SnapshotPublisher(path, lambda: [{"name": "Bardic"}])
+    >>> publisher.publish()
+    >>> SnapshotReader(path).load()
+    [{'name': 'Bardic'}]
+    >>> publisher.terminate()
+    >>> SnapshotReader(path).load() is None
+    True
+    """
+    _DEFAULT_PUBLISH_DELAY = 1.0
+
+    def __init__(self, path, source, publish_delay=_DEFAULT_PUBLISH_DELAY):
+        self.path = path
+        self._source = source
+        self._publish_delay = publish_delay
+        self._publish_lock = Lock()
+        self._generation = 0
+        self._wake = Event()
+        self._stopped = Event()
+
+        self._publish_thread = Thread(target=self._publish_delayed)
+        self._publish_thread.daemon = True
+        self._publish_thread.start()
+
+    def changed(self):
+        '''
+        Schedules a new snapshot.
+        '''
+        self._wake.set()
+
+    def _publish_delayed(self):
+        lower_thread_priority()
+
+        while not self._stopped.is_set():
+            self._wake.wait()
+            self._stopped.wait(self._publish_delay)
+            self._wake.clear()
+            if self._stopped.is_set():
+                break
+
+            try:
+                self.publish()
+            except Exception as e:
+                info("could not publish snapshot: " + repr(e))
+
+    def publish(self):
+        '''
+        Publishes a snapshot now.
+        '''
+        with self._publish_lock:
+            payload = json.dumps(self._source()).encode("utf-8")
+            self._generation += 1
+
+            tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                f.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION, self._generation, len(payload)))
+                f.write(payload)
+            os.replace(tmp_path, self.path)
+
+        debug("published snapshot {} with {} bytes".format(self._generation, len(payload)))
+
+    def terminate(self):
+        debug("snapshot publisher terminating.")
+        if self._publish_thread is not None:
+            self._stopped.set()
+            self._wake.set()
+            self._publish_thread.join()
+            self._publish_thread = None
+
+        # Nobody keeps a stale snapshot up to date
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class SnapshotReader(object):
+    """
+    Reads the snapshots of a SnapshotPublisher, possibly in another
+    process. The current snapshot stays mapped and is only looked at again
+    once it was replaced, which costs a stat() per call.
+    """
+    def __init__(self, path=None):
+        self.path = path if path is not None else default_path()
+        self.generation = None
+        self._lock = Lock()
+        self._key = None
+        self._mapping = None
+        self._length = 0
+        self._data = None
+
+    def _refresh(self):
+        '''
+        Maps the current snapshot, returns False if there is none.
+        '''
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._unmap()
+            return False
+
+        if self._key == (stat.st_dev, stat.st_ino, stat.st_mtime_ns):
+            return True
+
+        try:
+            with open(self.path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            info("could not map snapshot: " + str(e))
+            self._unmap()
+            return False
+
+        try:
+            magic, version, generation, length = _HEADER.unpack_from(mapping)
+        except struct.error:
+            magic, version, generation, length = None, None, None, 0
+        if magic != _MAGIC or version != _FORMAT_VERSION or _HEADER.size + length > len(mapping):
+            info("ignoring invalid snapshot " + self.path)
+            mapping.close()
+            self._unmap()
+            return False
+
+        self._unmap()
+        self._key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+        self._mapping = mapping
+        self._length = length
+        self.generation = generation
+        return True
+
+    def _unmap(self):
+        if self._mapping is not None:
+            self._mapping.close()
+        self._key = None
+        self._mapping = None
+        self._length = 0
+        self._data = None
+        self.generation = None
+
+    def payload(self):
+        '''
+        The current snapshot as JSON encoded bytes or None.
+        '''
+        with self._lock:
+            if not self._refresh():
+                return None
+            return self._mapping[_HEADER.size:_HEADER.size + self._length]
+
+    def load(self):
+        '''
+        The current snapshot or None. It is decoded once per snapshot, the
+        result is shared and must not be modified.
+        '''
+        with self._lock:
+            if not self._refresh():
+                return None
+            if self._data is None:
+                self._data = json.loads(self._mapping[_HEADER.size:_HEADER.size + self._length])
+            return self._data
+
+    def close(self):
+        with self._lock:
+            self._unmap()
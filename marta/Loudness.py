@@ -0,0 +1,280 @@
+from importlib import import_module
+from queue import Queue
+from threading import Thread, Event
+from logging import getLogger
+from os.path import dirname
+from time import monotonic as mtime
+import math
+
+from Util import lower_thread_priority
+
+debug = getLogger('  Loudness').debug
+info = getLogger('  Loudness').info
+
+# Loudness tracks are evened out to, the ReplayGain 2.0 reference level
+TARGET_LOUDNESS = -18.0
+
+# Gains beyond this many dB are not applied, in either direction
+MAX_GAIN = 12.0
+
+# Biquads (b, a) of the ITU-R BS.1770 K-weighting filter at 48 kHz: a high
+# shelf modelling the head, followed by a high pass
+_K_WEIGHTING = [
+    ((1.53512485958697, -2.69169618940638, 1.19839281085285), (1.0, -1.69065929318241, 0.73248077421585)),
+    ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)),
+]
+_K_WEIGHTING_RATE = 48000
+
+_ABSOLUTE_GATE = -70.0
+_RELATIVE_GATE = -10.0
+
+# Blocks of 400 ms overlapping by 75 %, made up of four 100 ms segments
+_SEGMENTS_PER_SECOND = 10
+_SEGMENTS_PER_BLOCK = 4
+
+_DECODE_BUFFER_SIZE = 256 * 1024
+
+# Measurements are written to the index after this many songs or seconds
+_FLUSH_SONGS = 20
+_FLUSH_SECONDS = 30.0
+
+
+def _k_weighting_power(numpy, frequencies):
+    '''
+    Squared magnitude response of the K-weighting filter.
+    '''
+    z = numpy.exp(-2j * numpy.pi * frequencies / _K_WEIGHTING_RATE)
+    response = numpy.ones(len(frequencies), dtype=complex)
+    for b, a in _K_WEIGHTING:
+        response *= (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+    return numpy.abs(response) ** 2
+
+
+def measure_pcm(chunks, sample_rate, channels):
+    '''
+    Integrated loudness in LUFS of signed 16 bit PCM data, given as an
+    iterable of byte strings. The K-weighting is applied in the frequency
+    domain per 100 ms segment, which is close enough for evening out
+    tracks and needs nothing but numpy.
+
+    Returns (lufs, blocks) with blocks being the number of 400 ms blocks
+    that passed the gates, lufs is None for silence.
+    '''
+    import numpy
+
+    segment_length = sample_rate // _SEGMENTS_PER_SECOND
+    weights = _k_weighting_power(numpy, numpy.fft.rfftfreq(segment_length, 1.0 / sample_rate))
+    # Parseval: all bins but DC and Nyquist stand for two of the full spectrum
+    weights[1:(segment_length + 1) // 2] *= 2
+    weights /= float(segment_length) ** 2
+
+    powers = []
+    pending = numpy.zeros((0, channels), dtype=numpy.float32)
+    for chunk in chunks:
+        samples = numpy.frombuffer(chunk, dtype="<i2").reshape(-1, channels)
+        pending = numpy.concatenate((pending, samples.astype(numpy.float32) / 32768))
+
+        segments = len(pending) // segment_length
+        if segments == 0:
+            continue
+
+        spectrum = numpy.fft.rfft(pending[:segments * segment_length].reshape(segments, segment_length, channels),
+                                  axis=1)
+        # Mean square per segment, summed over the channels
+        powers.append(numpy.einsum("sfc,f->s", numpy.abs(spectrum) ** 2, weights))
+        pending = pending[segments * segment_length:]
+
+    if not powers:
+        return None, 0
+
+    powers = numpy.concatenate(powers)
+    if len(powers) < _SEGMENTS_PER_BLOCK:
+        blocks = numpy.array([powers.mean()])
+    else:
+        summed = numpy.concatenate(([0], numpy.cumsum(powers)))
+        blocks = (summed[_SEGMENTS_PER_BLOCK:] - summed[:-_SEGMENTS_PER_BLOCK]) / _SEGMENTS_PER_BLOCK
+
+    block_loudness = -0.691 + 10 * numpy.log10(numpy.maximum(blocks, 1e-20))
+    gated = blocks[block_loudness > _ABSOLUTE_GATE]
+    if len(gated) == 0:
+        return None, 0
+
+    relative_gate = -0.691 + 10 * math.log10(gated.mean()) + _RELATIVE_GATE
+    gated = blocks[(block_loudness > _ABSOLUTE_GATE) & (block_loudness > relative_gate)]
+    return -0.691 + 10 * math.log10(gated.mean()), len(gated)
+
+
+def measure_file(path, should_stop=None):
+    '''
+    Decodes an MP3 file via libmpg123 and measures its loudness, see
+    measure_pcm(). Returns None if should_stop() became True meanwhile.
+    '''
+    from ctypes import create_string_buffer
+    from LibMPG123Player import Decoder
+
+    decoder = Decoder()
+    buffer = create_string_buffer(_DECODE_BUFFER_SIZE)
+    stopped = []
+
+    def chunks():
+        while True:
+            if should_stop is not None and should_stop():
+                stopped.append(True)
+                return
+            data, status = decoder.read(buffer)
+            if data:
+                yield data
+            if status == Decoder.MPG123_DONE:
+                return
+
+    try:
+        decoder.open(path)
+        sample_rate, channels = decoder.get_format()
+        result = measure_pcm(chunks(), sample_rate, channels)
+    finally:
+        decoder.close()
+        decoder.delete()
+
+    return None if stopped else result
+
+
+def combine(measurements):
+    '''
+    Loudness of several tracks played in a row, from their (lufs, blocks).
+
+    >>> combine([(-20.0, 10), (-20.0, 30)])
+    -20.0
+    >>> round(combine([(-10.0, 1), (-20.0, 1)]), 2)
+    -12.6
+    >>> combine([(None, 0)]) is None
+    True
+    '''
+    energy = 0.0
+    blocks = 0
+    for lufs, count in measurements:
+        if lufs is None or not count:
+            continue
+        energy += count * 10 ** (lufs / 10.0)
+        blocks += count
+
+    if not blocks:
+        return None
+    return round(10 * math.log10(energy / blocks), 6)
+
+
+def gain_in_db(lufs):
+    '''
+    >>> gain_in_db(-23.0)
+    5.0
+    >>> gain_in_db(0.0)
+    -12.0
+    '''
+    if lufs is None:
+        return 0.0
+    return max(-MAX_GAIN, min(MAX_GAIN, TARGET_LOUDNESS - lufs))
+
+
+class LoudnessAnalyzer(object):
+    """
+    Measures the loudness of songs in a low priority background thread and
+    stores the results in the library index. Measurements are written in
+    batches, so an interrupted analysis continues about where it stopped
+    on the next boot. Unchanged files are never measured twice.
+
+    Gains are per album, so quiet intros stay quiet, falling back to the
+    track's own loudness until the whole album has been measured.
+    """
+    def __init__(self, index):
+        self._index = index
+        self._queue = Queue()
+        self._stopped = Event()
+
+        self._analyze_thread = Thread(target=self._analyze_songs)
+        self._analyze_thread.daemon = True
+        self._analyze_thread.start()
+
+    def analyze(self, songs):
+        self._queue.put(list(songs))
+
+    def _measurement(self, song):
+        if song.mtime is None:
+            return None
+        return self._index.loudness(song.path, song.mtime, song.size)
+
+    def _analyze_songs(self):
+        lower_thread_priority()
+
+        # Only checks whether numpy and libmpg123 are there, measure_file()
+        # imports numpy itself
+        try:
+            import_module("numpy")
+            from LibMPG123Player import Decoder
+            Decoder()
+        except (ImportError, OSError) as e:
+            info("loudness analysis not available: " + str(e))
+            return
+
+        while True:
+            songs = self._queue.get(block=True, timeout=None)
+            if songs is None:
+                break
+
+            measured = 0
+            unflushed = 0
+            flushed_at = mtime()
+            for song in songs:
+                if self._stopped.is_set():
+                    return
+                if song.mtime is None or self._measurement(song) is not None:
+                    continue
+
+                try:
+                    result = measure_file(song.path, self._stopped.is_set)
+                except Exception as e:
+                    info("could not measure {}: {}".format(song.path, e))
+                    result = (None, 0)
+                if result is None:
+                    return
+
+                lufs, blocks = result
+                debug("{}: {} LUFS".format(song.path, lufs))
+                self._index.put_loudness(song.path, song.mtime, song.size, lufs, blocks)
+                measured += 1
+                unflushed += 1
+                if unflushed >= _FLUSH_SONGS or mtime() - flushed_at >= _FLUSH_SECONDS:
+                    self._index.flush_loudness()
+                    unflushed = 0
+                    flushed_at = mtime()
+
+            self._index.flush_loudness()
+            info("measured loudness of {} songs".format(measured))
+
+    def gain_for(self, song):
+        '''
+        Gain in dB evening out the loudness of the given song, 0 as long as
+        it was not measured.
+        '''
+        album = []
+        for song_dict in self._index.album_songs(dirname(song.path)):
+            measurement = self._index.loudness(song_dict["path"], song_dict["mtime"], song_dict["size"])
+            if measurement is None:
+                album = None
+                break
+            album.append(measurement)
+
+        lufs = combine(album) if album else None
+        if lufs is None:
+            measurement = self._measurement(song)
+            lufs = measurement[0] if measurement is not None else None
+
+        return gain_in_db(lufs)
+
+    def terminate(self):
+        debug("loudness analyzer terminating.")
+        if self._analyze_thread is None:
+            return
+
+        self._stopped.set()
+        self._queue.put(None)
+        self._analyze_thread.join()
+        self._analyze_thread = None
@@ -0,0 +1,329 @@
+from io import BytesIO
+from logging import getLogger
+from struct import unpack, error as StructError
+
+debug = getLogger('   MP3Info').debug
+
+# Unsynchronised tags have to be read as a whole, bigger ones are left to eyed3
+_MAX_UNSYNCHRONISED_TAG_READ = 65536
+
+_ID3V1_SIZE = 128
+
+# ID3v2.3/2.4 frame ids and their ID3v2.2 counterparts
+_FRAMES = {
+    "TIT2": "title",
+    "TPE1": "artist",
+    "TALB": "album",
+    "TRCK": "track_num",
+    "TT2": "title",
+    "TP1": "artist",
+    "TAL": "album",
+    "TRK": "track_num",
+}
+
+_TEXT_ENCODINGS = ["latin-1", "utf-16", "utf-16-be", "utf-8"]
+
+# How far into the audio data to look for the first MPEG frame
+_MAX_SYNC_SEARCH = 16384
+
+# Bitrates in kbit/s by [MPEG1?][layer][index]
+_BITRATES = {
+    True: {
+        1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+        2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+        3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    },
+    False: {
+        1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+        2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+        3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    },
+}
+
+# Sample rates by version bits, 1 is reserved
+_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    0: [11025, 12000, 8000],
+}
+
+
+class UnsupportedTagError(Exception):
+    pass
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _decode_text(data):
+    if not data:
+        return None
+
+    encoding = data[0]
+    if encoding >= len(_TEXT_ENCODINGS):
+        raise UnsupportedTagError("unknown text encoding " + str(encoding))
+
+    text = data[1:].decode(_TEXT_ENCODINGS[encoding], errors="replace")
+    # ID3v2.4 separates multiple values by null characters, use the first one
+    return text.split("\x00")[0].strip()
+
+
+def _parse_track_num(text):
+    """
+    >>> _parse_track_num("3/12")
+    3
+    >>> _parse_track_num("07")
+    7
+    >>> _parse_track_num("A1") is None
+    True
+    """
+    if text is None:
+        return None
+    try:
+        return int(text.split("/")[0])
+    except ValueError:
+        return None
+
+
+def _parse_id3v2(head, f):
+    major = head[3]
+    flags = head[5]
+    tag_size = _syncsafe(head[6:10])
+
+    if major not in (2, 3, 4):
+        raise UnsupportedTagError("ID3v2.{} not supported".format(major))
+
+    tag_end = 10 + tag_size
+
+    # Tag wide unsynchronisation, only used by ID3v2.2 and ID3v2.3 in practice.
+    # Frame offsets are only known after resynchronising, so the tag is read
+    # as a whole in this case.
+    if flags & 0x80 and major < 4:
+        if tag_size > _MAX_UNSYNCHRONISED_TAG_READ:
+            raise UnsupportedTagError("unsynchronised tag too big")
+        data = f.read(tag_size).replace(b"\xff\x00", b"\xff")
+        f = BytesIO(data)
+        tag_end = len(data)
+    else:
+        f.seek(10)
+
+    if flags & 0x40 and major > 2:
+        size = f.read(4)
+        if major == 3:
+            f.seek(unpack(">I", size)[0], 1)
+        else:
+            f.seek(_syncsafe(size) - 4, 1)
+
+    id_length, header_length = (3, 6) if major == 2 else (4, 10)
+
+    tags = {}
+    while f.tell() + header_length <= tag_end and len(tags) < 4:
+        header = f.read(header_length)
+        if len(header) < header_length or header[0:1] == b"\x00":
+            # padding
+            break
+
+        if major == 2:
+            size = (header[3] << 16) | (header[4] << 8) | header[5]
+            frame_flags = 0
+        elif major == 3:
+            size = unpack(">I", header[4:8])[0]
+            frame_flags = header[9]
+        else:
+            size = _syncsafe(header[4:8])
+            frame_flags = header[9]
+
+        frame_id = header[0:id_length].decode("latin-1")
+        if frame_id not in _FRAMES:
+            # Skip other frames (e.g. cover images) without reading them
+            f.seek(size, 1)
+            continue
+
+        # compression/encryption in v2.3, additionally unsynchronisation and
+        # data length indicators in v2.4
+        if (major == 3 and frame_flags & 0xc0) or (major == 4 and frame_flags & 0x0f):
+            raise UnsupportedTagError("frame {} uses unsupported flags".format(frame_id))
+
+        tags[_FRAMES[frame_id]] = _decode_text(f.read(size))
+
+    if "track_num" in tags:
+        tags["track_num"] = _parse_track_num(tags["track_num"])
+
+    return tags, 10 + tag_size + (10 if flags & 0x10 else 0)
+
+
+def _parse_id3v1(data):
+    if len(data) != _ID3V1_SIZE or data[0:3] != b"TAG":
+        return None
+
+    def text(raw):
+        return raw.split(b"\x00")[0].decode("latin-1").strip()
+
+    tags = {
+        "title": text(data[3:33]),
+        "artist": text(data[33:63]),
+        "album": text(data[63:93]),
+        "track_num": None
+    }
+
+    # ID3v1.1 stores the track number in the last byte of the comment
+    if data[125] == 0 and data[126] != 0:
+        tags["track_num"] = data[126]
+
+    return tags
+
+
+def _parse_frame_header(header):
+    """
+    Returns (sample_rate, bitrate in bit/s, samples per frame, frame size in
+    bytes, side info size) of an MPEG audio frame header or None.
+
+    >>> _parse_frame_header(b"\\xff\\xfb\\x90\\x64")
+    (44100, 128000, 1152, 417, 32)
+    """
+    if len(header) < 4 or header[0] != 0xff or header[1] & 0xe0 != 0xe0:
+        return None
+
+    version = (header[1] >> 3) & 0x3
+    layer = 4 - ((header[1] >> 1) & 0x3)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x3
+    padding = (header[2] >> 1) & 0x1
+    mono = (header[3] >> 6) == 3
+
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    bitrate = _BITRATES[mpeg1][layer][bitrate_index] * 1000
+
+    if layer == 1:
+        samples_per_frame = 384
+        frame_size = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples_per_frame = 1152 if (layer == 2 or mpeg1) else 576
+        frame_size = samples_per_frame // 8 * bitrate // sample_rate + padding
+
+    if mpeg1:
+        side_info_size = 17 if mono else 32
+    else:
+        side_info_size = 9 if mono else 17
+
+    return sample_rate, bitrate, samples_per_frame, frame_size, side_info_size
+
+
+def read_stream_info(path):
+    """
+    Determines length in milliseconds and sample rate of an MP3 file from
+    its first frame. VBR files are expected to carry a Xing/Info or VBRI
+    header with the number of frames, otherwise a constant bitrate is
+    assumed.
+
+    Returns a tuple (length_in_millis, sample_rate) or None.
+
+    >>> read_stream_info("../audio/system/startup.mp3")
+    (3840, 44100)
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(10)
+            audio_start = 0
+            if head[0:3] == b"ID3":
+                audio_start = 10 + _syncsafe(head[6:10]) + (10 if head[5] & 0x10 else 0)
+
+            f.seek(0, 2)
+            audio_end = f.tell()
+            if audio_end >= _ID3V1_SIZE:
+                f.seek(-_ID3V1_SIZE, 2)
+                if f.read(3) == b"TAG":
+                    audio_end -= _ID3V1_SIZE
+
+            f.seek(audio_start)
+            data = f.read(_MAX_SYNC_SEARCH)
+    except (OSError, IndexError):
+        return None
+
+    # Find the first frame, making sure the following one is where it should be
+    pos = data.find(b"\xff")
+    while pos >= 0:
+        frame = _parse_frame_header(data[pos:pos + 4])
+        if frame is not None:
+            following = data[pos + frame[3]:pos + frame[3] + 4]
+            if len(following) < 4 or _parse_frame_header(following) is not None:
+                break
+        pos = data.find(b"\xff", pos + 1)
+    else:
+        debug("{}: no MPEG frame found".format(path))
+        return None
+
+    sample_rate, bitrate, samples_per_frame, frame_size, side_info_size = frame
+    frames = None
+
+    xing = pos + 4 + side_info_size
+    if data[xing:xing + 4] in (b"Xing", b"Info") and len(data) >= xing + 12 and data[xing + 7] & 0x1:
+        frames = unpack(">I", data[xing + 8:xing + 12])[0]
+
+    vbri = pos + 4 + 32
+    if data[vbri:vbri + 4] == b"VBRI" and len(data) >= vbri + 18:
+        frames = unpack(">I", data[vbri + 14:vbri + 18])[0]
+
+    if frames is not None:
+        length_in_millis = frames * samples_per_frame * 1000 // sample_rate
+    else:
+        audio_bytes = audio_end - audio_start - pos
+        length_in_millis = audio_bytes * 8 * 1000 // bitrate
+
+    return length_in_millis, sample_rate
+
+
+def read_tags(path):
+    """
+    Reads title, artist, album and track number of an MP3 file by looking
+    at the frame headers of its ID3v2 tag and its ID3v1 tag only. Bodies of
+    other frames, e.g. cover images, are skipped without reading them.
+
+    Returns a dict with the keys "title", "artist", "album" and
+    "track_num", an empty dict for MP3 files without any tag and None if
+    the file could not be understood, e.g. because it is no MP3 file at all
+    or uses tag features this reader does not support.
+
+    >>> read_tags("../audio/system/startup.mp3")
+    {}
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(10)
+            tags = None
+            audio_start = 0
+
+            if head[0:3] == b"ID3":
+                tags, audio_start = _parse_id3v2(head, f)
+
+            f.seek(0, 2)
+            file_size = f.tell()
+            if file_size >= _ID3V1_SIZE + audio_start:
+                f.seek(-_ID3V1_SIZE, 2)
+                v1_tags = _parse_id3v1(f.read(_ID3V1_SIZE))
+                if tags is None:
+                    tags = v1_tags
+                elif v1_tags is not None:
+                    for key, value in v1_tags.items():
+                        if tags.get(key) is None:
+                            tags[key] = value
+
+            if tags is not None:
+                return tags
+
+            # No tag at all, make sure this is MPEG audio
+            f.seek(audio_start)
+            sync = f.read(2)
+            if len(sync) == 2 and sync[0] == 0xff and sync[1] & 0xe0 == 0xe0:
+                return {}
+    except UnsupportedTagError as e:
+        debug("{}: {}".format(path, e))
+    except (IndexError, StructError, UnicodeDecodeError) as e:
+        debug("{}: broken tag, {}".format(path, repr(e)))
+
+    return None
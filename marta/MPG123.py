@@ -1,16 +1,58 @@
 from subprocess import Popen, PIPE, STDOUT
-from threading import Thread, Event
-from logging import getLogger
+from threading import Thread, RLock, Event
+from concurrent.futures import Future, TimeoutError
+from collections import deque
+import os
+from logging import getLogger, DEBUG
+from time import monotonic as mtime
+
+from Player import Player
+import Latency
 
 debug = getLogger('    MPG123').debug
 info = getLogger('    MPG123').info
 
 
-class MPG123Player(object):
-    STATE_STOPPED = 0
-    STATE_PAUSED = 1
-    STATE_PLAYING = 2
-    STATE_TERMINATED = 3
+def _debug_enabled():
+    return getLogger('    MPG123').isEnabledFor(DEBUG)
+
+
+class MPG123Player(Player):
+    """
+    Player backend remote controlling an mpg123 process.
+
+    In gapless mode the stop of a finished track is reported with the
+    queued track, once mpg123 plays it. A track stopped while mpg123 still
+    loads the queued one is reported stopped only once:
+
+    >>> import sys
+    >>> from queue import Queue
+    >>> from time import sleep
+    >>> command = MPG123Player._MPG123_COMMAND
+    >>> MPG123Player._MPG123_COMMAND = [sys.executable, "../sim/fake_mpg123.py", "--track-seconds", "0.5",
+    ...                                 "--load-seconds", "0.5"]
+    >>> songs = ["../audio/C01DDEADBEEF/album/music_{}.mp3".format(i) for i in range(3)]
+    >>> stops = Queue()
+    >>> player = MPG123Player(stops.put, None, gapless=True)
+    >>> player.load_track_from_file(songs[0], 500, 44100)
+    True
+    >>> player.queue_track(songs[1], 500, 44100)
+    >>> player.play_track()
+    >>> stops.get(timeout=3) == songs[1]
+    True
+    >>> player.queue_track(songs[2], 500, 44100)
+    >>> while player._current_state != MPG123Player.STATE_HANDOVER:
+    ...     sleep(0.01)
+    >>> player.stop_track()
+    >>> stops.get(timeout=3) is None
+    True
+    >>> sleep(0.5)
+    >>> stops.empty(), len(player._pending), player.is_track_playing()
+    (True, 0, False)
+    >>> player.terminate()
+    0
+    >>> MPG123Player._MPG123_COMMAND = command
+    """
 
     # The first interaction with mpg123 takes really long, so this constant will not be considered
     # but all subsequent commands will not take longer than this time
@@ -18,160 +60,520 @@ class MPG123Player(object):
 
     _DEFAULT_VOLUME = 50
     _DEFAULT_PITCH = 100
-    _MPG123_BINARY = "mpg123"
 
-    def __init__(self, on_stop_callback, on_error_callback, volume=_DEFAULT_VOLUME, pitch=_DEFAULT_PITCH):
+    # The locally tracked position is reconciled with mpg123's at most this often
+    _POSITION_RECONCILE_INTERVAL_IN_SECONDS = 5
+    _MPG123_BINARY = "mpg123"
+    _MPG123_COMMAND = ['sudo', '-upi', _MPG123_BINARY, "--remote"]
+
+    _READ_CHUNK_SIZE = 65536
+
+    # Prefixes of the lines mpg123 answers each command with
+    _RESPONSES = {
+        "SILENCE": ("@silence",),
+        "PROGRESS": ("@progress",),
+        "V": ("@V ",),
+        "PITCH": ("@PITCH ",),
+        "SAMPLE": ("@SAMPLE ",),
+        "K": ("@K ",),
+        "P": ("@P 1", "@P 2"),
+        "S": ("@P 0",),
+        "L": ("@P 2",),
+        "LP": ("@P 1",),
+    }
+
+    # mpg123 finished a track in gapless mode and loads the queued one
+    STATE_HANDOVER = 4
+
+    def __init__(self, on_stop_callback, on_error_callback, volume=_DEFAULT_VOLUME, pitch=_DEFAULT_PITCH, gapless=False,
+                 hot_standby=False, progress=False):
+        '''
+        on_stop_callback: called with the file mpg123 continued with in
+                          gapless mode, None if playback just stopped
+        on_error_callback: called when mpg123 died and could not be replaced
+        gapless: continue with the track given to queue_track() as soon as
+                 the current one finished, without waiting for anyone
+        hot_standby: keep a second mpg123 process running, which takes over
+                     current track and position if the first one dies.
+                     Where the audio device cannot be opened twice, e.g.
+                     an ALSA hw device without dmix, the standby may fail
+                     to take over while the dead process still holds it,
+                     a fresh process is tried then
+        progress: let mpg123 report its position with every frame instead
+                  of asking for it every now and then
+        '''
         self._ipc_timeout = 10
         self._current_state = MPG123Player.STATE_STOPPED
-        self._program_responded = Event()
+
+        # Commands waiting for their response: (expected prefixes, future)
+        self._pending = deque()
+        self._pending_lock = RLock()
 
         self._track_length_in_samples = 0
-        self._track_position_in_samples = 0
         self._track_length_in_millis = 0
+        # (position in samples, monotonic time) of the last play/pause/seek/
+        # pitch change or position report, positions are extrapolated from it
+        self._position_anchor = (0, mtime())
+        self._position_reconcile = None
+        self._sample_rate = None
 
         self._volume = None
+        self._actual_volume = None
+        self._gain = 1.0
         self._actual_program_pitch = MPG123Player._DEFAULT_PITCH
         self._pitch = MPG123Player._DEFAULT_PITCH
 
         self._current_file = None
+        self._gapless = gapless
+        self._queued_file = None
+        self._queued_track_info = (None, None)
+        # Future of the L continuing with the queued file, while its stop is
+        # still to be reported
+        self._handover = None
 
         self._on_stop_callback = on_stop_callback
         self._on_error_callback = on_error_callback
-        self._mpg123_process = Popen(['sudo', '-upi', MPG123Player._MPG123_BINARY, "--remote"], stdin=PIPE, stdout=PIPE, stderr=STDOUT, universal_newlines=True, bufsize=2)
-
-        self._read_sout_thread = Thread(target=self._read_sout)
-        self._read_sout_thread.daemon = True
-        self._read_sout_thread.start()
-        self._was_error = False
+        self._output_mode = 'PROGRESS' if progress else 'SILENCE'
+        # Output lines are dispatched by their first two characters
+        self._handlers = {
+            "@P": self._handle_play_state,
+            "@S": self._handle_stream_info,
+            "@K": self._handle_seek,
+            "@F": self._handle_frame,
+            "@V": self._handle_volume,
+            "@E": self._handle_ignored,
+            "@s": self._handle_ignored,
+            "@p": self._handle_ignored,
+            "@R": self._handle_ignored,
+        }
+        self._hot_standby = hot_standby
+        self._standby = None
+        self._mpg123_process, self._read_sout_thread, started = self._spawn_process()
 
-        # this prevents mpg123 from spamming the stdout with positional information
         self._ipc_timeout = MPG123Player._DEFAULT_IPC_TIMEOUT_IN_SECONDS
         # Wait for mpg123 bootup
-        self._program_responded.wait(self._ipc_timeout)
-        self._command('SILENCE')
+        started.wait(self._ipc_timeout)
+        # SILENCE prevents mpg123 from spamming the stdout with positional information
+        self._command(self._output_mode)
 
         self.set_volume(volume)
         self.set_pitch(pitch)
+
+        if hot_standby:
+            self._standby = self._spawn_process()
         debug("mpg123 initialized")
 
+    def _spawn_process(self):
+        '''
+        Starts an mpg123 process and a thread reading its output. Returns
+        the process, the thread and an Event set once mpg123 is up.
+        '''
+        process = Popen(MPG123Player._MPG123_COMMAND, stdin=PIPE, stdout=PIPE, stderr=STDOUT, bufsize=0)
+        started = Event()
+
+        read_sout_thread = Thread(target=self._read_sout, args=(process, started))
+        read_sout_thread.daemon = True
+        read_sout_thread.start()
+
+        return process, read_sout_thread, started
+
+    def _quit_process(self, spawned):
+        process, read_sout_thread, _ = spawned
+        try:
+            process.stdin.write(b'Q\n')
+            process.wait()
+        except:
+            process.terminate()
+        read_sout_thread.join()
+
+    def _playback_state(self):
+        '''
+        What a new process has to restore: file, whether it was playing,
+        position, length, sample rate and volume.
+        '''
+        sample_rate = int(round(self._sample_rate * 1000)) if self._sample_rate is not None else None
+        return (self._current_file, self.is_track_playing(),
+                self._samples_to_millis(self._get_position_in_samples()), self._track_length_in_millis,
+                sample_rate, self._volume)
+
+    def _take_over(self, spawned, playback):
+        '''
+        Lets a spawned process continue with the given playback state of
+        the dead one. Returns False if it could not, the dead process is
+        left in place then.
+        '''
+        process, read_sout_thread, started = spawned
+        if not started.wait(self._ipc_timeout) or process.poll() is not None:
+            info("new mpg123 not available")
+            return False
+
+        current_file, was_playing, position_in_millis, length_in_millis, sample_rate, volume = playback
+        dead = self._mpg123_process, self._read_sout_thread
+        self._mpg123_process = process
+        self._read_sout_thread = read_sout_thread
+        self._current_state = MPG123Player.STATE_STOPPED
+        self._current_file = None
+        self._volume = None
+        self._actual_volume = None
+        self._actual_program_pitch = MPG123Player._DEFAULT_PITCH
+
+        try:
+            self._command(self._output_mode)
+            if volume is not None:
+                self.set_volume(volume)
+
+            if current_file is not None:
+                if not self.load_track_from_file(current_file, length_in_millis, sample_rate):
+                    raise Exception("could not load " + current_file)
+                if position_in_millis:
+                    self.set_position_in_millis(position_in_millis)
+                if was_playing:
+                    self.play_track()
+        except Exception as e:
+            info("new mpg123 failed: " + str(e))
+            self._mpg123_process, self._read_sout_thread = dead
+            return False
+
+        return True
+
+    def _replace_process(self):
+        '''
+        Continues with the standby process once mpg123 died, or with a
+        fresh one if the standby fails, e.g. because the audio device is
+        still busy. Runs in its own thread, as the reader thread of the
+        dead process must not wait for responses. Reports an error if
+        neither works or there is no standby.
+        '''
+        standby = self._standby
+        self._standby = None
+        if standby is not None:
+            playback = self._playback_state()
+            info("swapping in standby mpg123")
+            if self._take_over(standby, playback):
+                self._standby = self._spawn_process()
+                return
+            self._quit_process(standby)
+
+            info("spawning a new mpg123")
+            spawned = self._spawn_process()
+            if self._take_over(spawned, playback):
+                self._standby = self._spawn_process()
+                return
+            self._quit_process(spawned)
+
+        if self._on_error_callback is not None:
+            self._on_error_callback()
+
     def _mpg123_input(self, line):
-        debug("< " + str(line))
-
-        if line.startswith("@silence"):
-            debug("mpg123 now silenced")
-            self._program_responded.set()
-        if line.startswith('@R MPG123'):
-            debug("mpg123 startup")
-            self._program_responded.set()
+        handler = self._handlers.get(line[0:2])
+        if handler is None:
+            if _debug_enabled():
+                debug("< " + line)
             return
 
-        if line.startswith('@E '):
-            self._was_error = True
-            self._program_responded.set()
+        # @F lines arrive many times a second in progress mode and neither
+        # answer commands nor are worth logging
+        if line[1] == 'F':
+            handler(line)
+            return
+
+        if _debug_enabled():
+            debug("< " + line)
+
+        # Update the state first, so it is up to date once waiting callers continue
+        handler(line)
+        if self._pending:
+            self._resolve_pending(line)
+
+    def _resolve_pending(self, line):
+        with self._pending_lock:
+            if line.startswith('@E '):
+                # Errors are answered in order, so it belongs to the oldest command
+                while self._pending:
+                    _, future = self._pending.popleft()
+                    if future.set_running_or_notify_cancel():
+                        future.set_result(False)
+                        break
+                return
+
+            for entry in list(self._pending):
+                prefixes, future = entry
+                if line.startswith(prefixes):
+                    self._pending.remove(entry)
+                    # A cancelled command must not take the response of a
+                    # later one
+                    if future.set_running_or_notify_cancel():
+                        future.set_result(True)
+                        break
+
+    def _handle_ignored(self, line):
+        pass
+
+    def _handle_play_state(self, line):
+        if line.startswith('@PITCH '):
+            self._handle_pitch(line)
             return
 
         if line.startswith('@P 0'):
+            queued_file = self._queued_file
+            self._queued_file = None
+            if queued_file is not None:
+                self._hand_over(queued_file)
+                return
+
+            # mpg123 confirms a stop that was reported already, e.g. after
+            # a failed handover
+            if self._current_state == MPG123Player.STATE_STOPPED and self._current_file is None:
+                debug("already stopped")
+                return
+
             self._current_state = MPG123Player.STATE_STOPPED
-            self._program_responded.set()
             self._current_file = None
-            self._on_stop_callback()
+            self._anchor_position(0)
+            self._on_stop_callback(None)
             debug("state=STOPPED")
             return
 
         if line.startswith('@P 1'):
+            self._anchor_position(self._get_position_in_samples())
             self._current_state = MPG123Player.STATE_PAUSED
             debug("state=PAUSED")
-            self._program_responded.set()
             return
 
         if line.startswith('@P 2'):
+            self._anchor_position(self._get_position_in_samples())
             self._current_state = MPG123Player.STATE_PLAYING
             debug("state=PLAYING")
-            self._program_responded.set()
             return
 
+    def _hand_over(self, queued_file):
+        '''
+        Continues with the queued file once mpg123 finished the current one.
+        The stop is reported with the queued file once mpg123 plays it,
+        unless stop_track() or load_track_from_file() come first.
+        '''
+        self._current_state = MPG123Player.STATE_HANDOVER
+        self._current_file = queued_file
+        debug("state=HANDOVER")
+        try:
+            # This is the reader thread, so the responses are not waited for
+            self._handover = self._send('L ' + queued_file)
+            length_in_millis, sample_rate = self._queued_track_info
+            if length_in_millis is not None and sample_rate is not None:
+                self._set_track_info(length_in_millis, sample_rate)
+            else:
+                self._anchor_position(0)
+                self._send('SAMPLE')
+        except OSError as e:
+            info("could not continue with {}: {}".format(queued_file, e))
+            self._handover = None
+            self._stopped_after_handover()
+            return
+
+        handover = self._handover
+        handover.add_done_callback(lambda f: self._handed_over(queued_file, handover))
+
+    def _handed_over(self, queued_file, handover):
+        if handover is not self._handover:
+            debug("handover to {} taken over".format(queued_file))
+            return
+
+        self._handover = None
+        if not handover.cancelled() and handover.result():
+            debug("state=PLAYING (gapless)")
+            self._on_stop_callback(queued_file)
+            return
+
+        info("could not continue with " + queued_file)
+        self._stopped_after_handover()
+
+    def _stopped_after_handover(self):
+        self._current_state = MPG123Player.STATE_STOPPED
+        self._current_file = None
+        self._anchor_position(0)
+        self._on_stop_callback(None)
+        debug("state=STOPPED")
+
+    def _handle_pitch(self, line):
+        line = line.split(' ')[1]
+        # Samples played so far were played at the old speed
+        self._anchor_position(self._get_position_in_samples())
+        self._actual_program_pitch = round((float(line) + 1) * 100)
+        debug("pitch: %f", self._actual_program_pitch)
+
+    def _handle_stream_info(self, line):
         if line.startswith('@SAMPLE '):
-            line = line[8:-1]
-            line = line.split(' ')
-            self._track_position_in_samples = int(line[0])
-            debug("current position: %d", self._track_position_in_samples)
+            line = line[8:].split(' ')
+            self._anchor_position(int(line[0]))
+            debug("current position: %s", line[0])
             self._track_length_in_samples = int(line[1])
-            self._program_responded.set()
+            if self._sample_rate is not None:
+                self._track_length_in_millis = int(round(self._track_length_in_samples / self._sample_rate))
             return
 
         if line.startswith('@S '):
-            self._expecting_input = False
             sample_rate = int(line.split(" ")[3]) / float(1000)
+            self._sample_rate = sample_rate
             self._track_length_in_millis = int(round(self._track_length_in_samples / sample_rate))
             debug("track length: %d", self._track_length_in_millis)
-            self._program_responded.set()
             return
 
-        if line.startswith('@K '):
-            self._program_responded.set()
-            return
+    def _handle_seek(self, line):
+        try:
+            self._anchor_position(int(line[3:]))
+        except ValueError:
+            pass
 
-        if line.startswith('@V '):
-            line = line[3:-1]
-            line = line.split('%')[0]
-            self._volume = float(line)
-            debug("volume: %f", self._volume)
-            self._program_responded.set()
+    def _handle_frame(self, line):
+        # @F <frame> <frames left> <seconds> <seconds left>
+        if self._sample_rate is None:
             return
-
-        if line.startswith('@PITCH '):
-            line = line.split(' ')[1]
-            self._actual_program_pitch = round((float(line) + 1) * 100)
-            debug("pitch: %f", self._actual_program_pitch)
-            self._program_responded.set()
-            return
-
-    def _read_sout(self):
+        try:
+            self._anchor_position(int(float(line.split(' ')[3]) * 1000 * self._sample_rate))
+        except (IndexError, ValueError):
+            pass
+
+    def _handle_volume(self, line):
+        line = line[3:].split('%')[0]
+        self._actual_volume = float(line)
+        debug("volume: %f", self._actual_volume)
+
+    def _read_sout(self, process, started):
+        # mpg123's output is read in big chunks and split into lines here,
+        # which is a lot cheaper than a readline() per line in progress mode
+        fd = process.stdout.fileno()
+        rest = b''
         while True:
-            line = self._mpg123_process.stdout.readline()
-            # TODO a wee bit hacky, but seems to work more reliable
-            # than using poll()
-            if len(line) == 0:
+            try:
+                chunk = os.read(fd, MPG123Player._READ_CHUNK_SIZE)
+            except OSError:
+                chunk = b''
+            if not chunk:
                 break
-            self._mpg123_input(line)
+
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+
+            if not started.is_set():
+                if any(line.startswith(b'@R MPG123') for line in lines):
+                    started.set()
+
+            # The standby process is not listened to until it is swapped in
+            if process is not self._mpg123_process:
+                continue
+
+            # Of several frame lines in a row only the last one matters
+            for i, line in enumerate(lines):
+                if line.startswith(b'@F ') and i + 1 < len(lines) and lines[i + 1].startswith(b'@F '):
+                    continue
+                self._mpg123_input(line.decode('utf-8', 'replace').rstrip('\r'))
+
+        if process is not self._mpg123_process:
+            debug("standby mpg123 died")
+            return
 
         info("mpg123 died")
 
-        if self._on_error_callback is not None:
-            self._on_error_callback()
+        # Nobody is going to answer these anymore
+        with self._pending_lock:
+            while self._pending:
+                _, future = self._pending.popleft()
+                if future.set_running_or_notify_cancel():
+                    future.set_result(False)
 
-        self._program_responded.set()
+        if self._current_state == MPG123Player.STATE_TERMINATED:
+            return
 
-    def _command(self, command):
-        self._program_responded.clear()
+        replace_thread = Thread(target=self._replace_process)
+        replace_thread.daemon = True
+        replace_thread.start()
+
+    def _expect(self, prefixes):
+        future = Future()
+        with self._pending_lock:
+            self._pending.append((prefixes, future))
+        return future
+
+    def _write(self, command):
         debug("> " + str(command))
-        self._mpg123_process.stdin.write(command + '\n')
-        self._mpg123_process.stdin.flush()
+        with self._pending_lock:
+            self._mpg123_process.stdin.write((command + '\n').encode())
+
+    def _send(self, command):
+        '''
+        Sends a command without waiting for its response. Returns a future
+        resolving to True once the expected response arrived, or to False
+        if mpg123 answered with an error.
+        '''
+        name = command.split(' ')[0]
+        prefixes = MPG123Player._RESPONSES[name]
+        # Keep the order of pending commands in sync with the order of writes
+        with self._pending_lock:
+            future = self._expect(prefixes)
+            sent_at = mtime()
+            self._write(command)
+        future.add_done_callback(lambda f: self._record_latency(name, sent_at, f))
+        return future
+
+    def _record_latency(self, name, sent_at, future):
+        if future.cancelled() or not future.result():
+            return
 
-        debug("waiting for max " + str(self._ipc_timeout) + " seconds")
-        self._program_responded.wait(self._ipc_timeout)
-        if not self._program_responded.isSet():
-            raise Exception("timeout: " + str(self._ipc_timeout) + " sec")
+        Latency.record("player." + name, mtime() - sent_at)
+        if name == 'P' and self._current_state == MPG123Player.STATE_PLAYING:
+            Latency.record_since_event("input_to_audio")
 
-        if self._was_error:
-            self._was_error = False
-            return False
+    def _wait(self, futures):
+        '''
+        Waits for all given futures, returns True if none of the commands failed.
+        The timeout applies to the whole batch, not to each command.
+        '''
+        debug("waiting for max " + str(self._ipc_timeout) + " seconds")
+        deadline = mtime() + self._ipc_timeout
+        okay = True
+        for future in futures:
+            try:
+                okay = future.result(max(0, deadline - mtime())) and okay
+            except TimeoutError:
+                self._forget(futures)
+                raise Exception("timeout: " + str(self._ipc_timeout) + " sec")
+        return okay
+
+    def _forget(self, futures):
+        '''
+        Cancels the given futures and stops expecting their responses.
+        '''
+        with self._pending_lock:
+            for future in futures:
+                future.cancel()
+            self._pending = deque(entry for entry in self._pending if entry[1] not in futures)
 
-        return True
+    def _command(self, command):
+        return self._wait([self._send(command)])
 
     def is_track_playing(self):
-        return self._current_state == MPG123Player.STATE_PLAYING
+        return self._current_state in (MPG123Player.STATE_PLAYING, MPG123Player.STATE_HANDOVER)
 
     def get_volume(self):
         return self._volume
 
     def set_volume(self, volume):
-        if volume < 0:
+        if volume < Player.MIN_VOLUME:
             raise ValueError("Out of bounds!")
-        elif volume > 100:
+        elif volume > Player.MAX_VOLUME:
             raise ValueError("Out of bounds!")
 
-        if volume == self._volume:
+        self._volume = volume
+        self._apply_volume()
+
+    def set_gain(self, gain_in_db):
+        self._gain = 10 ** (gain_in_db / 20.0)
+        if self._volume is not None:
+            self._apply_volume()
+
+    def _apply_volume(self):
+        volume = min(Player.MAX_VOLUME, round(self._volume * self._gain, 2))
+        if self._actual_volume is not None and abs(volume - self._actual_volume) < 0.01:
             debug("volume already set")
             return
 
@@ -181,9 +583,9 @@ class MPG123Player(object):
         return self._pitch
 
     def set_pitch(self, pitch):
-        if pitch < 50:
+        if pitch < Player.MIN_PITCH:
             raise ValueError("Out of bounds!")
-        elif pitch > 200:
+        elif pitch > Player.MAX_PITCH:
             raise ValueError("Out of bounds!")
 
         self._pitch = pitch
@@ -196,13 +598,48 @@ class MPG123Player(object):
 
         self._command('PITCH ' + pitch)
 
+    def _anchor_position(self, position_in_samples):
+        self._position_anchor = (position_in_samples, mtime())
+
     def _get_position_in_samples(self):
-        self._command('SAMPLE')
-        return self._track_position_in_samples, self._track_length_in_samples
+        '''
+        Extrapolates the position from the last anchor, mpg123 is not asked.
+        '''
+        position_in_samples, anchor_time = self._position_anchor
+        if self._current_state != MPG123Player.STATE_PLAYING or self._sample_rate is None:
+            return position_in_samples
+
+        elapsed_in_millis = (mtime() - anchor_time) * 1000
+        position_in_samples += elapsed_in_millis * self._sample_rate * self._actual_program_pitch / 100
+        if self._track_length_in_samples:
+            position_in_samples = min(position_in_samples, self._track_length_in_samples)
+        return int(position_in_samples)
+
+    def _reconcile_position(self):
+        '''
+        Asks mpg123 for its position without waiting for the answer, if the
+        anchor got old and no such request is underway.
+        '''
+        _, anchor_time = self._position_anchor
+        if mtime() - anchor_time < MPG123Player._POSITION_RECONCILE_INTERVAL_IN_SECONDS:
+            return
+        if self._position_reconcile is not None and not self._position_reconcile.done():
+            return
+
+        try:
+            self._position_reconcile = self._send('SAMPLE')
+        except (OSError, ValueError) as e:
+            debug("could not reconcile position: " + str(e))
 
     def get_position_in_millis(self):
-        current_pos, length = self._get_position_in_samples()
-        return int(round((float(current_pos) / length) * self._track_length_in_millis))
+        if self._current_state == MPG123Player.STATE_PLAYING:
+            self._reconcile_position()
+        return self._samples_to_millis(self._get_position_in_samples())
+
+    def _samples_to_millis(self, samples):
+        if not self._sample_rate:
+            return 0
+        return int(round(samples / self._sample_rate))
 
     def set_position_in_millis(self, position_in_millis):
         position_in_millis /= float(self._track_length_in_millis)+0.5
@@ -212,7 +649,38 @@ class MPG123Player(object):
     def get_track_length_in_millis(self):
         return self._track_length_in_millis
 
-    def load_track_from_file(self, file_name):
+    def _set_track_info(self, length_in_millis, sample_rate):
+        self._sample_rate = sample_rate / float(1000)
+        self._track_length_in_millis = length_in_millis
+        self._track_length_in_samples = int(round(length_in_millis * self._sample_rate))
+        self._anchor_position(0)
+
+    def queue_track(self, file_name, length_in_millis=None, sample_rate=None):
+        '''
+        Sets the track to continue with in gapless mode once the current
+        one finished, ignored otherwise. See load_track_from_file() for the
+        optional track info.
+
+        The stop of the finished track is reported with the queued file,
+        once mpg123 plays it. Tracks loaded or stopped before then take
+        over, the stop is not reported on its own.
+        '''
+        if not self._gapless:
+            return
+
+        debug("queued " + str(file_name))
+        self._queued_track_info = (length_in_millis, sample_rate)
+        self._queued_file = file_name
+
+    def load_track_from_file(self, file_name, length_in_millis=None, sample_rate=None):
+        '''
+        Loads a track, paused at its beginning. If its length and sample rate
+        are known, e.g. from the library, they are used right away. Otherwise
+        the track is played silently for a moment to make mpg123 tell them.
+        '''
+        self._queued_file = None
+        self._handover = None
+
         if file_name == self._current_file:
             debug("file already loaded")
             return
@@ -222,16 +690,21 @@ class MPG123Player(object):
         if not okay:
             return False
 
-        self._get_position_in_samples()
-        # Forcing '@S ...' output in order to get the track's length in ms
-
-        volume_before = self._volume
-        self.set_volume(0)
-        self.play_track()
-        self.pause_track()
-        self.set_volume(volume_before)
-
-        self.set_position_in_millis(0)
+        if length_in_millis is not None and sample_rate is not None:
+            self._set_track_info(length_in_millis, sample_rate)
+            if self._pitch != self._actual_program_pitch:
+                self.set_pitch(self._pitch)
+            return True
+
+        # Forcing '@S ...' output in order to get the track's length in ms.
+        # After LP mpg123 is paused, so the two toggles play and pause again.
+        # All of this is sent at once and only waited for in the end.
+        volume_before = self._actual_volume
+        futures = [self._send('SAMPLE'), self._send('V 0'), self._send('P'), self._send('P')]
+        if volume_before is not None:
+            futures.append(self._send('V ' + str(volume_before)))
+        futures.append(self._send('K 0'))
+        self._wait(futures)
 
         if self._pitch != self._actual_program_pitch:
             self.set_pitch(self._pitch)
@@ -242,7 +715,7 @@ class MPG123Player(object):
         self._command('P')
 
     def play_track(self):
-        if self._current_state == MPG123Player.STATE_PLAYING:
+        if self.is_track_playing():
             debug("already playing")
             return
 
@@ -253,9 +726,17 @@ class MPG123Player(object):
             debug("already paused")
             return
 
+        # mpg123 does not answer a pause without a track
+        if self._current_state == MPG123Player.STATE_STOPPED:
+            debug("nothing to pause")
+            return
+
         self.toggle()
 
     def stop_track(self):
+        self._queued_file = None
+        self._handover = None
+
         if self._current_state == MPG123Player.STATE_STOPPED:
             debug("already stopped")
             return
@@ -270,12 +751,18 @@ class MPG123Player(object):
 
         self._on_error_callback = None
         self._current_state = MPG123Player.STATE_TERMINATED
+
+        if self._standby is not None:
+            standby = self._standby
+            self._standby = None
+            self._quit_process(standby)
+
         if self._mpg123_process.returncode is None:
             # This strange construct is half of a historical artifact from python 3
             # and can probably be destroyed and hopefully be forgotten.
             # On the other hand: I don't know what happens then and at this point I'm too afraid to ask (or test).
             try:
-                self._command('Q')
+                self._write('Q')
                 self._mpg123_process.wait()
             except:
                 try:
@@ -298,7 +785,7 @@ def main():
     from SetupLogging import setup_stdout_logging
     setup_stdout_logging()
 
-    player = MPG123Player(lambda: debug("song stopped"), lambda: debug("error"), 50)
+    player = MPG123Player(lambda next_file: debug("song stopped, next: " + str(next_file)), lambda: debug("error"), 50)
 
     debug("enter song file path")
     mp3_path = input()
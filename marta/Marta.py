@@ -2,10 +2,9 @@
 from logging import handlers, getLogger, DEBUG, INFO, Formatter, StreamHandler
 from sys import stdout, argv
 from queue import Queue, Empty
-from time import sleep, strftime
-from signal import signal, SIGINT
+from time import sleep, strftime, monotonic as mtime
+from signal import signal, SIGINT, SIGUSR1
 from os import environ
-from monotonic import monotonic as mtime
 import traceback
 import os
 import pwd
@@ -14,12 +13,14 @@ import Buttons
 from MartaHandler import MartaHandler
 from LEDStrip import LEDStrip
 from MPG123 import MPG123Player
+from Prefetcher import Prefetcher
 from MPU import MPU
 from RFIDReader import RFIDReader
 from TagToHandler import TAG_TO_HANDLER
 from Library import Library, LibraryAPI
 from Web import WebServer
-from EventManager import Server, QueueManager
+from EventManager import EventBus, BridgeServer
+import Latency
 
 debug = getLogger('     Marta').debug
 info = getLogger('     Marta').info
@@ -39,6 +40,7 @@ class Marta(object):
     EVENT_WEB_MUSIC = 6
     EVENT_WEB_POWER = 7
     EVENT_WEB_RFID = 8
+    EVENT_CHECKPOINT = 9
 
     EXIT_DEBUG = 2
 
@@ -51,7 +53,8 @@ class Marta(object):
         "EVENT_INTERRUPT",
         "EVENT_WEB_MUSIC",
         "EVENT_WEB_POWER",
-        "EVENT_WEB_RFID"
+        "EVENT_WEB_RFID",
+        "EVENT_CHECKPOINT"
     ]
 
     ################
@@ -68,13 +71,19 @@ class Marta(object):
 
     def __init__(self, username):
 
-        library_api_web = LibraryAPI()
-        self.library = Library(MARTA_BASE_DIR + "/audio/")
-        self.library_api = LibraryAPI(self.library)
+        self.__message_queue = EventBus.named("marta")
 
-        self.__queue_manager = QueueManager.manager()
+        # The web process posts events and talks to the library via this
+        self.bridge = BridgeServer()
+        self.bridge.register_bus("marta")
+        # The LED process reports its latencies, the web process asks for them
+        self.bridge.register("latency", Latency.record)
+        self.bridge.register("latency_report", Latency.report)
 
-        self.__message_queue = self.__queue_manager.get_marta()
+        self.library = Library(MARTA_BASE_DIR + "/audio/")
+        self.library_api = LibraryAPI(self.library, bridge=self.bridge)
+        # Checkpoints are taken by the message loop, see EVENT_CHECKPOINT
+        self.library.checkpointer.start(lambda: self.__message_queue.put([Marta.EVENT_CHECKPOINT]))
 
         self.leds = LEDStrip()
         Buttons.setup_gpio(lambda pin, millis: self.__message_queue.put([Marta.EVENT_BUTTON, pin, millis]))
@@ -84,10 +93,17 @@ class Marta(object):
             info("Early user interrupt!")
             exit(Marta.EXIT_DEBUG)
 
-        self.player = MPG123Player(lambda: self.__message_queue.put([Marta.EVENT_SONG_STOPPED]),
-                                   lambda: self.__message_queue.put([Marta.EVENT_MPG123_ERROR]),
-                                   volume=Marta.SYSTEM_SOUND_VOLUME)
+        on_stop = lambda next_file: self.__message_queue.put([Marta.EVENT_SONG_STOPPED, next_file])
+        on_error = lambda: self.__message_queue.put([Marta.EVENT_MPG123_ERROR])
+        if environ.get("MARTA_PLAYER") == "libmpg123":
+            from LibMPG123Player import LibMPG123Player
+            self.player = LibMPG123Player(on_stop, on_error, volume=Marta.SYSTEM_SOUND_VOLUME, gapless=True)
+        else:
+            self.player = MPG123Player(on_stop, on_error, volume=Marta.SYSTEM_SOUND_VOLUME, gapless=True,
+                                       hot_standby=environ.get("MARTA_HOT_STANDBY") == "1")
+
 
+        self.prefetcher = Prefetcher()
 
         self.player.load_track_from_file(Marta.START_SOUND_PATH)
         self.leds.startup()
@@ -137,7 +153,7 @@ class Marta(object):
             timeout = max_mono_time - now
             debug("waiting for " + str(timeout))
             try:
-                msg = self.__message_queue.get(block=True, timeout=timeout)
+                posted_at, msg = self.__message_queue.get_timed(block=True, timeout=timeout)
             except Empty:
                 # If a time change (due to network time availability) occurs while waiting for an event,
                 # Queue.get will return Empty early:
@@ -153,6 +169,9 @@ class Marta(object):
                 debug("possible timeout @ " + str(mtime()))
                 continue
 
+            handling_started_at = mtime()
+            Latency.record("queue", handling_started_at - posted_at)
+
             event = msg[0]
             params = msg[1:]
 
@@ -182,10 +201,11 @@ class Marta(object):
                     current_handler.initialize()
 
             debug(Marta.EVENT_HUMAN_READABLE[event] + ": " + str(params))
+            Latency.event_started(posted_at)
             if event == Marta.EVENT_ROTATION:
                 return_val = current_handler.rotation_event(params[0], params[1])
             elif event == Marta.EVENT_SONG_STOPPED:
-                return_val = current_handler.player_stop_event()
+                return_val = current_handler.player_stop_event(params[0])
             elif event == Marta.EVENT_RFID_TAG:
                 return_val = current_handler.rfid_tag_event(params[0])
             elif event == Marta.EVENT_BUTTON:
@@ -195,8 +215,14 @@ class Marta(object):
                 music_hanlder.web_command(params)
                 # self. HIER BAUSTELLE
                 return_val = None
+            elif event == Marta.EVENT_CHECKPOINT:
+                # Playback belongs to the music handler, whichever handler is active
+                TAG_TO_HANDLER["default"].get_instance(self).checkpoint_event()
+                return_val = None
             else:
                 raise Exception("Unknown event: " + str(event))
+            Latency.event_finished()
+            Latency.record("handler." + Marta.EVENT_HUMAN_READABLE[event], mtime() - handling_started_at)
 
             if return_val is None:
                 debug("not changing the timeout")
@@ -248,6 +274,21 @@ class Marta(object):
         except:
             pass
 
+        try:
+            self.prefetcher.terminate()
+        except:
+            pass
+
+        try:
+            self.library.terminate()
+        except:
+            pass
+
+        try:
+            self.bridge.terminate()
+        except:
+            pass
+
         try:
             self.leds.terminate()
         except:
@@ -267,11 +308,6 @@ class Marta(object):
 
 
 def main():
-    queueserver = Server()
-    queueserver.start()
-    sleep(1)
-    qm = QueueManager.manager()
-
     logger = getLogger('')
     logger.setLevel(INFO)
     formatter = Formatter("%(asctime)s.%(msecs)03d | %(name)s |    %(message)s", "%H:%M:%S")
@@ -326,6 +362,7 @@ def main():
     debug("initializing")
     marta = Marta("pi")
     signal(SIGINT, lambda s, f: marta.interrupt())
+    signal(SIGUSR1, lambda s, f: Latency.log_report())
 
     debug("looping")
     try:
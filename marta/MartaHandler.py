@@ -1,7 +1,3 @@
-from EventManager import QueueManager
-
-QueueManager.make_queue("marta")
-
 class MartaHandler(object):
     EVENT_HANDLER_DONE = -1
 
@@ -20,7 +16,7 @@ class MartaHandler(object):
     def rotation_event(self, x, y):
         return
 
-    def player_stop_event(self):
+    def player_stop_event(self, next_file=None):
         return
 
     def button_event(self, pin, millis):
@@ -53,7 +53,10 @@ class MusicHandler(MartaHandler):
         super(MusicHandler, self).__init__(marta)
         self.currently_controlling = MusicHandler.CONTROL_VOLUME
         self.current_tag = None
+        self.current_playlist = None
         self.expected_stop = False
+        # Song the player continues with in gapless mode
+        self.queued_path = None
 
         if exists(MusicHandler.UNKNOWN_TAG_FILE):
             debug("unknown tag file exists. removing")
@@ -71,11 +74,35 @@ class MusicHandler(MartaHandler):
 
         if self.current_playlist:
             debug("Saving state.")
-            self.current_playlist.save_state(position=self.marta.player.get_position_in_millis())
+            position = self.marta.player.get_position_in_millis()
+            self.current_playlist.save_state(position=position)
+            self._record_checkpoint(position)
 
+        self.queued_path = None
         self.expected_stop = True
         self.marta.player.stop_track()
 
+    def checkpoint_event(self):
+        '''
+        The checkpointer asks for a checkpoint every now and then. It is
+        taken here in the message loop, so playlist, album and position
+        fit together, and written in the checkpointer's thread.
+        '''
+        if not self.current_playlist or not self.marta.player.is_track_playing():
+            return
+        self.marta.library.checkpointer.submit(self._make_checkpoint(self.marta.player.get_position_in_millis()))
+
+    def _make_checkpoint(self, position):
+        checkpoint = self.current_playlist.checkpoint()
+        if checkpoint is not None:
+            checkpoint["position"] = position
+        return checkpoint
+
+    def _record_checkpoint(self, position):
+        checkpoint = self._make_checkpoint(position)
+        if checkpoint is not None:
+            self.marta.library.checkpointer.record(checkpoint)
+
     def load_state(self, tag):
         debug("Loading state.")
 
@@ -110,6 +137,18 @@ class MusicHandler(MartaHandler):
         self.save_state_and_stop()
         return MusicHandler.SHORT_TIMEOUT
 
+    def _load_song(self, song):
+        self.marta.prefetcher.loaded(song.path)
+        self.marta.player.set_gain(self.marta.library.gain_for(song))
+        self.marta.player.load_track_from_file(song.path, song.length_millis, song.sample_rate)
+
+    def _prepare_next_song(self):
+        next_song = self.current_playlist.peek_next_song()
+        self.queued_path = next_song.path if next_song is not None else None
+        if next_song is not None:
+            self.marta.prefetcher.prefetch(next_song.path)
+            self.marta.player.queue_track(next_song.path, next_song.length_millis, next_song.sample_rate)
+
     def _play_currently_selected_song(self, current_position = 0):
         if not self.current_playlist:
             info("Tried to play without a playlist?!")
@@ -117,17 +156,19 @@ class MusicHandler(MartaHandler):
 
         cur_song = self.current_playlist.cur_song()
 
+        self.queued_path = None
         if self.marta.player.is_track_playing():
             self.expected_stop = True
             self.marta.player.stop_track()
 
-        self.marta.player.load_track_from_file(cur_song.path)
+        self._load_song(cur_song)
         if current_position != 0:
             self.marta.player.set_position_in_millis(current_position)
 
         self.show_playlist_progress()
 
         self.marta.player.play_track()
+        self._prepare_next_song()
 
     def rfid_music_tag_event(self, tag):
         current_position = self.load_state(tag)
@@ -191,10 +232,17 @@ class MusicHandler(MartaHandler):
         self.marta.leds.fade_up_and_down(LEDStrip.BLUE)
         info("now controlling volume")
 
-    def player_stop_event(self):
+    def player_stop_event(self, next_file=None):
         '''
-        Called when a song stopped playing, reported by MPG123
+        Called when a song stopped playing, reported by MPG123. In gapless
+        mode next_file is the queued song the player already continued with.
         '''
+        # The player continued with a song queued before another one was
+        # loaded or playback stopped, the stop that caused is still to come
+        if next_file is not None and next_file != self.queued_path:
+            debug("ignoring the continuation with a song no longer queued")
+            return
+
         if self.expected_stop:
             self.expected_stop = False
             debug("ignoring this event because stopping is expected")
@@ -208,8 +256,13 @@ class MusicHandler(MartaHandler):
 
         self.show_playlist_progress()
 
-        self.marta.player.load_track_from_file(cur_song.path)
-        self.marta.player.play_track()
+        if next_file is not None and cur_song is not None and cur_song.path == next_file:
+            self.marta.prefetcher.loaded(cur_song.path)
+            self.marta.player.set_gain(self.marta.library.gain_for(cur_song))
+        else:
+            self._load_song(cur_song)
+            self.marta.player.play_track()
+        self._prepare_next_song()
 
     def button_red_green_event(self, pin, millis):
         if self.currently_controlling == MusicHandler.CONTROL_VOLUME:
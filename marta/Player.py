@@ -0,0 +1,71 @@
+class Player(object):
+    """
+    Interface of all player backends, see MPG123Player and LibMPG123Player.
+
+    Constructors take on_stop_callback and on_error_callback first.
+    on_stop_callback is called with the file playback continued with in
+    gapless mode, or with None whenever playback stopped, including after
+    stop_track(). on_error_callback is called when the backend died for good.
+    """
+    STATE_STOPPED = 0
+    STATE_PAUSED = 1
+    STATE_PLAYING = 2
+    STATE_TERMINATED = 3
+
+    MIN_VOLUME = 0
+    MAX_VOLUME = 100
+
+    MIN_PITCH = 50
+    MAX_PITCH = 200
+
+    def is_track_playing(self):
+        raise NotImplementedError()
+
+    def get_volume(self):
+        raise NotImplementedError()
+
+    def set_volume(self, volume):
+        raise NotImplementedError()
+
+    def set_gain(self, gain_in_db):
+        '''
+        Scales the volume actually played at, e.g. to even out loudness
+        differences between tracks. get_volume() is not affected.
+        '''
+        raise NotImplementedError()
+
+    def get_pitch(self):
+        raise NotImplementedError()
+
+    def set_pitch(self, pitch):
+        raise NotImplementedError()
+
+    def get_position_in_millis(self):
+        raise NotImplementedError()
+
+    def set_position_in_millis(self, position_in_millis):
+        raise NotImplementedError()
+
+    def get_track_length_in_millis(self):
+        raise NotImplementedError()
+
+    def queue_track(self, file_name, length_in_millis=None, sample_rate=None):
+        raise NotImplementedError()
+
+    def load_track_from_file(self, file_name, length_in_millis=None, sample_rate=None):
+        raise NotImplementedError()
+
+    def toggle(self):
+        raise NotImplementedError()
+
+    def play_track(self):
+        raise NotImplementedError()
+
+    def pause_track(self):
+        raise NotImplementedError()
+
+    def stop_track(self):
+        raise NotImplementedError()
+
+    def terminate(self):
+        raise NotImplementedError()
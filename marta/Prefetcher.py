@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from queue import Queue
+from threading import Thread, Lock
+from logging import getLogger
+import os
+
+debug = getLogger('Prefetcher').debug
+info = getLogger('Prefetcher').info
+
+
+class Prefetcher(object):
+    """
+    Pulls files into the page cache ahead of time, so that loading the next
+    track is not slowed down by the SD card.
+
+    Every load of a track is reported via loaded(), which counts a hit if
+    that file was prefetched before and a miss otherwise.
+    """
+    _CHUNK_SIZE = 256 * 1024
+
+    # Number of prefetched files remembered for hit/miss accounting
+    _REMEMBERED_FILES = 8
+
+    def __init__(self):
+        self._lock = Lock()
+        self._queue = Queue()
+        self._pending = set()
+        self._prefetched = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.prefetched_bytes = 0
+
+        self._prefetch_thread = Thread(target=self._prefetch_files)
+        self._prefetch_thread.daemon = True
+        self._prefetch_thread.start()
+
+    def prefetch(self, path):
+        with self._lock:
+            if path in self._pending or path in self._prefetched:
+                return
+            self._pending.add(path)
+
+        debug("queueing " + path)
+        self._queue.put(path)
+
+    def loaded(self, path):
+        with self._lock:
+            hit = self._prefetched.pop(path, None) is not None
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        debug("{} {}".format("hit" if hit else "miss", path))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "prefetched_bytes": self.prefetched_bytes
+            }
+
+    def _prefetch_files(self):
+        while True:
+            path = self._queue.get(block=True, timeout=None)
+            if path is None:
+                break
+
+            try:
+                size = self._read_ahead(path)
+            except OSError as e:
+                info("could not prefetch {}: {}".format(path, e))
+                size = None
+
+            with self._lock:
+                self._pending.discard(path)
+                if size is None:
+                    continue
+                self.prefetched_bytes += size
+                self._prefetched[path] = size
+                while len(self._prefetched) > Prefetcher._REMEMBERED_FILES:
+                    self._prefetched.popitem(last=False)
+
+    def _read_ahead(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            # The kernel's read ahead does the job asynchronously where available,
+            # otherwise just read the file once
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+            else:
+                while os.read(fd, Prefetcher._CHUNK_SIZE):
+                    pass
+        finally:
+            os.close(fd)
+
+        debug("prefetched {} ({} bytes)".format(path, size))
+        return size
+
+    def terminate(self):
+        debug("prefetcher terminating.")
+        if self._prefetch_thread is None:
+            debug("already terminated")
+            return
+
+        self._queue.put(None)
+        self._prefetch_thread.join()
+        self._prefetch_thread = None
+
+        info("prefetch stats: " + str(self.stats()))
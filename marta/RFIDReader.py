@@ -1,6 +1,9 @@
 from serial import Serial
 from threading import Thread, Event
 from logging import getLogger
+from time import monotonic as mtime
+
+import Latency
 
 debug = getLogger('RFIDReader').debug
 
@@ -59,6 +62,7 @@ class RFIDReader(object):
                 self._old_tag = ""
 
             elif head == RFIDReader.START_BYTE:
+                frame_started_at = mtime()
 
                 # actually the tag data is divided into 2 bytes version + 8 bytes tag + 2 bytes checksum
                 # I couldn't find out anything about the version differences, so I just ignored it.
@@ -81,6 +85,7 @@ class RFIDReader(object):
 
                         self._on_detection(tag)
                         self._old_tag = tag
+                        Latency.record("rfid", mtime() - frame_started_at)
 
     def terminate(self):
         debug("rfid terminating.")
@@ -0,0 +1,203 @@
+from threading import Thread, Lock, Event
+from logging import getLogger
+import json
+import os
+
+debug = getLogger('StateStore').debug
+info = getLogger('StateStore').info
+
+
+class StateStore(object):
+    """
+    Keeps the playback state of all playlists and albums in memory and
+    writes it to a single journal file in the background. Writes are
+    delayed by flush_delay seconds, so that all changes made meanwhile end
+    up in one write. The journal is replaced atomically, it is either the
+    old or the new one after a power loss.
+
+    States are addressed by the path of the file they used to live in,
+    e.g. "<album>/album.json". Given the library as legacy_root, those
+    files are taken over once, when there is no journal yet or it was
+    written before migrating. The journal records that, the files are left
+    alone and never read again.
+
+    Without a path nothing is written, e.g. for doctests. If given,
+    on_change() is called after every put().
+
+    >>> store = StateStore(None)
+    >>> store.get("/nowhere/album.json") is None
+    True
+    >>> store.put("/nowhere/album.json", {"idx": 3})
+    >>> store.get("/nowhere/album.json")
+    {'idx': 3}
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> os.makedirs(root + "/playlist/album")
+    >>> with open(root + "/playlist/album/album.json", "w") as f:
+    ...     _ = f.write('{"idx": 2, "position": 7}')
+    >>> store = StateStore(root + "/.state.json", legacy_root=root)
+    >>> store.get(root + "/playlist/album/album.json")
+    {'idx': 2, 'position': 7}
+    >>> store.terminate()
+    >>> os.unlink(root + "/playlist/album/album.json")
+    >>> StateStore(root + "/.state.json", legacy_root=root).get(root + "/playlist/album/album.json")
+    {'idx': 2, 'position': 7}
+    """
+    _VERSION = 1
+
+    _DEFAULT_FLUSH_DELAY = 2.0
+
+    # Names of the files states used to live in
+    _LEGACY_FILES = ["playlist.json", "album.json"]
+
+    def __init__(self, path, flush_delay=_DEFAULT_FLUSH_DELAY, on_change=None, legacy_root=None):
+        self.path = path
+        self._flush_delay = flush_delay
+        self._on_change = on_change
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self._states = {}
+        self._migrated = False
+        self._changed = False
+        self._wake = Event()
+        self._stopped = Event()
+        self._flush_thread = None
+
+        if path is None:
+            return
+
+        self._states = self._read_journal()
+        if legacy_root is not None and not self._migrated:
+            self._migrate(legacy_root)
+            self._wake.set()
+
+        self._flush_thread = Thread(target=self._flush_delayed)
+        self._flush_thread.daemon = True
+        self._flush_thread.start()
+
+    def _read_journal(self):
+        try:
+            with open(self.path, "r") as f:
+                journal = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            info("state journal {} is corrupt, starting over".format(self.path))
+            return {}
+
+        if journal.get("version") != StateStore._VERSION:
+            info("state journal version {} not supported".format(journal.get("version")))
+            return {}
+
+        debug("loaded {} states from {}".format(len(journal["states"]), self.path))
+        self._migrated = journal.get("migrated", False)
+        return journal["states"]
+
+    def _migrate(self, root):
+        '''
+        Takes over the state files of playlists and albums below root,
+        unless the journal has newer states. Paths are built like the
+        library builds them, so the keys match.
+        '''
+        migrated = 0
+        for playlist in os.listdir(root):
+            playlist_path = root + "/" + playlist
+            if not os.path.isdir(playlist_path):
+                continue
+
+            directories = [playlist_path] + [playlist_path + "/" + album for album in os.listdir(playlist_path)
+                                             if os.path.isdir(playlist_path + "/" + album)]
+            for directory in directories:
+                for name in StateStore._LEGACY_FILES:
+                    key = directory + "/" + name
+                    if key in self._states:
+                        continue
+                    try:
+                        with open(key, "r") as f:
+                            state = json.load(f)
+                    except (OSError, ValueError):
+                        continue
+                    if isinstance(state, dict):
+                        self._states[key] = state
+                        migrated += 1
+
+        info("migrated {} state files".format(migrated))
+        self._migrated = True
+        self._changed = True
+
+    def get(self, key):
+        '''
+        Returns a copy of the state stored under key or None.
+        '''
+        with self._lock:
+            state = self._states.get(key)
+        return dict(state) if state is not None else None
+
+    def put(self, key, state):
+        with self._lock:
+            self._states[key] = dict(state)
+            self._changed = True
+        self._wake.set()
+
+        if self._on_change is not None:
+            self._on_change()
+
+    def _flush_delayed(self):
+        while not self._stopped.is_set():
+            self._wake.wait()
+            # Give further changes the chance to make it into the same write
+            self._stopped.wait(self._flush_delay)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the journal now, if anything changed.
+        '''
+        if self.path is None:
+            return
+
+        with self._write_lock:
+            with self._lock:
+                if not self._changed:
+                    return
+                self._changed = False
+                data = json.dumps({"version": StateStore._VERSION, "migrated": self._migrated,
+                                   "states": self._states})
+
+            try:
+                self._write_atomically(data)
+            except OSError as e:
+                info("could not write state journal: " + str(e))
+                with self._lock:
+                    self._changed = True
+                return
+
+        debug("state journal written")
+
+    def _write_atomically(self, data):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        # Make the rename itself durable
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def terminate(self):
+        debug("state store terminating.")
+        if self._flush_thread is None:
+            return
+
+        self._stopped.set()
+        self._wake.set()
+        self._flush_thread.join()
+        self._flush_thread = None
+        self.flush()
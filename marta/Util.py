@@ -6,3 +6,16 @@ def sorted_aphanumeric(data):
     convert = lambda text: int(text) if text.isdigit() else text.lower()
     alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
     return sorted(data, key=alphanum_key)
+
+
+def lower_thread_priority(niceness=19):
+    '''
+    Lowers the scheduling priority of the calling thread only. Linux
+    treats threads as processes here, other platforms are left alone.
+    '''
+    try:
+        from os import setpriority, PRIO_PROCESS
+        from threading import get_native_id
+        setpriority(PRIO_PROCESS, get_native_id(), niceness)
+    except (ImportError, OSError):
+        pass
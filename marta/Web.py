@@ -6,6 +6,7 @@ from wtforms import Form, TextField, TextAreaField, validators, StringField, Sub
 from flask_bootstrap import Bootstrap
 from werkzeug.utils import secure_filename
 from multiprocessing import Process
+from EventManager import BridgeClient
 #from Marta import Marta
 EVENT_WEB_MUSIC = 5 # TODO
 
@@ -55,7 +56,7 @@ def playlist_load():
 
 @app.route('/music/playlist/all', methods=['GET'])
 def music_playlist():
-    return json.dumps(library_api.playlist("all"))
+    return library_api.playlists_json()
         
 @app.route('/music/playlist/assign/<playlist>', methods=['POST'])
 def playlist_assign(playlist):
@@ -91,6 +92,10 @@ def music_state():
             }
     return json.dumps(response)
 
+@app.route('/latency', methods=['GET'])
+def latency():
+    return json.dumps(bridge.call("latency_report"))
+
 @app.route('/volume', methods=['GET', 'POST'])
 def volume():
     return ""
@@ -147,13 +152,16 @@ def upload():
 #def send_js(filename):
 #    return send_from_directory("../web/static", filename)
 library_api = None
+bridge = BridgeClient()
 class WebServer(object):
     def __init__(self, lib_api, on_event):
+        global library_api
+        # Set before forking, so that the web process has it
+        library_api = lib_api
         self._web_process = Process(target=app.run, kwargs={"host":"0.0.0.0"})
         self._web_process.deamon = True
         self._web_process.start()
         self.send_event = on_event
-        library_api = lib_api
 
 #if __name__ == "__main__":
 #    audio_dir = "../audio"
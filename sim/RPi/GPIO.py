@@ -0,0 +1,94 @@
+"""
+Stand-in for RPi.GPIO, see benchmarks/bench_sim.py. Pins are pulled up
+and read 1 until a simulated button press pulls them down.
+
+    import RPi.GPIO as GPIO
+    GPIO.press(13, millis=120)
+"""
+from threading import Lock
+import time
+
+BCM = 11
+BOARD = 10
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+_lock = Lock()
+_levels = {}
+_callbacks = {}
+
+
+def setwarnings(flag):
+    pass
+
+
+def setmode(mode):
+    pass
+
+
+def setup(pin, direction, pull_up_down=PUD_OFF, initial=None):
+    with _lock:
+        if direction == IN:
+            _levels[pin] = LOW if pull_up_down == PUD_DOWN else HIGH
+        else:
+            _levels[pin] = initial if initial is not None else LOW
+
+
+def input(pin):
+    return _levels.get(pin, HIGH)
+
+
+def output(pin, value):
+    _levels[pin] = int(bool(value))
+
+
+def add_event_detect(pin, edge, callback=None, bouncetime=None):
+    with _lock:
+        _callbacks.setdefault(pin, []).append(callback)
+
+
+def remove_event_detect(pin):
+    with _lock:
+        _callbacks.pop(pin, None)
+
+
+def cleanup(pin=None):
+    with _lock:
+        if pin is None:
+            _levels.clear()
+            _callbacks.clear()
+        else:
+            _levels.pop(pin, None)
+            _callbacks.pop(pin, None)
+
+
+def set_input(pin, level):
+    '''
+    Drives an input pin and calls its edge callbacks in the calling thread,
+    like RPi.GPIO does in its own thread.
+    '''
+    with _lock:
+        changed = _levels.get(pin, HIGH) != level
+        _levels[pin] = level
+        callbacks = list(_callbacks.get(pin, []))
+
+    if changed:
+        for callback in callbacks:
+            callback(pin)
+
+
+def press(pin, millis=100):
+    '''
+    Pushes the button on pin for the given time, buttons are active low.
+    '''
+    set_input(pin, LOW)
+    time.sleep(millis / 1000.0)
+    set_input(pin, HIGH)
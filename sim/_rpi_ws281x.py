@@ -0,0 +1,115 @@
+"""
+Stand-in for the rpi_ws281x SWIG module, as used by marta/neopixel.py, see
+benchmarks/bench_sim.py. Rendering takes as long as sending the data to
+the strip at 800 kHz would.
+"""
+import time
+
+WS2811_SUCCESS = 0
+WS2811_STRIP_RGB = 0x00100800
+WS2811_STRIP_GRB = 0x00081000
+
+# Microseconds on the wire per LED and for the reset afterwards
+_MICROS_PER_LED = 30
+_RESET_MICROS = 50
+
+# Number of renders and LEDs set, per process
+renders = 0
+leds_set = 0
+
+
+class _Channel(object):
+    def __init__(self):
+        self.count = 0
+        self.gpionum = 0
+        self.invert = 0
+        self.brightness = 0
+        self.strip_type = WS2811_STRIP_RGB
+        self.leds = []
+
+
+class _Controller(object):
+    def __init__(self):
+        self.channels = [_Channel(), _Channel()]
+        self.freq = 800000
+        self.dmanum = 5
+
+
+def new_ws2811_t():
+    return _Controller()
+
+
+def delete_ws2811_t(controller):
+    pass
+
+
+def ws2811_channel_get(controller, channel):
+    return controller.channels[channel]
+
+
+def ws2811_channel_t_count_set(channel, count):
+    channel.count = count
+    channel.leds = [0] * count
+
+
+def ws2811_channel_t_count_get(channel):
+    return channel.count
+
+
+def ws2811_channel_t_gpionum_set(channel, gpionum):
+    channel.gpionum = gpionum
+
+
+def ws2811_channel_t_invert_set(channel, invert):
+    channel.invert = invert
+
+
+def ws2811_channel_t_brightness_set(channel, brightness):
+    channel.brightness = brightness
+
+
+def ws2811_channel_t_brightness_get(channel):
+    return channel.brightness
+
+
+def ws2811_channel_t_strip_type_set(channel, strip_type):
+    channel.strip_type = strip_type
+
+
+def ws2811_t_freq_set(controller, freq):
+    controller.freq = freq
+
+
+def ws2811_t_dmanum_set(controller, dmanum):
+    controller.dmanum = dmanum
+
+
+def ws2811_init(controller):
+    return WS2811_SUCCESS
+
+
+def ws2811_fini(controller):
+    pass
+
+
+def ws2811_render(controller):
+    global renders
+    renders += 1
+    count = sum(channel.count for channel in controller.channels)
+    time.sleep((count * _MICROS_PER_LED + _RESET_MICROS) / 1000000.0)
+    return WS2811_SUCCESS
+
+
+def ws2811_get_return_t_str(code):
+    return "simulated error {}".format(code)
+
+
+def ws2811_led_get(channel, n):
+    return channel.leds[n]
+
+
+def ws2811_led_set(channel, n, color):
+    global leds_set
+    leds_set += 1
+    channel.leds[n] = color
+    return 0
@@ -0,0 +1,173 @@
+"""
+Speaks mpg123's --remote protocol without decoding or playing anything,
+see benchmarks/bench_sim.py. Tracks take as long as the real file lasts,
+if marta/MP3Info can tell, or --track-seconds otherwise. With --speed
+everything is played that many times faster. --load-seconds makes loading
+a track take that long, like from a slow SD card.
+
+    python3 sim/fake_mpg123.py [--remote] [--track-seconds 180] [--speed 1] [--load-seconds 0]
+"""
+from argparse import ArgumentParser
+from threading import Thread, Lock, Event
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "marta"))
+
+from MP3Info import read_stream_info  # noqa: E402
+
+STOPPED = 0
+PAUSED = 1
+PLAYING = 2
+
+# Seconds per MPEG frame at 44.1 kHz, @F lines come this often
+FRAME_SECONDS = 1152 / 44100.0
+
+
+class FakeMPG123(object):
+    def __init__(self, track_seconds, speed, load_seconds=0, out=sys.stdout):
+        self._track_seconds = track_seconds
+        self._speed = speed
+        self._load_seconds = load_seconds
+        self._out = out
+        self._out_lock = Lock()
+        self._lock = Lock()
+        self._quit = Event()
+
+        self.state = STOPPED
+        self.sample_rate = 44100
+        self.length = 0
+        self.pitch = 0.0
+        self.progress = False
+        # Samples played until the last state change and when that was
+        self._position = 0
+        self._since = time.time()
+
+        self._ticker_thread = Thread(target=self._tick)
+        self._ticker_thread.daemon = True
+        self._ticker_thread.start()
+
+    def say(self, line):
+        with self._out_lock:
+            self._out.write(line + "\n")
+            self._out.flush()
+
+    def _rate(self):
+        return self.sample_rate * self._speed * (1 + self.pitch)
+
+    def position(self):
+        if self.state != PLAYING:
+            return self._position
+        return min(self.length, self._position + int((time.time() - self._since) * self._rate()))
+
+    def _set_state(self, state, position=None):
+        self._position = self.position() if position is None else position
+        self._since = time.time()
+        self.state = state
+
+    def _tick(self):
+        while not self._quit.wait(FRAME_SECONDS / self._speed):
+            with self._lock:
+                if self.state != PLAYING:
+                    continue
+                position = self.position()
+                if position >= self.length:
+                    self._set_state(STOPPED, 0)
+                    self.say("@P 0")
+                elif self.progress:
+                    seconds = position / float(self.sample_rate)
+                    left = (self.length - position) / float(self.sample_rate)
+                    self.say("@F {} {} {:.2f} {:.2f}".format(int(seconds / FRAME_SECONDS),
+                                                             int(left / FRAME_SECONDS), seconds, left))
+
+    def _open(self, path):
+        time.sleep(self._load_seconds)
+        if not os.path.isfile(path):
+            self.say("@E Error opening stream: " + path)
+            self._set_state(STOPPED, 0)
+            self.say("@P 0")
+            return False
+
+        info = read_stream_info(path)
+        if info is not None:
+            length_in_millis, self.sample_rate = info
+        else:
+            length_in_millis, self.sample_rate = self._track_seconds * 1000, 44100
+        self.length = int(length_in_millis * self.sample_rate / 1000)
+        self.say("@I ID3:" + os.path.basename(path))
+        return True
+
+    def _stream_info(self):
+        self.say("@S 1.0 3 {} Joint-Stereo 0 417 2 0 0 0 128 0 1".format(self.sample_rate))
+
+    def command(self, line):
+        parts = line.strip().split(" ", 1)
+        name = parts[0].upper()
+        argument = parts[1] if len(parts) > 1 else ""
+
+        with self._lock:
+            if name in ("L", "LOAD"):
+                if self._open(argument):
+                    self._stream_info()
+                    self._set_state(PLAYING, 0)
+                    self.say("@P 2")
+            elif name in ("LP", "LOADPAUSED"):
+                if self._open(argument):
+                    self._set_state(PAUSED, 0)
+                    self.say("@P 1")
+            elif name in ("P", "PAUSE"):
+                if self.state == PAUSED:
+                    self._stream_info()
+                    self._set_state(PLAYING)
+                    self.say("@P 2")
+                elif self.state == PLAYING:
+                    self._set_state(PAUSED)
+                    self.say("@P 1")
+            elif name in ("S", "STOP"):
+                self._set_state(STOPPED, 0)
+                self.say("@P 0")
+            elif name in ("K", "SEEK"):
+                self._set_state(self.state, max(0, min(self.length, int(argument))))
+                self.say("@K {}".format(self._position))
+            elif name in ("V", "VOLUME"):
+                self.say("@V {:f}%".format(float(argument)))
+            elif name == "PITCH":
+                self._set_state(self.state)
+                self.pitch = float(argument)
+                self.say("@PITCH {:f}".format(self.pitch))
+            elif name == "SAMPLE":
+                self.say("@SAMPLE {} {}".format(self.position(), self.length))
+            elif name == "SILENCE":
+                self.progress = False
+                self.say("@silence")
+            elif name == "PROGRESS":
+                self.progress = True
+                self.say("@progress")
+            elif name in ("Q", "QUIT"):
+                self._quit.set()
+            else:
+                self.say("@E Unknown command or no arguments: " + name)
+
+    def run(self, lines):
+        self.say("@R MPG123 (ThOr) v10")
+        for line in lines:
+            if line.strip():
+                self.command(line)
+            if self._quit.is_set():
+                break
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--remote", action="store_true", help="ignored, always on")
+    parser.add_argument("--track-seconds", type=float, default=180)
+    parser.add_argument("--speed", type=float, default=1)
+    parser.add_argument("--load-seconds", type=float, default=0)
+    args = parser.parse_args()
+
+    FakeMPG123(args.track_seconds, args.speed, args.load_seconds).run(sys.stdin)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Stand-in for pyserial with an RDM6300 RFID reader on the port, see
+benchmarks/bench_sim.py. While a tag is placed, its frame is sent over
+and over again like the reader does, nothing is sent otherwise.
+
+    import serial
+    serial.place_tag(serial.tag_with_checksum("5500ACB961"))
+"""
+from threading import Condition
+import time
+
+# Time the reader takes to send a frame again while the tag stays
+_FRAME_INTERVAL = 0.06
+
+# Seconds per byte at 9600 baud with 8N1
+_BYTE_TIME = 10.0 / 9600
+
+_changed = Condition()
+_tag = None
+_generation = 0
+
+
+def tag_with_checksum(data):
+    '''
+    The twelve characters the reader sends for the ten given hex digits,
+    i.e. with the XOR checksum appended.
+
+    >>> tag_with_checksum("5500ACB961")
+    '5500ACB96121'
+    '''
+    checksum = 0
+    for i in range(0, 10, 2):
+        checksum ^= int(data[i:i + 2], 16)
+    return data.upper() + "{:02X}".format(checksum)
+
+
+def frame_for(tag):
+    return b"\x02" + tag.encode("latin-1") + b"\x03"
+
+
+def place_tag(tag):
+    global _tag, _generation
+    with _changed:
+        _tag = tag
+        _generation += 1
+        _changed.notify_all()
+
+
+def remove_tag():
+    place_tag(None)
+
+
+class Serial(object):
+    def __init__(self, port=None, baudrate=9600, timeout=None):
+        self.port = port
+        self.timeout = timeout
+        self._pending = b""
+        self._next_frame_at = 0
+        self._generation = None
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        data = b""
+        while len(data) < size:
+            if not self._pending and not self._wait_for_frame(deadline):
+                break
+            chunk = self._pending[:size - len(data)]
+            self._pending = self._pending[len(chunk):]
+            data += chunk
+
+        time.sleep(len(data) * _BYTE_TIME)
+        return data
+
+    def _wait_for_frame(self, deadline):
+        with _changed:
+            while True:
+                now = time.time()
+                if _tag is not None and (now >= self._next_frame_at or self._generation != _generation):
+                    self._pending = frame_for(_tag)
+                    self._next_frame_at = now + _FRAME_INTERVAL
+                    self._generation = _generation
+                    return True
+
+                timeout = None if deadline is None else deadline - now
+                if _tag is not None:
+                    timeout = self._next_frame_at - now if timeout is None else min(timeout,
+                                                                                   self._next_frame_at - now)
+                if timeout is not None and timeout <= 0:
+                    return False
+                _changed.wait(timeout)
+
+    def close(self):
+        pass
@@ -0,0 +1,54 @@
+"""
+Stand-in for smbus with an MPU-6050 on it, see benchmarks/bench_sim.py.
+The accelerometer reports gravity as if the device was tilted by tilt().
+"""
+from math import radians, sin, cos
+from threading import Lock
+
+# Accelerometer output registers, high byte first
+_ACCEL_XOUT = 0x3b
+_ACCEL_YOUT = 0x3d
+_ACCEL_ZOUT = 0x3f
+
+# Raw value of 1 g at the default range of +-2 g
+_ONE_G = 16384
+
+_lock = Lock()
+_registers = {}
+
+
+def _set_word(register, value):
+    value &= 0xffff
+    _registers[register] = value >> 8
+    _registers[register + 1] = value & 0xff
+
+
+def tilt(x_degrees, y_degrees):
+    '''
+    Tilts the device around the x and y axis, as MPU.get_rotation() reports
+    them.
+    '''
+    x, y = radians(x_degrees), radians(y_degrees)
+    with _lock:
+        _set_word(_ACCEL_XOUT, int(round(-sin(y) * _ONE_G)))
+        _set_word(_ACCEL_YOUT, int(round(cos(y) * sin(x) * _ONE_G)))
+        _set_word(_ACCEL_ZOUT, int(round(cos(y) * cos(x) * _ONE_G)))
+
+
+tilt(0, 0)
+
+
+class SMBus(object):
+    def __init__(self, bus=None):
+        self.bus = bus
+
+    def write_byte_data(self, address, register, value):
+        # Waking the MPU up is all that is ever written
+        pass
+
+    def read_byte_data(self, address, register):
+        with _lock:
+            return _registers.get(register, 0)
+
+    def close(self):
+        pass